@@ -5,22 +5,231 @@ be run inside a qiime2 container an example definition is provided
 This is an extremely resource intensive process and can take
 in excess of 7 hours, and use 42 GB of ram
 
+The imported reference sequences and the reads extracted with a primer pair
+are cached in the cache directory so they are only created once for each
+reference and primer pair. The naive bayes model is fitted in chunks of
+--chunk-size reference sequences (classify__chunk_size). The default of 5000,
+rather than the 20000 of qiime2, lowers the memory used by each partial fit
+but makes the fit slower, it does not limit the memory of the reference
+sequences or the fitted classifier which grow with the reference database.
+Each of the --workers processes trains one reference and the memory of every
+reference being trained is used at once, the default of 1 trains them one
+after the other. Use more workers only if there is memory for all of the
+references trained together.
+--benchmark trains on a small synthetic reference to compare chunk sizes
+
 The classifiers created during this process have been provided in
 the one drive link
 https://1drv.ms/u/s!Aus7JUVmM6BTgbsirlMW6ddWK-bn7Q?e=wNHBJD
 """
 
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
 import qiime2
-from qiime2.plugins.feature_classifier.methods import extract_reads,  fit_classifier_naive_bayes
-
-# Import the refernce database files
-seqs = qiime2.Artifact.import_data("FeatureData[Sequence]","99_Silva_111_rep_set.fasta")
-taxa = qiime2.Artifact.import_data("FeatureData[Taxonomy]","99_Silva_111_taxa_map.txt")
-seqs138 = qiime2.Artifact.load("silva-138-99-seqs.qza")
-taxa138 = qiime2.Artifact.load("silva-138-99-tax.qza")
-
-#Create and save the classifiers
-classifier =  fit_classifier_naive_bayes(seqs,taxa,verbose = True)
-classifier.classifier.save("Silva_111")
-classifier = fit_classifier_naive_bayes(seqs138,taxa138,verbose = True)
-classifier.classifier.save("Silva_138")
\ No newline at end of file
+from qiime2.plugins.feature_classifier.methods import extract_reads, fit_classifier_naive_bayes
+
+# The reference databases, either files to import or existing artifacts
+REFERENCES = {
+    "Silva_111": {"sequences": "99_Silva_111_rep_set.fasta", "taxonomy": "99_Silva_111_taxa_map.txt"},
+    "Silva_138": {"sequences": "silva-138-99-seqs.qza", "taxonomy": "silva-138-99-tax.qza"}
+}
+
+
+def file_key(*parts):
+    """
+    A short hash used to name cached files
+    :param parts: The values the cached file depends on
+    :return: The hex digest
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def load_reference(location, semantic_type, cache_dir):
+    """
+    Load a reference artifact, files that are not artifacts are imported once and the artifact is cached
+    :param location: The location of the .qza, fasta or taxonomy file
+    :param semantic_type: The type to import the file as
+    :param cache_dir: The directory of the cached artifacts
+    :return: The artifact
+    """
+    if location.endswith(".qza"):
+        return qiime2.Artifact.load(location)
+
+    stat = os.stat(location)
+    cache_file = os.path.join(cache_dir, os.path.basename(location) + "-" +
+                              file_key(os.path.abspath(location), stat.st_size, stat.st_mtime) + ".qza")
+    if os.path.exists(cache_file):
+        return qiime2.Artifact.load(cache_file)
+
+    artifact = qiime2.Artifact.import_data(semantic_type, location)
+    artifact.save(cache_file)
+    return artifact
+
+
+def reference_reads(name, sequences, primers, cache_dir):
+    """
+    Get the reads of a reference, if a primer pair is given the reads between the primers are extracted once for each
+    reference and primer pair and cached
+    :param name: The name of the reference
+    :param sequences: The reference sequences artifact
+    :param primers: The extract_reads parameters (f_primer, r_primer, trunc_len...) or None to use the full sequences
+    :param cache_dir: The directory of the cached artifacts
+    :return: The reads artifact
+    """
+    if not primers:
+        return sequences
+
+    cache_file = os.path.join(cache_dir, name + "-reads-" + file_key(str(sequences.uuid), primers) + ".qza")
+    if os.path.exists(cache_file):
+        print(name + ": using cached reads " + cache_file)
+        return qiime2.Artifact.load(cache_file)
+
+    start = time.time()
+    reads = extract_reads(sequences, **primers).reads
+    reads.save(cache_file)
+    print(name + ": extracted reads in " + str(round(time.time() - start, 1)) + "s")
+    return reads
+
+
+def train(job):
+    """
+    Train the classifier of one reference, run in a worker process
+    :param job: A tuple of the name, the reference definition, the primers, the chunk size, the cache directory and
+    the output directory
+    :return: The location of the classifier with the wall time and peak memory of the worker
+    """
+    name, reference, primers, chunk_size, cache_dir, output_dir = job
+    start = time.time()
+    sequences = load_reference(reference["sequences"], "FeatureData[Sequence]", cache_dir)
+    taxonomy = load_reference(reference["taxonomy"], "FeatureData[Taxonomy]", cache_dir)
+    reads = reference_reads(name, sequences, primers, cache_dir)
+
+    # The naive bayes model is fitted with partial fits of chunk_size sequences
+    classifier = fit_classifier_naive_bayes(reads, taxonomy, classify__chunk_size=chunk_size, verbose=True)
+    location = classifier.classifier.save(os.path.join(output_dir, name))
+
+    # ru_maxrss is in kilobytes, each worker only trains one reference so this is the peak of the reference
+    return {
+        "reference": name,
+        "classifier": location,
+        "wall_time": time.time() - start,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+
+
+def train_all(references, primers, chunk_size, workers, cache_dir, output_dir):
+    """
+    Train the classifiers of several references in parallel worker processes
+    :param references: A dictionary of the name of each reference to its sequences and taxonomy files
+    :param primers: The extract_reads parameters or None
+    :param chunk_size: The number of sequences in each partial fit
+    :param workers: The number of references trained at once
+    :param cache_dir: The directory of the cached artifacts
+    :param output_dir: The directory to save the classifiers to
+    :return: The results of each reference
+    """
+    for directory in (cache_dir, output_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    jobs = [(name, reference, primers, chunk_size, cache_dir, output_dir) for name, reference in references.items()]
+    results = []
+    pool = multiprocessing.Pool(min(workers, len(jobs)), maxtasksperchild=1)
+    try:
+        for result in pool.imap_unordered(train, jobs):
+            print(result["reference"] + ": trained in " + str(round(result["wall_time"], 1)) + "s, peak memory " +
+                  str(round(result["peak_rss_mb"], 1)) + "MB, saved to " + result["classifier"])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def synthetic_reference(directory, n_sequences, length=1400, n_taxa=50, seed=1):
+    """
+    Create a random reference database for benchmarking. Sequences of the same taxon share most of their bases so the
+    classifier has something to learn
+    :param directory: The directory to write the fasta and taxonomy files to
+    :param n_sequences: The number of sequences
+    :param length: The length of each sequence
+    :param n_taxa: The number of taxa
+    :param seed: The random seed
+    :return: The reference definition
+    """
+    rng = random.Random(seed)
+    bases = "ACGT"
+    taxa = []
+    for i in range(n_taxa):
+        lineage = "D_0__Bacteria;D_1__Phylum" + str(i % 5) + ";D_2__Class" + str(i % 10) + ";D_3__Genus" + str(i)
+        template = [rng.choice(bases) for _ in range(length)]
+        taxa.append((lineage, template))
+
+    sequences = os.path.join(directory, "synthetic_seqs.fasta")
+    taxonomy = os.path.join(directory, "synthetic_taxa.txt")
+    with open(sequences, "w") as seq_file, open(taxonomy, "w") as tax_file:
+        for i in range(n_sequences):
+            lineage, template = taxa[i % n_taxa]
+            sequence = [base if rng.random() > 0.03 else rng.choice(bases) for base in template]
+            seq_file.write(">seq" + str(i) + "\n" + "".join(sequence) + "\n")
+            tax_file.write("seq" + str(i) + "\t" + lineage + "\n")
+    return {"sequences": sequences, "taxonomy": taxonomy}
+
+
+def benchmark(n_sequences, chunk_sizes):
+    """
+    Train classifiers on a synthetic reference with each chunk size and print the time and peak memory, one at a time
+    so the measurements are not affected by each other
+    :param n_sequences: The number of sequences in the synthetic reference
+    :param chunk_sizes: The chunk sizes to compare
+    :return: The results
+    """
+    directory = tempfile.mkdtemp(prefix="classifier_benchmark_")
+    try:
+        reference = synthetic_reference(directory, n_sequences)
+        results = []
+        for chunk_size in chunk_sizes:
+            results.extend(train_all({"Synthetic_" + str(chunk_size): reference}, None, chunk_size, 1,
+                                     os.path.join(directory, "cache"), os.path.join(directory, "classifiers")))
+        print("{0:<12} {1:>10} {2:>14}".format("chunk_size", "time (s)", "peak RSS (MB)"))
+        for chunk_size, result in zip(chunk_sizes, results):
+            print("{0:<12} {1:>10.1f} {2:>14.1f}".format(chunk_size, result["wall_time"], result["peak_rss_mb"]))
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train naive bayes classifiers for the reference databases")
+    parser.add_argument("--references", nargs="*", default=list(REFERENCES), choices=list(REFERENCES))
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of references trained at once, each uses the memory of its own reference")
+    parser.add_argument("--chunk-size", type=int, default=5000,
+                        help="Number of sequences in each partial fit, lower values use less memory but are slower")
+    parser.add_argument("--f-primer", help="Forward primer to extract the reads of the amplified region")
+    parser.add_argument("--r-primer", help="Reverse primer to extract the reads of the amplified region")
+    parser.add_argument("--trunc-len", type=int, default=0, help="Length to truncate the extracted reads to")
+    parser.add_argument("--cache-dir", default="cache")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--benchmark", type=int, metavar="N_SEQUENCES",
+                        help="Train on a synthetic reference of this many sequences instead")
+    parser.add_argument("--benchmark-chunk-sizes", type=int, nargs="*", default=[1000, 5000, 20000])
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.benchmark_chunk_sizes)
+    else:
+        primers = None
+        if args.f_primer and args.r_primer:
+            primers = {"f_primer": args.f_primer, "r_primer": args.r_primer, "trunc_len": args.trunc_len}
+        train_all(dict((name, REFERENCES[name]) for name in args.references), primers, args.chunk_size, args.workers,
+                  args.cache_dir, args.output_dir)
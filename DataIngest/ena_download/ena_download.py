@@ -1,16 +1,221 @@
+import csv
+import hashlib
+import io
+import itertools
 import json
-from ftplib import FTP
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from ftplib import FTP, all_errors, error_perm
 from os import path
+import posixpath
+import re
+from pymongo import errors
 from pymongoClient import client
 
 
+
+class checksumError(Exception):
+    """
+    Raised when a downloaded file does not match the size or MD5 given in the file report
+    """
+
+
+# Errors after which a download is retried
+download_errors = all_errors + (checksumError,)
+
+
+def file_md5(file_path, chunk_size=1 << 20):
+    """
+    Hash a file in chunks so large files are never held in memory
+    :param file_path: The file to hash
+    :param chunk_size: The number of bytes read at a time
+    :return: The md5 hash object so more data can be added to it
+    """
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest
+
+
+def fsync_dir(directory):
+    """
+    Flush a directory entry to disk so a rename into it survives a crash
+    :param directory: The directory to flush
+    :return: NONE
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+
+# Whitespace and the commas between the records of a json array
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_records(f, buffer="", chunk_size=1 << 16):
+    """
+    Stream the objects of a json array (or of a file with one json object per line) one at a time
+    :param f: The open report file
+    :param buffer: Text already read from the start of the file
+    :param chunk_size: The number of characters read at a time
+    :return: A generator of the records
+    """
+    decoder = json.JSONDecoder()
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        pos = JSON_SEPARATORS.match(buffer, pos).end()
+        if pos < len(buffer):
+            if not started:
+                started = True
+                if buffer[pos] == "[":
+                    pos += 1
+                    continue
+            if buffer[pos] == "]":
+                return
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+                yield record
+                continue
+            except ValueError:
+                # The record is incomplete unless the whole file has been read
+                if eof:
+                    raise
+        elif eof:
+            return
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_report(report, chunk_size=1 << 16):
+    """
+    Stream the records of an ENA file report without loading the whole report. Both the json and the tsv formats of the
+    report are supported
+    :param report: The location of the report or the contents of the report
+    :param chunk_size: The number of characters read at a time
+    :return: A generator of the records as dictionaries
+    """
+    f = open(report, "r") if path.exists(report) else io.StringIO(report)
+    with f:
+        head = f.read(chunk_size)
+        if head.lstrip()[:1] in ("[", "{"):
+            for record in iter_json_records(f, head, chunk_size):
+                yield record
+        else:
+            # Complete the partially read line so the reader sees whole lines
+            lines = itertools.chain(io.StringIO(head + f.readline()), f)
+            for record in csv.DictReader(lines, delimiter="\t"):
+                yield record
+
+
+class downloadManifest:
+    """
+    Records the expected and verified size and MD5 of every downloaded run. Re-runs use it to skip files that are
+    already complete without reading them again
+    """
+    def __init__(self, location, save_every=50):
+        """
+        :param location: The path of the manifest file
+        :param save_every: The number of updates between each write of the manifest to disk
+        """
+        self.location = location
+        self.save_every = save_every
+        self.unsaved = 0
+        self.entries = {}
+        if os.path.exists(location):
+            with open(location, "r") as f:
+                self.entries = json.load(f)
+
+    def expected(self, sample):
+        """
+        Get the expected size and MD5 of a run from the fastq_bytes and fastq_md5 fields of the ENA file report
+        :param sample: The file report entry for the run
+        :return: The expected size and MD5, either may be None if the report does not include the field
+        """
+        size = sample.get('fastq_bytes')
+        md5 = sample.get('fastq_md5')
+        size = int(str(size).split(';')[0]) if size else None
+        md5 = md5.split(';')[0].lower() if md5 else None
+        return size, md5
+
+    def is_complete(self, run_accession, file_path, expected_size, expected_md5):
+        """
+        Check if a file was verified by a previous run and has not changed since
+        :param run_accession: The run the file belongs to
+        :param file_path: The location of the file
+        :param expected_size: The size the file should be
+        :param expected_md5: The MD5 the file should have
+        :return: True if the file can be skipped
+        """
+        entry = self.entries.get(run_accession)
+        if entry is None or not os.path.exists(file_path):
+            return False
+        stat = os.stat(file_path)
+        if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+            return False
+        if expected_size is not None and expected_size != entry["size"]:
+            return False
+        if expected_md5 and expected_md5 != entry["md5"]:
+            return False
+        return True
+
+    def update(self, run_accession, result, expected_size, expected_md5):
+        """
+        Record a completed download
+        :param run_accession: The run the file belongs to
+        :param result: The result of the download (file, size and md5)
+        :param expected_size: The size given in the file report
+        :param expected_md5: The MD5 given in the file report
+        :return: NONE
+        """
+        self.entries[run_accession] = {
+            "file": result["file"],
+            "size": result["size"],
+            "md5": result["md5"],
+            "expected_size": expected_size,
+            "expected_md5": expected_md5,
+            "mtime": os.stat(result["file"]).st_mtime
+        }
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        """
+        Atomically write the manifest to disk
+        :return: NONE
+        """
+        temp = self.location + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.entries, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.location)
+        self.unsaved = 0
+
+
 class ftpDownloader:
     """
     Class that allows the downloading of files through the FTP protocol
     """
-    def __init__(self):
+    def __init__(self, port=21, timeout=60, user='anonymous', password=''):
         self.URL = None
+        self.port = port
+        self.timeout = timeout
+        self.user = user
+        self.password = password
+        self.connection = None
+        self.home = None
         self.file_location = None
         self.file = None
         self.output_dir = None
@@ -51,35 +256,347 @@ class ftpDownloader:
 
     def connect(self):
         """
-        Connects to the ftp server
+        Connects to the ftp server, the root URL may include a port (host:port) which is useful for local test servers
         :return:
         """
         print("Connecting to ftp server")
-        self.connection = FTP(self.URL, timeout=60)
-        self.connection.login('anonymous', '')
+        host, port = self.URL, self.port
+        if ":" in host:
+            host, port = host.rsplit(":", 1)
+        self.connection = FTP(timeout=self.timeout)
+        self.connection.connect(host, int(port))
+        self.connection.login(self.user, self.password)
+        # Remember the login directory so files can be requested by their full path without changing directory
+        self.home = self.connection.pwd()
 
-    def download(self):
+    def remote_path(self):
         """
-        Downloads a file
-        :return:
+        The full path of the current file on the server
+        :return: The path relative to the root of the server
         """
-        # Restore directory to root
-        self.connection.cwd("~")
-        self.connection.cwd(self.file_location)
-        self.connection.retrbinary("RETR " + self.file, open(os.path.join(self.output_dir, self.file), 'wb').write)
+        return posixpath.join(self.home, self.file_location, self.file)
+
+    def remote_size(self):
+        """
+        Ask the server for the size of the current file
+        :return: The size in bytes or None if the server does not support the SIZE command
+        """
+        try:
+            self.connection.voidcmd("TYPE I")
+            return self.connection.size(self.remote_path())
+        except error_perm:
+            return None
+
+    def download(self, expected_size=None, expected_md5=None, callback=None):
+        """
+        Downloads a file into a temporary .part file which is only renamed into place once its size and MD5 have been
+        verified. If a partial file already exists the transfer is resumed from the end of it using a REST offset
+        :param expected_size: The size of the file from the file report, asked from the server if not given
+        :param expected_md5: The MD5 of the file from the file report, not verified if not given
+        :param callback: Optional function called with the size of every chunk written
+        :return: A dictionary with the path, size and MD5 of the file and the number of bytes transferred
+        """
+        destination = os.path.join(self.output_dir, self.file)
+        partial = destination + ".part"
+        if expected_size is None:
+            expected_size = self.remote_size()
+
+        # A complete copy from a previous run is hashed once and kept if it matches
+        if os.path.exists(destination):
+            if expected_size is None or os.path.getsize(destination) == expected_size:
+                md5 = file_md5(destination).hexdigest()
+                if not expected_md5 or md5 == expected_md5:
+                    return {"file": destination, "size": os.path.getsize(destination), "md5": md5, "transferred": 0}
+            os.remove(destination)
+
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if expected_size is not None and offset > expected_size:
+            # The local copy can not be a prefix of the remote file so start again
+            offset = 0
+
+        # The data already on disk is hashed once and the rest is hashed as it is written
+        digest = file_md5(partial) if offset else hashlib.md5()
+        transferred = 0
+        with open(partial, 'ab' if offset else 'wb') as f:
+            def write(chunk):
+                nonlocal transferred
+                f.write(chunk)
+                digest.update(chunk)
+                transferred += len(chunk)
+                if callback is not None:
+                    callback(len(chunk))
+
+            if expected_size is None or offset < expected_size:
+                self.connection.retrbinary("RETR " + self.remote_path(), write, rest=offset or None)
+            f.flush()
+            os.fsync(f.fileno())
+
+        size = offset + transferred
+        md5 = digest.hexdigest()
+        if (expected_size is not None and size != expected_size) or (expected_md5 and md5 != expected_md5):
+            os.remove(partial)
+            raise checksumError("Downloaded " + self.file + " does not match the expected size and MD5")
+
+        os.replace(partial, destination)
+        fsync_dir(self.output_dir)
+        return {"file": destination, "size": size, "md5": md5, "transferred": transferred}
+
+    def alive(self):
+        """
+        Check the connection is still open, servers drop connections that have been idle for too long
+        :return: True if the server answered
+        """
+        try:
+            self.connection.voidcmd("NOOP")
+            return True
+        except all_errors:
+            return False
 
     def close(self):
         self.connection.close()
 
 
+class ftpConnectionPool:
+    """
+    A bounded set of logged in FTP connections for each host which are shared between download workers
+    """
+    def __init__(self, connections_per_host, **connection_args):
+        """
+        :param connections_per_host: The maximum number of open connections to a single host
+        :param connection_args: Arguments passed to each ftpDownloader (port, timeout, user, password)
+        """
+        self.connections_per_host = connections_per_host
+        self.connection_args = connection_args
+        self.idle = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        """
+        Get a connection to the host, blocking while all of the connections to that host are in use. Idle connections
+        are checked before they are reused and replaced if the server has closed them
+        :param host: The root URL of the server
+        :return: A connected ftpDownloader
+        """
+        with self.lock:
+            slots = self.slots.setdefault(host, threading.BoundedSemaphore(self.connections_per_host))
+        slots.acquire()
+
+        while True:
+            with self.lock:
+                idle = self.idle.setdefault(host, [])
+                ftp = idle.pop() if idle else None
+            if ftp is None:
+                break
+            if ftp.alive():
+                return ftp
+            try:
+                ftp.close()
+            except all_errors:
+                pass
+        try:
+            ftp = ftpDownloader(**self.connection_args)
+            ftp.URL = host
+            ftp.connect()
+            return ftp
+        except all_errors:
+            slots.release()
+            raise
+
+    def release(self, ftp, broken=False):
+        """
+        Return a connection to the pool
+        :param ftp: The connection being returned
+        :param broken: If the connection failed it is closed rather than reused
+        :return: NONE
+        """
+        if broken:
+            try:
+                ftp.close()
+            except all_errors:
+                pass
+        else:
+            with self.lock:
+                self.idle[ftp.URL].append(ftp)
+        self.slots[ftp.URL].release()
+
+    def close(self):
+        """
+        Close all the idle connections
+        :return: NONE
+        """
+        with self.lock:
+            for connections in self.idle.values():
+                for ftp in connections:
+                    try:
+                        ftp.close()
+                    except all_errors:
+                        pass
+            self.idle = {}
+
+
+class pooledDownloader:
+    """
+    Downloads a number of files at once with a pool of worker threads that share a bounded number of FTP connections
+    per host. Failed transfers are retried with exponential backoff and resume from the data already on disk
+    """
+    def __init__(self, workers=4, connections_per_host=4, retries=5, backoff=2.0, **connection_args):
+        """
+        :param workers: The number of files to download at the same time
+        :param connections_per_host: The maximum number of open connections to a single host
+        :param retries: The number of times a failed download is retried
+        :param backoff: The base delay in seconds between retries, doubled after every failure
+        :param connection_args: Arguments passed to each ftpDownloader (port, timeout, user, password)
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ftpConnectionPool(connections_per_host, **connection_args)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ftp-worker")
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def submit(self, url, output_dir, expected_size=None, expected_md5=None):
+        """
+        Queue a file for download
+        :param url: The ftp url of the file
+        :param output_dir: The directory to store the file in
+        :param expected_size: The size the file should be
+        :param expected_md5: The MD5 the file should have
+        :return: A future that resolves to the result of ftpDownloader.download
+        """
+        return self.executor.submit(self.fetch, url, output_dir, expected_size, expected_md5)
+
+    def fetch(self, url, output_dir, expected_size=None, expected_md5=None):
+        """
+        Download a single file retrying on failure
+        :param url: The ftp url of the file
+        :param output_dir: The directory to store the file in
+        :param expected_size: The size the file should be
+        :param expected_md5: The MD5 the file should have
+        :return: The result of ftpDownloader.download
+        """
+        host = url.split("/", 1)[0]
+        attempt = 0
+        while True:
+            ftp = None
+            # Any other error (or an interrupt) leaves the connection in an unknown state so it is not reused
+            broken = True
+            try:
+                ftp = self.pool.acquire(host)
+                ftp.update_url(url)
+                ftp.update_output_dir(output_dir)
+                start = time.time()
+                result = ftp.download(expected_size, expected_md5)
+                broken = False
+                self.record(result["transferred"], time.time() - start)
+                return result
+            except download_errors as err:
+                # A checksum failure leaves the connection itself usable
+                broken = not isinstance(err, checksumError)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                error = err
+            finally:
+                if ftp is not None:
+                    self.pool.release(ftp, broken=broken)
+            delay = self.backoff * 2 ** (attempt - 1) + random.uniform(0, self.backoff)
+            print("Download of", url, "failed (" + str(error) + ") retrying in", round(delay, 1), "seconds")
+            time.sleep(delay)
+
+    def record(self, transferred, seconds):
+        """
+        Add a completed transfer to the throughput statistics of the current worker
+        :param transferred: The number of bytes transferred
+        :param seconds: The time the transfer took
+        :return: NONE
+        """
+        worker = threading.current_thread().name
+        with self.stats_lock:
+            stats = self.stats.setdefault(worker, {"files": 0, "bytes": 0, "seconds": 0.0})
+            stats["files"] += 1
+            stats["bytes"] += transferred
+            stats["seconds"] += seconds
+
+    def report(self):
+        """
+        Print the throughput of each worker
+        :return: NONE
+        """
+        for worker, stats in sorted(self.stats.items()):
+            rate = stats["bytes"] / stats["seconds"] / 1e6 if stats["seconds"] > 0 else 0.0
+            print(worker + ":", stats["files"], "files,", round(stats["bytes"] / 1e6, 1), "MB,",
+                  round(rate, 2), "MB/s")
+
+    def close(self):
+        """
+        Wait for all the queued downloads to finish then close the connections
+        :return: NONE
+        """
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+
+
+class sampleRegistry:
+    """
+    Collects downloaded samples and registers them in the database in batches rather than one at a time
+    """
+    def __init__(self, db_client, batch_size=100):
+        """
+        :param db_client: The database client
+        :param batch_size: The number of samples collected before they are written to the database
+        """
+        self.dbClient = db_client
+        self.batch_size = batch_size
+        self.batch = {}
+        self.registered = 0
+
+    def add(self, sample):
+        """
+        Add a sample to the next batch, writing the batch if it is full
+        :param sample: The sample information
+        :return: NONE
+        """
+        if sample['run_accession'] in self.batch:
+            print("run_accession " + sample['run_accession'] + " already exists, ignored the additional instances")
+            print("Ensure that there are no repeating instances of the same file")
+            return
+        self.batch[sample['run_accession']] = sample
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current batch to the database. Samples that are already registered are left unchanged
+        :return: NONE
+        """
+        if not self.batch:
+            return
+        try:
+            self.dbClient.bulk_upsert(self.batch.values(), "run_accession", "samples", len(self.batch),
+                                      overwrite=False)
+        except errors.BulkWriteError as err:
+            # Another process registering the same sample at the same time is not an error
+            if any(error["code"] != 11000 for error in err.details["writeErrors"]):
+                raise
+        self.registered += len(self.batch)
+        print("Registered", str(self.registered), "Samples in the database")
+        self.batch = {}
+
+
 class retrieveFromTable:
     """
-    Parses the data provided in a json table ino samples that can be downloaded
+    Parses the data provided in a json or tsv table ino samples that can be downloaded
     """
-    def __init__(self, jsonTable, outputDir):
+    def __init__(self, jsonTable, outputDir, downloader_args=None, register_batch_size=100):
         self.data = self.parseTable(jsonTable)
         self.outputDir = "./" + outputDir
+        self.downloader_args = downloader_args if downloader_args is not None else {}
+        self.completed = 0
+        self.failed = 0
         self.dbClient = client.dbClient()
+        self.registry = sampleRegistry(self.dbClient, register_batch_size)
         self.downloadProcess()
         self.dbClient.close()
 
@@ -96,37 +613,75 @@ class retrieveFromTable:
 
     def parseTable(self, jsonTable):
         """
-        Parse the json table into a useable format
-        :param jsonTable:
-        :return:
+        Parse the table into a stream of samples, the table is read as it is consumed so it is never held in memory
+        :param jsonTable: The location of the table or the table contents
+        :return: A generator of the samples
         """
-        try:
-            exists = path.exists(jsonTable)
-            with open(jsonTable, "r") as f:
-                return json.loads(f.read())
-        except:
-            return json.loads(jsonTable)
+        return iter_report(jsonTable)
 
     def downloadProcess(self):
         """
-        Loop thorugh the table and download each file specified
+        Download every file specified in the table using a pool of concurrent downloaders. Samples are read from the
+        table as download slots become free and files recorded as complete in the download manifest are skipped.
+        Samples are entered into the database in batches as their downloads complete
         :return:
         """
-        print("Starting Download Process for " + str(len(self.data)), "Samples")
-        ftp = ftpDownloader()
-        for sample in self.data:
-            path = os.path.join(self.outputDir, sample['run_accession'])
-            if self.checkExists(path):
-                ftp.update_url(sample['fastq_ftp'])
-                ftp.update_output_dir(path)
-                ftp.download()
+        print("Starting Download Process")
+        manifest = downloadManifest(os.path.join(self.outputDir, "download_manifest.json"))
+        downloader = pooledDownloader(**self.downloader_args)
+        # Limit the samples waiting for a worker so the table is only read ahead a little
+        max_pending = self.downloader_args.get("workers", 4) * 4
+        pending = {}
+        skipped = 0
+        try:
+            for sample in self.data:
+                path = os.path.join(self.outputDir, sample['run_accession'])
+                self.checkExists(path)
+                expected_size, expected_md5 = manifest.expected(sample)
+                file_path = os.path.join(path, sample['fastq_ftp'].rsplit('/', 1)[-1])
+                if manifest.is_complete(sample['run_accession'], file_path, expected_size, expected_md5):
+                    skipped += 1
+                    self.insertDB(sample, path)
+                    continue
+                future = downloader.submit(sample['fastq_ftp'], path, expected_size, expected_md5)
+                pending[future] = (sample, path, expected_size, expected_md5)
+                if len(pending) >= max_pending:
+                    self.collectDownloads(pending, manifest, FIRST_COMPLETED)
+            self.collectDownloads(pending, manifest, ALL_COMPLETED)
+        finally:
+            self.registry.flush()
+            manifest.save()
+            downloader.close()
+        print(str(self.completed), "Samples downloaded,", str(skipped), "already downloaded,", str(self.failed),
+              "failed")
+        downloader.report()
+
+    def collectDownloads(self, pending, manifest, return_when):
+        """
+        Wait for queued downloads to finish and enter the completed samples into the database
+        :param pending: The queued downloads and the sample information for each
+        :param manifest: The download manifest to record completed files in
+        :param return_when: Wait for the first download to finish (FIRST_COMPLETED) or all of them (ALL_COMPLETED)
+        :return: NONE
+        """
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            sample, path, expected_size, expected_md5 = pending.pop(future)
+            try:
+                result = future.result()
+            except download_errors as err:
+                self.failed += 1
+                print("Sample", sample['run_accession'], "failed to download:", err)
+                print("Re-run the service to resume the download")
+                continue
+            self.completed += 1
+            manifest.update(sample['run_accession'], result, expected_size, expected_md5)
             self.insertDB(sample, path)
-            print("Sample", str(self.data.index(sample)), "Downloaded")
-        ftp.close()
+            print("Sample", str(self.completed), "Downloaded")
 
     def insertDB(self, sampleData, path):
         """
-        Inserts the information about each sample into the database
+        Prepares the information about each sample and queues it to be entered into the database
         :param sampleData: The data about the sample
         :param path: The path the sample data was stored at
         :return:
@@ -142,15 +697,20 @@ class retrieveFromTable:
                       " or by changing the alias in the provided json file")
         sampleData['file_location'] = path
 
-        if self.dbClient.check_doc_exists({"run_accession": sampleData['run_accession']}, "samples"):
-            print("study_accession " + sampleData['run_accession'] + " already exists, ignored the additional instances")
-            print("Ensure that there are no repeating instances of the same file")
-        else:
-            self.dbClient.insert_one(sampleData, "samples")
+        self.registry.add(sampleData)
 
 
 if __name__ == '__main__':
     ena_json_table = os.getenv('JSON_FILE')
     output_dir = os.getenv('OUTPUT_DIR')
-    table = retrieveFromTable(ena_json_table, output_dir)
-
+    downloader_args = {
+        "workers": int(os.getenv('DOWNLOAD_WORKERS', 4)),
+        "connections_per_host": int(os.getenv('FTP_CONNECTIONS_PER_HOST', 4)),
+        "retries": int(os.getenv('DOWNLOAD_RETRIES', 5)),
+        "backoff": float(os.getenv('DOWNLOAD_BACKOFF', 2.0)),
+        "port": int(os.getenv('FTP_PORT', 21)),
+        "user": os.getenv('FTP_USER', 'anonymous'),
+        "password": os.getenv('FTP_PASSWORD', ''),
+    }
+    register_batch_size = int(os.getenv('REGISTER_BATCH_SIZE', 100))
+    table = retrieveFromTable(ena_json_table, output_dir, downloader_args, register_batch_size)
@@ -1,5 +1,6 @@
-import json
+import logging
 import os
+import time
 
 from pymongoClient import client
 import pandas as pd
@@ -27,16 +28,43 @@ def import_data(file, header=1, nan_val=' ', separator=','):
     # Replace nan values
     df = df.replace(nan_val, np.NaN)
 
-    # Export to json for db entry
-    json_data = df.to_json(orient="records")
+    return records_from_frame(df)
 
-    return json.loads(json_data)
+
+def records_from_frame(df):
+    """
+    Convert a dataframe into database records directly, missing values become None (null in the database)
+    :param df: The metadata dataframe
+    :return: A list of dictionaries, one per row
+    """
+    # Object columns hold python values rather than numpy scalars which the database driver cannot encode
+    df = df.astype(object).where(pd.notnull(df), None)
+    return df.to_dict(orient="records")
+
+
+def bulk_ingest(records, db_client, batch_size=1000):
+    """
+    Write the metadata records to the database in batches, each record is upserted on its sample id
+    :param records: The metadata records
+    :param db_client: The database client
+    :param batch_size: The number of records written in each batch
+    :return: The number of records written
+    """
+    keyed = [record for record in records if record.get("sample") is not None]
+    if len(keyed) != len(records):
+        logging.warning(str(len(records) - len(keyed)) + " metadata rows have no sample id and were not ingested")
+
+    start = time.time()
+    written = db_client.bulk_upsert(keyed, "sample", "metadata", batch_size)
+    elapsed = max(time.time() - start, 1e-9)
+    print("Ingested", written, "metadata rows in", round(elapsed, 2), "seconds (" + str(int(written / elapsed)),
+          "rows/s)")
+    return written
 
 
 if __name__ == '__main__':
     metadata_file = os.getenv('META_FILE')
     data = import_data(metadata_file, -1, separator="\t")
     db_client = client.dbClient()
-    for item in data:
-        db_client.insert_one(item,"metadata")
-    db_client.close()
\ No newline at end of file
+    bulk_ingest(data, db_client, int(os.getenv('BATCH_SIZE', 1000)))
+    db_client.close()
@@ -0,0 +1,186 @@
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# A registry of the qiime2 artifacts loaded or created by the stages running in this process. When several stages run in
+# one process (the in-process runner of stage_scheduler.py) a stage can use the artifact its parent created without
+# reading it back from disk, and artifacts are written to disk in the background while the next stage runs.
+# When a stage runs on its own it behaves the same as qiime2.Artifact.load and Artifact.save
+
+# Path of each artifact to the artifact
+artifacts = {}
+# Path of each artifact to the future of its background save
+pending = {}
+lock = threading.Lock()
+executor = None
+
+
+def background_saves():
+    """
+    Check if artifacts are saved in the background, set by the ARTIFACT_STORE_ASYNC environment variable
+    :return: True if saves are made in the background
+    """
+    return os.getenv("ARTIFACT_STORE_ASYNC", "off").lower() in ("on", "true", "1")
+
+
+def load(path):
+    """
+    Get the artifact stored at a location, from memory if it has already been loaded or saved in this process
+    :param path: The location of the .qza file
+    :return: The artifact
+    """
+    path = os.path.abspath(path)
+    with lock:
+        if path in artifacts:
+            return artifacts[path]
+
+    # An artifact released from memory may still be being written
+    wait([path])
+    import qiime2
+    artifact = qiime2.Artifact.load(path)
+    with lock:
+        return artifacts.setdefault(path, artifact)
+
+
+def peek(path):
+    """
+    Get an artifact only if it is already in memory
+    :param path: The location of the .qza file
+    :return: The artifact or None
+    """
+    with lock:
+        return artifacts.get(os.path.abspath(path))
+
+
+def save(result, path):
+    """
+    Save an artifact or visualization to a location. Artifacts are kept in memory for later stages, if background
+    saves are enabled the file is written by a worker thread (call flush to wait for it)
+    :param result: The qiime2 artifact or visualization
+    :param path: The location to save it to
+    :return: The location
+    """
+    global executor
+    absolute = os.path.abspath(path)
+    if not background_saves():
+        result.save(path)
+        if hasattr(result, "view"):
+            with lock:
+                artifacts[absolute] = result
+        return path
+
+    with lock:
+        if hasattr(result, "view"):
+            artifacts[absolute] = result
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=int(os.getenv("ARTIFACT_SAVE_WORKERS", 2)))
+            # Everything is written before the process exits
+            atexit.register(flush)
+        previous = pending.get(absolute)
+        pending[absolute] = executor.submit(write, result, absolute, previous)
+    return path
+
+
+def write(result, path, previous=None):
+    """
+    Write a result to disk, after any earlier save to the same location
+    :param result: The qiime2 artifact or visualization
+    :param path: The location to save it to
+    :param previous: The future of an earlier save to the location
+    :return: The location
+    """
+    if previous is not None:
+        previous.result()
+    result.save(path)
+    return path
+
+
+def wait(paths):
+    """
+    Wait for the background saves of some locations to finish
+    :param paths: The locations
+    :return: NONE
+    """
+    with lock:
+        futures = [pending.get(os.path.abspath(path)) for path in paths]
+    for future in futures:
+        if future is not None:
+            future.result()
+
+
+def after_saved(paths, callback):
+    """
+    Run a function once the given locations have been written, straight away if none of them are waiting to be saved
+    :param paths: The locations
+    :param callback: A function taking no arguments
+    :return: NONE
+    """
+    with lock:
+        futures = [pending[os.path.abspath(path)] for path in paths if os.path.abspath(path) in pending]
+        futures = [future for future in futures if not future.done()]
+        if futures:
+            pending[("after_saved", id(callback))] = executor.submit(run_after, futures, callback)
+            return
+    callback()
+
+
+def run_after(futures, callback):
+    """
+    Wait for futures and then run a function, used by after_saved
+    """
+    for future in futures:
+        future.result()
+    return callback()
+
+
+def flush():
+    """
+    Wait for every background save to finish, the first error is raised once all the saves have finished
+    :return: The number of saves waited for
+    """
+    with lock:
+        futures = list(pending.items())
+        pending.clear()
+
+    error = None
+    for key, future in futures:
+        try:
+            future.result()
+        except Exception as err:
+            logging.error("Could not save " + str(key) + ": " + str(err))
+            error = error or err
+    if error is not None:
+        raise error
+    return len(futures)
+
+
+def held():
+    """
+    The locations of the artifacts held in memory
+    :return: The list of locations
+    """
+    with lock:
+        return list(artifacts)
+
+
+def release(paths):
+    """
+    Release artifacts from memory, a later load reads them from disk once they have been saved
+    :param paths: The locations
+    :return: NONE
+    """
+    with lock:
+        for path in paths:
+            artifacts.pop(os.path.abspath(path), None)
+
+
+def clear():
+    """
+    Save everything waiting to be saved and release the artifacts held in memory
+    :return: NONE
+    """
+    flush()
+    with lock:
+        artifacts.clear()
@@ -1,53 +1,264 @@
-from pymongo import MongoClient, errors
+from pymongo import MongoClient, UpdateOne, errors
+import datetime
+import hashlib
+import json
 import os
 import logging
-class dbClient:
+import threading
+import time
+
+# The indexes on the fields every stage queries by, as (field, unique) pairs for each collection
+INDEXES = {
+    "samples": [("run_accession", True), ("sample_alias", False)],
+    "metadata": [("sample", False)],
+    "experiment": [("parent", False), ("stage", False), ("created", False)],
+    "stage_cache": [("last_used", False)],
+    "versions": [("group", False)]
+}
+
+# The collections resolve_samples reads, the time each was last written to is part of the resolver cache key
+RESOLVED_COLLECTIONS = ("samples", "metadata")
+
+# One MongoClient (and so one connection pool) is shared by every dbClient in a process
+shared_client = None
+shared_client_lock = threading.Lock()
+
+
+def connection_settings():
+    """
+    The connection settings for the database, each can be overridden with an environment variable
+    :return: The keyword arguments for the MongoClient
+    """
+    settings = {
+        "host": os.getenv("MONGO_HOST", "database"),
+        "port": int(os.getenv("MONGO_PORT", 27017)),
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 10)),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", 0)),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 3000)),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 3000)),
+        # Connect on first use rather than when the client is created
+        "connect": False
+    }
+    # No socket timeout by default as some aggregations can take a while
+    if os.getenv("MONGO_SOCKET_TIMEOUT_MS"):
+        settings["socketTimeoutMS"] = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS"))
+    return settings
+
+
+def resolver_cache_expired(cache_file):
+    """
+    Check if a cached resolve_samples result is older than RESOLVER_CACHE_MAX_AGE_HOURS (default 24)
+    :param cache_file: The location of the cached result
+    :return: True if the result should not be used
+    """
+    max_age = float(os.getenv("RESOLVER_CACHE_MAX_AGE_HOURS", 24)) * 3600
+    try:
+        return time.time() - os.path.getmtime(cache_file) > max_age
+    except OSError:
+        return True
+
+
+class dbClient(object):
+    # Indexes only need to be checked once per process
+    indexes_ensured = False
 
     def __init__(self):
         """
         A client that contains a number of shared features for interacting with the datbase architecture of the system
         This class provides a number of commonly used feeatures that are needed to
         retrieve and store results from previous experiments
+        The connection is only made when the database is first used
+        """
+        # Results of get_related_stage for this process, experiments are never modified once created
+        self.related_stage_memo = {}
+
+    @property
+    def client(self):
         """
-        self.client = self.start_connection()
-        self.database = self.client["metagenomic"]
+        The MongoClient shared by the process, connecting to the database if needed
+        """
+        return self.start_connection()
+
+    @property
+    def database(self):
+        """
+        The metagenomic database (or the MONGO_DATABASE database), the declared indexes are checked the first time it
+        is used
+        """
+        database = self.client[os.getenv("MONGO_DATABASE", "metagenomic")]
+        if not dbClient.indexes_ensured:
+            dbClient.indexes_ensured = True
+            self.ensure_indexes()
+        return database
 
     def start_connection(self):
         """
-        Create a connection between the current container and the mongo DB datbase
+        Create (once per process) a pooled connection between the current container and the mongo DB datbase. The
+        database is pinged when the connection is created so a missing database fails fast rather than on a query
         :return: The client connection
         """
-        try:
-            # try to instantiate a client instance
-            client = MongoClient(
-                host='database',
-                port=27017,
-                serverSelectionTimeoutMS=3000,  # 3 second timeout
-            )
-            return client
-        except errors.ServerSelectionTimeoutError as err:
-            # catch pymongo.errors.ServerSelectionTimeoutError
-            print("pymongo ERROR:", err)
+        global shared_client
+        with shared_client_lock:
+            if shared_client is None:
+                settings = connection_settings()
+                client = MongoClient(**settings)
+                try:
+                    self.health_check(client)
+                except errors.PyMongoError as err:
+                    logging.error("Could not connect to the database at " + settings["host"] + ":" +
+                                  str(settings["port"]) + " - " + str(err))
+                    client.close()
+                    raise
+                shared_client = client
+            return shared_client
 
-    def insert_one(self, data, collection):
+    def health_check(self, client=None):
+        """
+        Check the database is reachable by sending a ping, this also opens the first pooled connection
+        :param client: The client to check, defaults to the shared client
+        :return: The round trip time of the ping in seconds
+        """
+        if client is None:
+            client = self.client
+        start = time.time()
+        client.admin.command("ping")
+        return time.time() - start
+
+    def insert_one(self, data, collection, key=None):
         """
         Insert a single json data object into the database at the specified colletion
         :param data: The json data object
         :param collection: The name of the collection to enter the object into
+        :param key: The field used to match an existing object, if not given the whole object is matched
         :return: NONE
         """
+        if key is not None:
+            self.upsert_one(data, key, collection)
+            return
         coll = self.database[collection]
-        coll.update(data, data, upsert=True);
+        coll.replace_one(data, data, upsert=True)
+        self.mark_updated(collection)
 
-    def insert_many(self, data, collection):
+    def upsert_one(self, data, key, collection):
         """
-        Insert multiple objects into the specified collection
+        Insert or update a single json data object matched on a single (indexed) key field
         :param data: The json data object
+        :param key: The field used to match an existing object
         :param collection: The name of the collection to enter the object into
         :return: NONE
         """
         coll = self.database[collection]
-        coll.update_many(data, data, upsert=True)
+        coll.update_one({key: data[key]}, {"$set": data}, upsert=True)
+        self.mark_updated(collection)
+
+    def insert_many(self, data, collection, key=None):
+        """
+        Insert multiple objects into the specified collection
+        :param data: The json data objects
+        :param collection: The name of the collection to enter the object into
+        :param key: The field used to match existing objects, if not given the objects are always inserted
+        :return: NONE
+        """
+        if key is not None:
+            self.bulk_upsert(data, key, collection)
+            return
+        coll = self.database[collection]
+        coll.insert_many(list(data), ordered=False)
+        self.mark_updated(collection)
+
+    def bulk_upsert(self, data, key, collection, batch_size=1000, overwrite=True):
+        """
+        Upsert many objects into the specified collection using batched bulk writes. Each object is matched on a
+        single key field rather than the whole document
+        :param data: An iterable of json data objects
+        :param key: The field used to match existing objects
+        :param collection: The name of the collection to enter the objects into
+        :param batch_size: The number of objects sent to the database in each write
+        :param overwrite: If False existing objects are left unchanged and only new objects are inserted
+        :return: The number of objects written
+        """
+        coll = self.database[collection]
+        operator = "$set" if overwrite else "$setOnInsert"
+        written = 0
+        batch = []
+        for item in data:
+            batch.append(UpdateOne({key: item[key]}, {operator: item}, upsert=True))
+            if len(batch) >= batch_size:
+                coll.bulk_write(batch, ordered=False)
+                written += len(batch)
+                batch = []
+        if batch:
+            coll.bulk_write(batch, ordered=False)
+            written += len(batch)
+        if written:
+            self.mark_updated(collection)
+        return written
+
+    def mark_updated(self, collection):
+        """
+        Record the time a collection read by resolve_samples was written to, so cached resolved samples from before
+        the write are no longer used. Other collections are not tracked
+        :param collection: The name of the collection that was written to
+        :return: NONE
+        """
+        if collection not in RESOLVED_COLLECTIONS:
+            return
+        self.database["updates"].update_one({"_id": collection}, {"$set": {"updated": datetime.datetime.utcnow()}},
+                                            upsert=True)
+
+    def data_version(self):
+        """
+        The times the collections read by resolve_samples were last written to
+        :return: A list with the time (as a string, empty if never recorded) for each of RESOLVED_COLLECTIONS
+        """
+        updates = dict((doc["_id"], str(doc.get("updated", "")))
+                       for doc in self.database["updates"].find({"_id": {"$in": list(RESOLVED_COLLECTIONS)}}))
+        return [updates.get(collection, "") for collection in RESOLVED_COLLECTIONS]
+
+    def ensure_indexes(self):
+        """
+        Create the indexes declared in INDEXES. A failure (such as duplicate values in a unique field) is logged rather
+        than stopping the service
+        :return: NONE
+        """
+        for collection, fields in INDEXES.items():
+            for key, unique in fields:
+                try:
+                    self.ensure_index(collection, key, unique)
+                except errors.OperationFailure as err:
+                    logging.warning("Could not create index on " + collection + "." + key + ": " + str(err))
+
+    def ensure_index(self, collection, key, unique=False):
+        """
+        Create an ascending index on a field of a collection if it does not already exist
+        :param collection: The name of the collection
+        :param key: The field to index
+        :param unique: If True the field must be unique across the collection
+        :return: The name of the index
+        """
+        coll = self.database[collection]
+        return coll.create_index(key, unique=unique)
+
+    def claim_version(self, group, owner, start=1):
+        """
+        Claim the next version number of a group (such as the models trained on one experiment). The id of each claim
+        is made of the group and the version so the same version can never be claimed twice, if another service claims
+        the version first the next version is tried
+        :param group: The name of the group being versioned
+        :param owner: The id of the experiment claiming the version
+        :param start: The lowest version that can be claimed
+        :return: The version claimed
+        """
+        coll = self.database["versions"]
+        latest = coll.find_one({"group": group}, sort=[("version", -1)])
+        version = max(start, latest["version"] + 1 if latest is not None else 1)
+        while True:
+            try:
+                coll.insert_one({"_id": group + ":v" + str(version), "group": group, "version": version,
+                                 "owner": owner})
+                return version
+            except errors.DuplicateKeyError:
+                version += 1
 
     def query(self, query, collection):
         """
@@ -60,6 +271,18 @@ class dbClient:
         docs = coll.find(query)
         return docs
 
+    def get_many(self, key, values, collection, return_fields=None):
+        """
+        Get all the objects whose key field matches one of the values using a single query
+        :param key: The field to match
+        :param values: The values of the field to return objects for
+        :param collection: The collection to query
+        :param return_fields: The attributes of the objects to return (dict), all attributes if not given
+        :return: A cursor of the matching objects
+        """
+        coll = self.database[collection]
+        return coll.find({key: {"$in": list(values)}}, return_fields)
+
     def check_doc_exists(self, query, collection):
         """
         Checks if an object of the given specification exists in the specified collection
@@ -75,11 +298,25 @@ class dbClient:
 
     def new_experiment(self, json_object):
         """
-        Enter a new experiment object into the database
+        Enter a new experiment object into the database. The ids of all the experiments above it in the experiment
+        tree are stored with it (nearest first) so its lineage can be read without walking the tree, with the time it
+        was created so the latest experiment can be found
         :param json_object: The experiment json object
         :return: NONE
         """
         coll = self.database["experiment"]
+        parent_id = json_object.get("parent")
+        if "ancestors" not in json_object:
+            ancestors = []
+            if parent_id is not None:
+                parent = coll.find_one({"_id": parent_id})
+                lineage = self.get_lineage(parent) if parent is not None else [parent_id]
+                for ancestor in lineage:
+                    if ancestor != json_object["_id"] and ancestor not in ancestors:
+                        ancestors.append(ancestor)
+            json_object["ancestors"] = ancestors
+        if "created" not in json_object:
+            json_object["created"] = datetime.datetime.utcnow()
         coll.insert_one(json_object)
 
     def get_one(self, query, collection):
@@ -106,66 +343,206 @@ class dbClient:
         docs = coll.find_one(query, return_fields)
         return docs
 
-    def post_order_traversal(self, node, visited):
+    def resolve_samples(self, run_accessions, fields=None, cache_dir=None):
         """
-        A post order tree traversal method for searching the service tree
-        Will return all the children between the current node and a leaf that havent been visited
-        :param node: The current node being visited
-        :param visited:
-        :return: The children of the current node that haven't already been visited
+        Join a list of samples (run accessions) to their sample alias and metadata using a single aggregation rather
+        than two queries per sample. The result can be cached on disk, keyed by the set of samples and the time the
+        samples and metadata were last written to (see mark_updated), so other stages using the same samples do not
+        need to query the database again. Cached results older than RESOLVER_CACHE_MAX_AGE_HOURS (default 24) are not
+        used, this covers changes made to the database without the dbClient
+        :param run_accessions: The run accessions of the samples
+        :param fields: The metadata fields to return, all the fields if not given
+        :param cache_dir: Directory for the cached results, defaults to the RESOLVER_CACHE_DIR environment variable
+        (no caching if neither is set)
+        :return: A dictionary of run accession to {"sample_alias": alias, "metadata": metadata or None}, samples that
+        are not in the database are not included
         """
-        coll = self.database["experiment"]
-        visited.append(node["_id"])
-        # All the chilren of the current node
-        current_children = [i for i in coll.find({"parent": node["_id"]})]
-
-        # Will get all the children of the current children that havent already been visited
-        if len(current_children) > 0:
-            for child in current_children:
-                if child["_id"] not in visited:
-                    return current_children + self.post_order_traversal(child, visited)
+        run_accessions = sorted(set(run_accessions))
+        cache_file = self.resolver_cache_file(run_accessions, cache_dir)
+
+        if cache_file is not None and os.path.exists(cache_file) and not resolver_cache_expired(cache_file):
+            with open(cache_file, "r") as f:
+                result = json.load(f)
         else:
-            return []
+            coll = self.database["samples"]
+            joined = coll.aggregate([
+                {"$match": {"run_accession": {"$in": run_accessions}}},
+                {"$project": {"_id": 0, "run_accession": 1, "sample_alias": 1}},
+                {"$lookup": {"from": "metadata", "localField": "sample_alias", "foreignField": "sample",
+                             "as": "metadata"}}
+            ])
+            result = {}
+            for sample in joined:
+                metadata = None
+                if sample["metadata"]:
+                    metadata = sample["metadata"][0]
+                    metadata.pop("_id", None)
+                result[sample["run_accession"]] = {"sample_alias": sample.get("sample_alias"), "metadata": metadata}
+            self.cache_resolved_samples(result, run_accessions, cache_dir)
 
-    def get_specified_parent_stage(self, target_stage, experiments, visited):
+        if fields:
+            for sample in result.values():
+                if sample["metadata"] is not None:
+                    sample["metadata"] = dict((field, sample["metadata"].get(field)) for field in fields)
+        return result
+
+    def iterate_samples(self, criteria, batch_size=1000):
+        """
+        Stream the samples that satisfy a query joined to their metadata, using one aggregation cursor rather than
+        a query per sample
+        :param criteria: A mongodb query for the samples collection
+        :param batch_size: The number of samples fetched from the database at a time
+        :return: A generator of {"run_accession", "file_location", "sample_alias", "metadata": metadata or None}
+        """
+        coll = self.database["samples"]
+        joined = coll.aggregate([
+            {"$match": criteria},
+            {"$project": {"_id": 0, "run_accession": 1, "file_location": 1, "sample_alias": 1}},
+            {"$lookup": {"from": "metadata", "localField": "sample_alias", "foreignField": "sample",
+                         "as": "metadata"}}
+        ], allowDiskUse=True, batchSize=batch_size)
+        for sample in joined:
+            metadata = None
+            if sample["metadata"]:
+                metadata = sample["metadata"][0]
+                metadata.pop("_id", None)
+            sample["metadata"] = metadata
+            yield sample
+
+    def cache_resolved_samples(self, resolved, run_accessions=None, cache_dir=None):
+        """
+        Store resolved samples in the on disk cache, this allows a stage that selects a subset of the samples it
+        resolved to pass that subset on to the next stage
+        :param resolved: The result of resolve_samples (with all the metadata fields)
+        :param run_accessions: The samples the result is for, defaults to the samples in the result
+        :param cache_dir: Directory for the cached results, defaults to the RESOLVER_CACHE_DIR environment variable
+        :return: NONE
+        """
+        if run_accessions is None:
+            run_accessions = resolved.keys()
+        cache_file = self.resolver_cache_file(run_accessions, cache_dir)
+        if cache_file is None:
+            return
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Remove the expired results, including those keyed on an earlier version of the samples or metadata
+        for name in os.listdir(cache_dir):
+            if name.endswith(".json") and resolver_cache_expired(os.path.join(cache_dir, name)):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump(resolved, f)
+        os.rename(cache_file + ".tmp", cache_file)
+
+    def resolver_cache_file(self, run_accessions, cache_dir=None):
         """
-        A tree search that searches through all the services until it finds the services with the same type as the
-        target stage. This will search every node that is operated before the current stage by using post order tree
-        traversal.
-        Does not deal with an experiment not existing as it assumed that this will always be the case. This is because
-        the initial experiment passed is always the first parent of the current experiment which is checked for existence
-        in each docker image. This means that all the
+        The location of the cached resolved samples for a set of samples, the name changes when the samples or
+        metadata collections are written to
+        :param run_accessions: The run accessions of the samples
+        :param cache_dir: Directory for the cached results, defaults to the RESOLVER_CACHE_DIR environment variable
+        :return: The file location or None if caching is not enabled
+        """
+        if cache_dir is None:
+            cache_dir = os.getenv("RESOLVER_CACHE_DIR")
+        if not cache_dir:
+            return None
+        key = json.dumps([sorted(set(run_accessions)), self.data_version()])
+        return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get_lineage(self, experiment):
+        """
+        Get the ids of an experiment and every experiment above it in the experiment tree, nearest first. Experiments
+        created before the ancestors were stored are looked up with a single $graphLookup
+        :param experiment: The experiment
+        :return: The list of experiment ids
+        """
+        if "ancestors" in experiment:
+            return [experiment["_id"]] + list(experiment["ancestors"])
+
+        coll = self.database["experiment"]
+        found = list(coll.aggregate([
+            {"$match": {"_id": experiment["_id"]}},
+            {"$graphLookup": {"from": "experiment", "startWith": "$parent", "connectFromField": "parent",
+                              "connectToField": "_id", "as": "lineage", "depthField": "depth"}},
+            {"$project": {"lineage._id": 1, "lineage.depth": 1}}
+        ]))
+        lineage = sorted(found[0]["lineage"], key=lambda item: item["depth"]) if found else []
+        return [experiment["_id"]] + [item["_id"] for item in lineage if item["_id"] != experiment["_id"]]
+
+    def get_related_stage(self, target_stage, experiment):
+        """
+        Find the experiment of the target stage that is most closely related to the given experiment. This is the
+        target stage experiment that shares the nearest ancestor with it, so it may be an ancestor itself or on a
+        neighbouring branch of the experiment tree (such as the metadata or the phylogenetic tree).
+        All the candidates are found in one $graphLookup aggregation and the results are memoised for the process
         :param target_stage: The stage that the returned value must be a part of
-        :param experiments: The experiments to search through
-        :param visited: The experiments that have already been visited
-        :return:
+        :param experiment: The experiment to start the search from
+        :return: The related experiment or None if there isn't one
         """
+        memo_key = (target_stage, experiment["_id"])
+        if memo_key in self.related_stage_memo:
+            return self.related_stage_memo[memo_key]
+
+        lineage = self.get_lineage(experiment)
         coll = self.database["experiment"]
-        parent = coll.find_one({"_id": experiments[0]["_id"]})
-        if parent["stage"] == target_stage:
-            return parent
-        else:
+        candidates = coll.aggregate([
+            {"$match": {"stage": target_stage}},
+            {"$graphLookup": {"from": "experiment", "startWith": "$parent", "connectFromField": "parent",
+                              "connectToField": "_id", "as": "related_lineage"}},
+            {"$match": {"$or": [{"_id": {"$in": lineage}}, {"related_lineage._id": {"$in": lineage}}]}}
+        ])
+
+        best = None
+        best_distance = None
+        for candidate in candidates:
+            related = set([candidate["_id"]] + [item["_id"] for item in candidate.pop("related_lineage")])
+            # The distance is how far up the lineage the first shared experiment is
+            distance = next(i for i, exp_id in enumerate(lineage) if exp_id in related)
+            if best is None or distance < best_distance:
+                best, best_distance = candidate, distance
 
-            visited.append(parent["_id"])
-            children = coll.find({"parent": parent["_id"]})
-            # Will get all the nodes that are connected to the children of the current node
-            for child in children:
-                if child["_id"] not in visited:
-                    all_children = [child]
-                    child_return = self.post_order_traversal(child, visited)
-                    if child_return is not None:
-                        # Adds all the childs children to the list
-                        all_children.extend(child_return)
-                    experiments.extend(all_children)
-
-            current_exp_parent = coll.find_one({"_id": experiments[0]["parent"]})
-            if current_exp_parent["_id"] not in visited:
-                experiments.append(current_exp_parent)
-            experiments.pop(0)
-            if not experiments:
-                return None
-
-            return self.get_specified_parent_stage(target_stage, experiments, visited)
+        self.related_stage_memo[memo_key] = best
+        return best
+
+    def get_specified_parent_stage(self, target_stage, experiments, visited):
+        """
+        Kept for compatibility, use get_related_stage
+        :param target_stage: The stage that the returned value must be a part of
+        :param experiments: A list containing the experiment to start the search from
+        :param visited: Unused
+        :return: The related experiment or None if there isn't one
+        """
+        return self.get_related_stage(target_stage, experiments[0])
+
+    def get_incremental_base(self, stage, parent, match=None):
+        """
+        Find the experiment an incremental run of a stage builds on. When the parent experiment only processed the
+        samples that changed since its base experiment (it has a sample_delta), the base of this stage is the latest
+        experiment of this stage whose parent is that base (experiments created before the creation time was stored
+        are only used if no later experiment exists). If the output of the parent only holds the changed samples
+        (its sample_delta is partial) the stage can't process every sample instead, so a missing base is an error
+        :param stage: The stage being run
+        :param parent: The parent experiment
+        :param match: Extra conditions the base must meet, such as the parameters that change the result of the stage
+        :return: The base experiment or None if the stage should process every sample
+        """
+        delta = parent.get("sample_delta")
+        if not delta:
+            return None
+        query = {"stage": stage, "parent": delta["base"]}
+        if match:
+            query.update(match)
+        coll = self.database["experiment"]
+        for base in coll.find(query).sort("created", -1).limit(1):
+            return base
+        if delta.get("partial"):
+            raise ValueError("The output of " + parent["_id"] + " only holds the samples changed since " +
+                             delta["base"] + " but no " + stage + " experiment was run on " + delta["base"] +
+                             ", run the workflow again without a base experiment to process every sample")
+        return None
 
     def stage_parent_correct(self, current_stage, parent_experiment):
         """
@@ -208,7 +585,11 @@ class dbClient:
 
     def close(self):
         """
-        Close the db connection
+        Close the db connection, the next use of any dbClient in the process will reconnect
         :return: NONE
         """
-        self.client.close()
+        global shared_client
+        with shared_client_lock:
+            if shared_client is not None:
+                shared_client.close()
+                shared_client = None
@@ -0,0 +1,83 @@
+import json
+import numpy as np
+import pandas as pd
+
+# Reads and writes the feature matrix passed from the machine learning data prep service to the machine learning
+# services. The features are saved as a float32 .npy file (the dtype the sklearn trees use) so they can be memory mapped
+# and passed to the estimators without a copy, the sample ids, feature names and labels are saved in a json index file
+# next to it
+
+
+def index_location(matrix_file):
+    """
+    The default location of the index file of a matrix
+    :param matrix_file: The location of the .npy file
+    :return: The location of the index file
+    """
+    return matrix_file[:-4] + ".json" if matrix_file.endswith(".npy") else matrix_file + ".json"
+
+
+def save(df, label_column, matrix_file, index_file=None, csv_file=None, chunk_size=1000):
+    """
+    Save a feature matrix. The matrix is written a block of columns at a time so sparse dataframes are only made dense
+    a block at a time
+    :param df: A dataframe indexed by sample id of the labels and features
+    :param label_column: The column of the labels, every other column is a feature
+    :param matrix_file: The location of the .npy file
+    :param index_file: The location of the index file, next to the matrix file if not given
+    :param csv_file: Also export the dataframe to this csv file in the legacy format (labels first)
+    :param chunk_size: The number of columns made dense at once
+    :return: The location of the matrix and index files
+    """
+    index_file = index_file or index_location(matrix_file)
+    features = df.drop(columns=[label_column])
+
+    matrix = np.lib.format.open_memmap(matrix_file, mode="w+", dtype=np.float32, shape=features.shape)
+    for first in range(0, features.shape[1], chunk_size):
+        matrix[:, first:first + chunk_size] = features.iloc[:, first:first + chunk_size].to_numpy(dtype=np.float32)
+    matrix.flush()
+    del matrix
+
+    with open(index_file, "w") as f:
+        json.dump({
+            "index": [str(sample) for sample in df.index],
+            "columns": [str(column) for column in features.columns],
+            "label_column": label_column,
+            "labels": df[label_column].tolist()
+        }, f)
+
+    if csv_file is not None:
+        pd.concat([df[label_column], features], axis=1).to_csv(csv_file, sep=',')
+    return matrix_file, index_file
+
+
+def load(matrix_file, index_file=None, mmap=True):
+    """
+    Load a feature matrix, csv files written by older versions of the data prep service are also read
+    :param matrix_file: The location of the .npy or .csv file
+    :param index_file: The location of the index file, next to the matrix file if not given
+    :param mmap: Memory map the matrix rather than reading it into memory
+    :return: A dataframe of the features and a series of the labels both indexed by sample id
+    """
+    if matrix_file.endswith(".csv"):
+        dataset = pd.read_csv(matrix_file, sep=',', index_col=0, header=0)
+        return dataset.iloc[:, 1:], dataset.iloc[:, 0]
+
+    with open(index_file or index_location(matrix_file), "r") as f:
+        index = json.load(f)
+
+    matrix = np.load(matrix_file, mmap_mode="r" if mmap else None)
+    samples = pd.Index(index["index"], name="sample-id")
+    features = pd.DataFrame(matrix, index=samples, columns=index["columns"], copy=False)
+    labels = pd.Series(index["labels"], index=samples, name=index["label_column"])
+    return features, labels
+
+
+def values(features):
+    """
+    The features of a loaded matrix as the float32 array the sklearn estimators use. For a matrix saved as float32
+    this is the memory mapped matrix itself, csv files and float64 matrices from older data prep experiments are copied
+    :param features: The features returned by load
+    :return: The float32 array of the features
+    """
+    return features.to_numpy(dtype=np.float32, copy=False)
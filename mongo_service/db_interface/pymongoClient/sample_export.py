@@ -0,0 +1,105 @@
+import shutil
+
+# Writes the qiime2 manifest and metadata files of a selection of samples from one streaming database cursor. Lines
+# are collected and written in chunks so large studies are not written a line at a time
+
+# The value written when a sample has no value for a metadata field
+MISSING = "NaN"
+
+
+def metadata_header(headings):
+    """
+    The header line of a metadata file
+    :param headings: The metadata fields in column order
+    :return: The line
+    """
+    return "sample-id \t" + "".join(heading + "\t" for heading in headings) + "\n"
+
+
+def metadata_row(sample_id, metadata, headings):
+    """
+    A line of a metadata file, missing values are written as NaN
+    :param sample_id: The id of the sample (run accession)
+    :param metadata: The metadata of the sample or None
+    :param headings: The metadata fields in column order
+    :return: The line
+    """
+    if metadata is None:
+        metadata = {}
+    values = [metadata.get(heading) for heading in headings]
+    return sample_id + "\t" + "".join((MISSING if value is None else str(value)) + "\t" for value in values) + "\n"
+
+
+def export_samples(db, criteria, manifest_file, metadata_file, manifest_path, required=None, fields=None,
+                   chunk_size=1000):
+    """
+    Write the manifest and metadata files of the samples that satisfy a query in a single pass over one aggregation
+    cursor joining the samples to their metadata
+    :param db: The dbClient
+    :param criteria: A mongodb query for the samples collection
+    :param manifest_file: The location of the manifest file
+    :param metadata_file: The location of the metadata file
+    :param manifest_path: A function giving the location of the sequences of a sample in the manifest
+    :param required: The metadata fields a sample must have a value for to be exported
+    :param fields: The metadata fields to write in column order, the fields of the first exported sample if not given
+    :param chunk_size: The number of lines written at a time
+    :return: The exported samples (run_accession and file_location)
+    """
+    required = required or []
+    exported = []
+    headings = list(fields) if fields else None
+    manifest_lines = ["sample-id\tabsolute-filepath\n"]
+    metadata_lines = []
+
+    with open(manifest_file, "w") as manifest, open(metadata_file, "w") as metadata_out:
+        for sample in db.iterate_samples(criteria, chunk_size):
+            metadata = sample["metadata"]
+            if metadata is None or any(metadata.get(field) is None for field in required):
+                continue
+
+            if headings is None:
+                headings = [heading for heading in metadata.keys() if heading != "sample"]
+            if not exported:
+                metadata_lines.append(metadata_header(headings))
+
+            manifest_lines.append(sample["run_accession"] + "\t" + manifest_path(sample) + "\n")
+            metadata_lines.append(metadata_row(sample["run_accession"], metadata, headings))
+            exported.append({"run_accession": sample["run_accession"], "file_location": sample["file_location"]})
+
+            if len(manifest_lines) >= chunk_size:
+                manifest.writelines(manifest_lines)
+                metadata_out.writelines(metadata_lines)
+                manifest_lines, metadata_lines = [], []
+
+        if not exported:
+            metadata_lines.append(metadata_header(headings or []))
+        manifest.writelines(manifest_lines)
+        metadata_out.writelines(metadata_lines)
+    return exported
+
+
+def select_metadata(source, destination, fields=None, chunk_size=1000):
+    """
+    Copy a metadata file written by export_samples keeping only some of the fields
+    :param source: The location of the exported metadata file
+    :param destination: The location to write to
+    :param fields: The fields to keep in column order, every field if not given
+    :param chunk_size: The number of lines written at a time
+    :return: NONE
+    """
+    if not fields:
+        shutil.copyfile(source, destination)
+        return
+
+    with open(source, "r") as f, open(destination, "w") as out:
+        columns = f.readline().rstrip("\n").split("\t")[1:]
+        positions = [columns.index(field) if field in columns else None for field in fields]
+        lines = [metadata_header(fields)]
+        for line in f:
+            values = line.rstrip("\n").split("\t")
+            selected = [MISSING if position is None else values[position + 1] for position in positions]
+            lines.append(values[0] + "\t" + "".join(value + "\t" for value in selected) + "\n")
+            if len(lines) >= chunk_size:
+                out.writelines(lines)
+                lines = []
+        out.writelines(lines)
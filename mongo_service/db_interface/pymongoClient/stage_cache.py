@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+import zipfile
+from pymongoClient import artifact_store
+
+# Files are hashed in chunks so large inputs are never read into memory at once
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def artifact_identity(path):
+    """
+    Get an identity for an input of a stage. Qiime2 artifacts (.qza/.qzv) are identified by their UUID, which is the
+    name of the root directory of the archive, any other file or directory is identified by a hash of its content
+    :param path: The location of the input
+    :return: The identity as a string
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+        if names:
+            root = names[0].split("/")[0]
+            try:
+                return "uuid:" + str(uuid.UUID(root))
+            except ValueError:
+                pass
+    return "sha256:" + content_hash(path)
+
+
+def content_hash(path):
+    """
+    Hash the content of a file, or of every file in a directory (including their relative paths)
+    :param path: The location of the file or directory
+    :return: The hex digest
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+                digest.update(content_hash(file_path).encode("utf-8"))
+        return digest.hexdigest()
+
+    with open(path, "rb") as f:
+        chunk = f.read(HASH_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(HASH_CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def flatten(paths):
+    """
+    Flatten the output locations of an experiment (a string or nested lists of strings) into a list
+    :param paths: The output locations
+    :return: The list of locations
+    """
+    if paths is None:
+        return []
+    if isinstance(paths, (list, tuple)):
+        result = []
+        for item in paths:
+            result.extend(flatten(item))
+        return result
+    return [paths]
+
+
+def link_file(source, destination):
+    """
+    Hard link a file to a new location, copying it if it can't be linked (e.g. a different file system)
+    :param source: The existing file
+    :param destination: The new location
+    :return: NONE
+    """
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return
+    directory = os.path.dirname(destination)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class stageCache(object):
+    def __init__(self, db, stage, max_age_days=None, max_size_gb=None):
+        """
+        A cache of the results of a stage, keyed on the stage, the identities of its inputs and its parameters.
+        When a stage is re-run on the same inputs with the same parameters the outputs of the earlier experiment are
+        linked into the new experiment rather than recomputed.
+        Entries are stored in the stage_cache collection, entries not used for max_age_days are evicted, as are the
+        least recently used entries once the cached outputs total more than max_size_gb. The cache can be turned
+        off by setting the STAGE_CACHE environment variable to "off"
+        :param db: The dbClient
+        :param stage: The name of the stage
+        :param max_age_days: Days an unused entry is kept, defaults to STAGE_CACHE_MAX_AGE_DAYS (30)
+        :param max_size_gb: Total size of the cached outputs, defaults to STAGE_CACHE_MAX_SIZE_GB (100)
+        """
+        self.db = db
+        self.stage = stage
+        self.enabled = os.getenv("STAGE_CACHE", "on").lower() not in ("off", "false", "0")
+        if max_age_days is None:
+            max_age_days = float(os.getenv("STAGE_CACHE_MAX_AGE_DAYS", 30))
+        if max_size_gb is None:
+            max_size_gb = float(os.getenv("STAGE_CACHE_MAX_SIZE_GB", 100))
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        # Identities of the inputs already seen by this process
+        self.identities = {}
+
+    def identity(self, path):
+        """
+        The identity of an input, memoised for the process
+        :param path: The location of the input
+        :return: The identity
+        """
+        if path not in self.identities:
+            # Artifacts held in memory may not have been written to disk yet
+            artifact = artifact_store.peek(path)
+            if artifact is not None:
+                self.identities[path] = "uuid:" + str(artifact.uuid)
+            else:
+                self.identities[path] = artifact_identity(path)
+        return self.identities[path]
+
+    def key(self, inputs, parameters):
+        """
+        Create the cache key of a run of the stage
+        :param inputs: The input locations of the stage (a string or nested lists of strings)
+        :param parameters: The parameters of the stage, the order of the keys does not matter
+        :return: The key
+        """
+        description = {
+            "stage": self.stage,
+            "inputs": [self.identity(path) for path in flatten(inputs)],
+            "params": parameters
+        }
+        canonical = json.dumps(description, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def lookup(self, key):
+        """
+        Find the cache entry for a key, entries whose outputs no longer exist are removed
+        :param key: The cache key
+        :return: The entry or None if there isn't one
+        """
+        if not self.enabled:
+            return None
+        coll = self.db.database["stage_cache"]
+        entry = coll.find_one({"_id": key})
+        if entry is None:
+            return None
+        if not all(os.path.exists(path) for path in entry["output"]):
+            logging.warning("Cached outputs of " + entry["experiment"] + " are missing, removing the cache entry")
+            coll.delete_one({"_id": key})
+            return None
+        coll.update_one({"_id": key}, {"$set": {"last_used": time.time()}, "$inc": {"hits": 1}})
+        return entry
+
+    def restore(self, key, outputs):
+        """
+        Link the cached outputs for a key to the output locations of a new experiment
+        :param key: The cache key
+        :param outputs: The output locations of the new experiment (in the same order as when stored)
+        :return: The cache entry if the outputs were restored or None on a cache miss
+        """
+        entry = self.lookup(key)
+        if entry is None or len(entry["output"]) != len(flatten(outputs)):
+            return None
+        artifact_store.wait(entry["output"])
+        for source, destination in zip(entry["output"], flatten(outputs)):
+            link_file(source, destination)
+        print("Reused the outputs of " + entry["experiment"] + " (saved " + str(round(entry["run_time"], 1)) + "s)")
+        return entry
+
+    def store(self, key, exp_id, outputs, run_time):
+        """
+        Add the outputs of an experiment to the cache and evict old entries
+        :param key: The cache key
+        :param exp_id: The id of the experiment that created the outputs
+        :param outputs: The output locations
+        :param run_time: How long the outputs took to compute in seconds
+        :return: NONE
+        """
+        if not self.enabled:
+            return
+        outputs = flatten(outputs)
+        # The size of the outputs is only known once they have been written
+        artifact_store.after_saved(outputs, lambda: self.add_entry(key, exp_id, outputs, run_time))
+
+    def add_entry(self, key, exp_id, outputs, run_time):
+        """
+        Write the cache entry for the outputs of an experiment, used by store once the outputs are on disk
+        :param key: The cache key
+        :param exp_id: The id of the experiment that created the outputs
+        :param outputs: The list of output locations
+        :param run_time: How long the outputs took to compute in seconds
+        :return: NONE
+        """
+        now = time.time()
+        entry = {
+            "_id": key,
+            "stage": self.stage,
+            "experiment": exp_id,
+            "output": outputs,
+            "size": sum(os.path.getsize(path) for path in outputs if os.path.isfile(path)),
+            "run_time": run_time,
+            "created": now,
+            "last_used": now,
+            "hits": 0
+        }
+        self.db.database["stage_cache"].replace_one({"_id": key}, entry, upsert=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove entries not used within the maximum age, then the least recently used entries until the cached outputs
+        are within the maximum size. Only the cache entries are removed, the outputs still belong to their experiments
+        :return: The number of entries removed
+        """
+        coll = self.db.database["stage_cache"]
+        removed = coll.delete_many({"last_used": {"$lt": time.time() - self.max_age}}).deleted_count
+
+        total = 0
+        expired = []
+        for entry in coll.find({}, {"size": 1}).sort("last_used", -1):
+            total += entry.get("size", 0)
+            if total > self.max_size:
+                expired.append(entry["_id"])
+        if expired:
+            removed += coll.delete_many({"_id": {"$in": expired}}).deleted_count
+        return removed
@@ -1,5 +1,5 @@
 import os
-from pymongoClient import client
+from pymongoClient import client, artifact_store
 import logging
 import qiime2
 import json
@@ -7,16 +7,18 @@ import json
 CURRENT_STAGE = "Data_Import"
 
 
-def experiment(exp_id, parent_name, parameters):
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which converts a manifest file into a qiime2 sequences artifact by importing
     each sample data file
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
     if db.check_doc_exists({"_id": exp_id}, "experiment"):
@@ -30,19 +32,32 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
     # Load the manifest file
     manifest = parent["output"]["data"]
 
-    # Create a qiime2 sequences artifact using the metadata
-    single_end_sequences = qiime2.Artifact.import_data('SampleData[SequencesWithQuality]', manifest,
-                                                                  view_type='SingleEndFastqManifestPhred33V2')
+    # In incremental mode only the samples added since the base experiment are imported, the delta is marked partial
+    # so the next stage can't mistake the sequences for every sample
+    base = db.get_incremental_base(CURRENT_STAGE, parent)
+    delta = None
+    if base is not None:
+        delta = {"base": base["_id"], "added": parent["sample_delta"]["added"],
+                 "removed": parent["sample_delta"]["removed"], "partial": True}
+        manifest = parent["sample_delta"]["manifest"]
 
-    single_end_sequences.save(outputs[0])
+    if delta is not None and not delta["added"]:
+        # Nothing to import, the sequences of the base are recorded and the next stage only removes samples
+        outputs[0] = base["output"]["data"]
+    else:
+        # Create a qiime2 sequences artifact using the metadata
+        single_end_sequences = qiime2.Artifact.import_data('SampleData[SequencesWithQuality]', manifest,
+                                                           view_type='SingleEndFastqManifestPhred33V2')
+
+        artifact_store.save(single_end_sequences, outputs[0])
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params":parameters,
@@ -51,18 +66,27 @@ def experiment(exp_id, parent_name, parameters):
             "data": outputs[0]
         }
     }
+    if delta is not None:
+        this_experiment["sample_delta"] = delta
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
+
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
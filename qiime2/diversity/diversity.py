@@ -1,6 +1,6 @@
 import json
 import os
-from pymongoClient import client
+from pymongoClient import client, artifact_store
 import qiime2
 import logging
 from qiime2.plugins import diversity, metadata, feature_table, empress, emperor
@@ -20,11 +20,11 @@ def alpha_diversity(sequences, metadata, metric, out_dirs):
     """
     alpha_diversity = diversity.pipelines.alpha(sequences, metric=metric)
 
-    alpha_diversity.alpha_diversity.save(out_dirs[0])
+    artifact_store.save(alpha_diversity.alpha_diversity, out_dirs[0])
 
     correlation = diversity.visualizers.alpha_group_significance(alpha_diversity.alpha_diversity,
                                                                  metadata)
-    correlation.visualization.save(out_dirs[1])
+    artifact_store.save(correlation.visualization, out_dirs[1])
 
 
 def beta_diversity(distance_matrix, metadata, params, out_dirs):
@@ -40,13 +40,14 @@ def beta_diversity(distance_matrix, metadata, params, out_dirs):
     params["metadata"] = metadata.get_column("dx")
     # Beta diversity with relation to the diagnosis metadata
     dx_beta_diversity = diversity.visualizers.beta_group_significance(**params)
-    dx_beta_diversity.visualization.save(out_dirs[2])
+    artifact_store.save(dx_beta_diversity.visualization, out_dirs[2])
 
 
-def empress_plot(parent_exp, sequence_table, scoring, tree, metadata, params, out_dirs):
+def empress_plot(db, parent_exp, sequence_table, scoring, tree, metadata, params, out_dirs):
     """
     Perfoms a number of stages to generate an empress plot. An empress plot contains a phlogenetic tree, PCoA anlyses,
     A biplot for the PCoA and related data about taxa frequency
+    :param db: The dbClient
     :param parent_exp: The parent experiment
     :param sequence_table: The sequences in table format
     :param scoring: The scoring system to use for the PCoA analyses
@@ -57,8 +58,8 @@ def empress_plot(parent_exp, sequence_table, scoring, tree, metadata, params, ou
     :return: NONE
     """
     # Classification file used in order to convert the UIDs to the taxonomic labels
-    classification_file = db.get_specified_parent_stage("Feature_Classification", [parent_exp], [])["output"]["data"]
-    classification = qiime2.Artifact.load(classification_file)
+    classification_file = db.get_related_stage("Feature_Classification", parent_exp)["output"]["data"]
+    classification = artifact_store.load(classification_file)
 
     relative_sequence = feature_table.methods.relative_frequency(sequence_table)
     # Pcoa biplot used for the empress plot
@@ -74,19 +75,21 @@ def empress_plot(parent_exp, sequence_table, scoring, tree, metadata, params, ou
     # for PCOA positioning
     empress_plot = empress.visualizers.community_plot(**params)
 
-    empress_plot.visualization.save(out_dirs[3])
+    artifact_store.save(empress_plot.visualization, out_dirs[3])
 
 
-def experiment(exp_id, parent_name, parameters):
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which performs a series of diversity anlyses including;
     alpha diversity, beta diversity, PCoA and biplots
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -103,18 +106,18 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
     # Metadata for the samples used in diversity metrics to determine importance
-    metadata_file = db.get_specified_parent_stage("Metadata_Creator", [parent], [])["output"]["data"]
+    metadata_file = db.get_related_stage("Metadata_Creator", parent)["output"]["data"]
     sample_metadata = qiime2.Metadata.load(metadata_file)
 
     # Tree for all the phylogenic diversity metrics
-    phylogenetic_tree_file = db.get_specified_parent_stage("Rooted_Tree", [parent], [])["output"]["data"]
-    phylogenetic_tree = qiime2.Artifact.load(phylogenetic_tree_file)
+    phylogenetic_tree_file = db.get_related_stage("Rooted_Tree", parent)["output"]["data"]
+    phylogenetic_tree = artifact_store.load(phylogenetic_tree_file)
 
     # The UID sequences to perform diversity analysis on
-    sequences = qiime2.Artifact.load(parent["output"]["data"][1])
+    sequences = artifact_store.load(parent["output"]["data"][1])
 
     diversity_metrics = diversity.pipelines.core_metrics_phylogenetic(table=sequences,
                                                                       phylogeny=phylogenetic_tree,
@@ -126,7 +129,7 @@ def experiment(exp_id, parent_name, parameters):
     beta_diversity(diversity_metrics.weighted_unifrac_distance_matrix, sample_metadata, parameters["beta_diversity"].copy(),
                    outputs)
 
-    empress_plot(parent, diversity_metrics.rarefied_table, diversity_metrics.weighted_unifrac_pcoa_results,
+    empress_plot(db, parent, diversity_metrics.rarefied_table, diversity_metrics.weighted_unifrac_pcoa_results,
                  phylogenetic_tree, sample_metadata, parameters["pcoa"].copy(), outputs)
 
     this_experiment = {
@@ -143,17 +146,22 @@ def experiment(exp_id, parent_name, parameters):
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-    # Get the passed parameters
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params_in = json.loads(os.getenv("PARAMS"))
-    np.random.seed(params_in["random_seed"])
-
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
+    parameters = json.loads(environment["PARAMS"])
+    np.random.seed(parameters["random_seed"])
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params_in)
+    experiment(db, experiment_id, environment.get("PARENT"), parameters, environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
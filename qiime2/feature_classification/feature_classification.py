@@ -1,22 +1,214 @@
+import hashlib
 import json
 import os
 import logging
-from pymongoClient import client
+import time
+from pymongoClient import client, stage_cache, artifact_store
 import qiime2
-from qiime2.plugins import feature_classifier, metadata
+from qiime2.plugins import feature_classifier, feature_table, metadata
+import joblib
+import pandas as pd
 
 CURRENT_STAGE = "Feature_Classification"
 
+# The directory of the trained classifiers (mounted from sklearn_classifier in the container)
+CLASSIFIER_DIR = os.getenv("CLASSIFIER_DIR", "/qiime_classifier/classifiers/")
 
-def experiment(exp_id, parent_name, parameters):
+# The classify_sklearn parameters that change the assigned taxonomy, the others only change how it is computed
+RESULT_PARAMETERS = ["confidence", "read_orientation"]
+
+
+def load_classifier(classifier_location):
+    """
+    Load the scikit-learn pipeline of a classifier artifact. The first time a classifier is used the pipeline is
+    extracted from the artifact and stored as an uncompressed joblib file, later runs memory map the arrays of that
+    file rather than unpickling the whole model, so the pages are shared by every process using the classifier
+    :param classifier_location: The location of the classifier .qza
+    :return: The pipeline
+    """
+    from sklearn.pipeline import Pipeline
+
+    cache_dir = os.getenv("CLASSIFIER_CACHE_DIR", os.path.join(CLASSIFIER_DIR, ".cache"))
+    identity = stage_cache.artifact_identity(classifier_location).split(":")[-1]
+    cache_file = os.path.join(cache_dir, os.path.basename(classifier_location)[:-4] + "-" + identity + ".joblib")
+
+    if not os.path.exists(cache_file):
+        start = time.time()
+        pipeline = artifact_store.load(classifier_location).view(Pipeline)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        joblib.dump(pipeline, cache_file + ".tmp")
+        os.replace(cache_file + ".tmp", cache_file)
+        print("Cached the classifier in " + str(round(time.time() - start, 1)) + "s")
+
+    return joblib.load(cache_file, mmap_mode="r")
+
+
+def taxonomy_cache_ids(classifier_key, sequences):
+    """
+    The ids of the taxonomy cache entries of some sequences
+    :param classifier_key: The classifier and the parameters that change its result
+    :param sequences: The sequences (strings)
+    :return: A dictionary of sequence to id
+    """
+    return dict((sequence, hashlib.sha1((classifier_key + ":" + sequence).encode("utf-8")).hexdigest())
+                for sequence in sequences)
+
+
+def classify_novel(novel, classifier_location, classify_params):
+    """
+    Classify the sequences that are not in the taxonomy cache
+    :param novel: A dictionary of sequence to feature id for the sequences to classify
+    :param classifier_location: The location of the classifier .qza
+    :param classify_params: The classify_sklearn parameters (reads_per_batch, n_jobs, confidence etc.)
+    :return: A dictionary of sequence to (taxon, confidence)
+    """
+    from q2_types.feature_data import DNAFASTAFormat
+    from q2_feature_classifier.classifier import classify_sklearn
+
+    reads = DNAFASTAFormat()
+    with open(str(reads), "w") as f:
+        for sequence, feature_id in novel.items():
+            f.write(">" + feature_id + "\n" + sequence + "\n")
+
+    # Batches of reads are classified in parallel by n_jobs processes
+    result = classify_sklearn(reads, load_classifier(classifier_location), **classify_params)
+    return dict((sequence, (result.loc[feature_id, "Taxon"], result.loc[feature_id, "Confidence"]))
+                for sequence, feature_id in novel.items())
+
+
+def seconds_per_sequence(db, classifier_key):
+    """
+    The time classifying a sequence took in the most recent experiment that classified sequences with the classifier
+    :param db: The dbClient
+    :param classifier_key: The classifier and the parameters that change its result
+    :return: The time in seconds or None if the classifier hasn't been used
+    """
+    previous = db.query({"stage": CURRENT_STAGE, "taxonomy_cache.classifier": classifier_key,
+                         "taxonomy_cache.classified": {"$gt": 0}}, "experiment").sort("created", -1).limit(1)
+    for experiment_record in previous:
+        stats = experiment_record["taxonomy_cache"]
+        return stats["classify_time"] / stats["classified"]
+    return None
+
+
+def cached_classification(db, sequences, classifier_name, classifier_location, parameters):
+    """
+    Assign a taxonomy to every feature, the taxonomy of sequences already classified with the same classifier and
+    parameters is read from the taxonomy_cache collection and only the novel sequences are classified
+    :param db: The dbClient
+    :param sequences: The representative sequences artifact
+    :param classifier_name: The name of the classifier
+    :param classifier_location: The location of the classifier .qza
+    :param parameters: The classify_sklearn parameters
+    :return: The taxonomy artifact and the statistics of the cache
+    """
+    from q2_types.feature_data import DNAIterator
+
+    result_params = dict((key, parameters[key]) for key in RESULT_PARAMETERS if key in parameters)
+    classifier_key = classifier_name + ":" + stage_cache.artifact_identity(classifier_location) + ":" + \
+        json.dumps(result_params, sort_keys=True)
+
+    # Feature ids are usually a hash of the sequence, but the sequences are compared to be sure
+    features = dict((read.metadata["id"], str(read)) for read in sequences.view(DNAIterator))
+    cache_ids = taxonomy_cache_ids(classifier_key, set(features.values()))
+
+    taxonomy = {}
+    for entry in db.get_many("_id", cache_ids.values(), "taxonomy_cache", {"sequence": 1, "taxon": 1,
+                                                                           "confidence": 1}):
+        taxonomy[entry["sequence"]] = (entry["taxon"], entry["confidence"])
+    hits = len(taxonomy)
+
+    novel = {}
+    for feature_id, sequence in features.items():
+        if sequence not in taxonomy:
+            novel[sequence] = feature_id
+
+    classify_time = 0.0
+    if novel:
+        start = time.time()
+        classified = classify_novel(novel, classifier_location, parameters)
+        classify_time = time.time() - start
+        taxonomy.update(classified)
+        db.bulk_upsert(({"_id": cache_ids[sequence], "classifier": classifier_key, "sequence": sequence,
+                         "taxon": taxon, "confidence": confidence}
+                        for sequence, (taxon, confidence) in classified.items()), "_id", "taxonomy_cache")
+
+    per_sequence = classify_time / len(novel) if novel else seconds_per_sequence(db, classifier_key)
+    stats = {
+        "classifier": classifier_key,
+        "sequences": len(cache_ids),
+        "hits": hits,
+        "hit_rate": float(hits) / len(cache_ids) if cache_ids else 0.0,
+        "classified": len(novel),
+        "classify_time": classify_time,
+        "time_saved": hits * per_sequence if per_sequence is not None else None
+    }
+    print("Taxonomy cache hit rate " + str(round(stats["hit_rate"] * 100, 1)) + "% (" + str(hits) + " of " +
+          str(len(cache_ids)) + " sequences), classified " + str(len(novel)) + " sequences in " +
+          str(round(classify_time, 1)) + "s" + ("" if stats["time_saved"] is None else
+                                                 ", saved about " + str(round(stats["time_saved"], 1)) + "s"))
+
+    table = pd.DataFrame([[feature_id, taxonomy[sequence][0], taxonomy[sequence][1]]
+                          for feature_id, sequence in features.items()],
+                         columns=["Feature ID", "Taxon", "Confidence"]).set_index("Feature ID")
+    return qiime2.Artifact.import_data("FeatureData[Taxonomy]", table), stats
+
+
+def incremental_classification(db, sequences, base, classifier_name, classifier_location, parameters):
+    """
+    Classify only the features that are not in the taxonomy of the base experiment and merge their taxonomy into it
+    :param db: The dbClient
+    :param sequences: The representative sequences artifact
+    :param base: The base feature classification experiment
+    :param classifier_name: The name of the classifier
+    :param classifier_location: The location of the classifier .qza
+    :param parameters: The classify_sklearn parameters
+    :return: The taxonomy artifact and the statistics of the cache (None if there were no new features)
+    """
+    from q2_types.feature_data import DNAIterator
+
+    base_taxonomy = artifact_store.load(base["output"]["data"])
+    known = set(base_taxonomy.view(qiime2.Metadata).to_dataframe().index)
+    new_features = [read.metadata["id"] for read in sequences.view(DNAIterator) if read.metadata["id"] not in known]
+    print(str(len(new_features)) + " features are not in the taxonomy of " + base["_id"])
+    if not new_features:
+        return base_taxonomy, None
+
+    new_metadata = qiime2.Metadata(pd.DataFrame(index=pd.Index(new_features, name="feature-id")))
+    new_sequences = feature_table.methods.filter_seqs(sequences, metadata=new_metadata).filtered_data
+    new_taxonomy, stats = cached_classification(db, new_sequences, classifier_name, classifier_location, parameters)
+    return feature_table.methods.merge_taxa(data=[base_taxonomy, new_taxonomy]).merged_data, stats
+
+
+def base_match(parameters):
+    """
+    The conditions an incremental base must meet for its taxonomy to be reused, it must have been classified with the
+    same classifier and the same parameters that change the assigned taxonomy
+    :param parameters: The parameters of the experiment
+    :return: The query on the parameters of the base experiment
+    """
+    match = {"params.classifier": parameters["classifier"]}
+    for key in RESULT_PARAMETERS:
+        field = "params.classify_sklearn." + key
+        if key in parameters["classify_sklearn"]:
+            match[field] = parameters["classify_sklearn"][key]
+        else:
+            match[field] = {"$exists": False}
+    return match
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which gives a taxonomy to the ASV's determined during quality analyses
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -33,30 +225,51 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
+
+    classifier_location = os.path.join(CLASSIFIER_DIR, parameters["classifier"] + ".qza")
+
+    # In incremental mode only the features that are not in the base experiment are classified, every feature is
+    # classified if no base used the same classifier and parameters
+    base = db.get_incremental_base(CURRENT_STAGE, parent, base_match(parameters))
+    delta = None
+    inputs = [parent["output"]["data"][1], classifier_location]
+    if base is not None:
+        delta = {"base": base["_id"], "added": parent["sample_delta"]["added"],
+                 "removed": parent["sample_delta"]["removed"]}
+        inputs.append(base["output"]["data"])
+
+    # Reuse the outputs of an earlier experiment with the same sequences, classifier and parameters
+    cache = stage_cache.stageCache(db, CURRENT_STAGE)
+    cache_key = cache.key(inputs, parameters)
+    cached = cache.restore(cache_key, outputs)
 
-    # Loads the sequences and a classifier reference database model
-    sequences = qiime2.Artifact.load(parent["output"]["data"][1])
+    taxonomy_stats = None
+    if cached is None:
+        start = time.time()
 
-    gg_classifier = qiime2.Artifact.load("/qiime_classifier/classifiers/" + params["classifier"] + ".qza")
+        # Loads the sequences, the classifier is only loaded if some of the sequences have not been classified before
+        sequences = artifact_store.load(parent["output"]["data"][1])
 
-    # Prepare the parameters for the classification process
-    classify_params = parameters["classify_sklearn"].copy()
-    classify_params["reads"] = sequences
-    classify_params["classifier"] = gg_classifier
+        # Classification runner
+        if base is not None:
+            classification, taxonomy_stats = incremental_classification(
+                db, sequences, base, parameters["classifier"], classifier_location, parameters["classify_sklearn"])
+        else:
+            classification, taxonomy_stats = cached_classification(
+                db, sequences, parameters["classifier"], classifier_location, parameters["classify_sklearn"])
 
-    # Classification runner
-    taxonomy = feature_classifier.methods.classify_sklearn(**classify_params)
+        # Artifact save
+        artifact_store.save(classification, outputs[0])
 
-    # Artifact save
-    taxonomy.classification.save(outputs[0])
+        # Visual save
+        taxonomy_classification = metadata.visualizers.tabulate(classification.view(qiime2.Metadata))
+        artifact_store.save(taxonomy_classification.visualization, outputs[1])
 
-    # Visual save
-    taxonomy_classification = metadata.visualizers.tabulate(taxonomy.classification.view(qiime2.Metadata))
-    taxonomy_classification.visualization.save(outputs[1])
+        cache.store(cache_key, exp_id, outputs, time.time() - start)
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params":parameters,
@@ -65,19 +278,31 @@ def experiment(exp_id, parent_name, parameters):
             "visuals": outputs[1]
         }
     }
+    if cached is not None:
+        this_experiment["cached_from"] = cached["experiment"]
+    elif taxonomy_stats is not None:
+        this_experiment["taxonomy_cache"] = taxonomy_stats
+    if delta is not None:
+        this_experiment["sample_delta"] = delta
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
@@ -1,41 +1,103 @@
-import io
 import os
 import logging
 import json
+import numpy as np
 import pandas as pd
-from pymongoClient import client
+from pymongoClient import client, artifact_store
 import qiime2
-from qiime2.plugins import taxa, feature_table
 import biom
 
 
 CURRENT_STAGE = "Freq_To_Biom"
 
+# Samples with these diagnoses (no metadata or a blank diagnosis) are left out of the table
+EXCLUDED_DIAGNOSES = [" ", "inconclusive"]
 
-def new_headers(df, metadata):
+# The sparse formats the table can also be saved in
+SPARSE_FORMATS = ["npz", "h5"]
+
+
+def sample_diagnoses(db, sample_ids):
+    """
+    Get the diagnosis of every sample, all the samples are resolved in one query
+    :param db: The dbClient
+    :param sample_ids: The sample ids (run accessions)
+    :return: A pandas series of the diagnosis of each sample in the same order, "inconclusive" if a sample has no
+    metadata
+    """
+    resolved = db.resolve_samples(sample_ids, ["dx"])
+    conditions = [resolved.get(sample_id, {}).get("metadata") for sample_id in sample_ids]
+    # Capture when the condition is not included in the metadata
+    return pd.Series(["inconclusive" if condition is None else condition["dx"] for condition in conditions],
+                     index=sample_ids, dtype=object)
+
+
+def write_lefse_table(output_loc, matrix, observation_ids, sample_ids, diagnoses, chunk_size=1000):
     """
-    Creates a set of overview headers according to the requirements of Qiime2 and Lefse biom format
-    :param df: The dataframe to use for new headers
-    :param metadata: The diagnosis metadata to add
-    :return: The new headers
+    Write the table in the format used by lefse, a #Diagnosis row of the condition of each sample and a #OTU id row of
+    the sample ids followed by a row for each observation. Rows are made dense and written a chunk at a time
+    :param output_loc: The location of the tsv file
+    :param matrix: The scipy sparse matrix (observations x samples)
+    :param observation_ids: The ids of the rows
+    :param sample_ids: The ids of the columns
+    :param diagnoses: The diagnosis of each column
+    :param chunk_size: The number of rows made dense at once
+    :return: NONE
     """
-    result = [('#Diagnosis', '#OTU id')]
-    current = df.columns
-    for i in current[1:]:
-        result.append((metadata[i], i))
-    return result
+    matrix = matrix.tocsr()
+    with open(output_loc, "w") as f:
+        f.write("#Diagnosis\t" + "\t".join("" if dx is None else str(dx) for dx in diagnoses) + "\n")
+        f.write("#OTU id\t" + "\t".join(sample_ids) + "\n")
+        for first in range(0, matrix.shape[0], chunk_size):
+            rows = matrix[first:first + chunk_size].toarray()
+            f.writelines(observation_ids[first + i] + "\t" + "\t".join(map(repr, row.tolist())) + "\n"
+                         for i, row in enumerate(rows))
+
 
-def experiment(exp_id, parent_name, parameters):
+def write_sparse_table(output_loc, table, diagnoses, sparse_format):
+    """
+    Write the table in a sparse binary format alongside the tsv
+    :param output_loc: The location of the file without an extension
+    :param table: The biom table of the included samples
+    :param diagnoses: The diagnosis of each sample
+    :param sparse_format: "npz" for a numpy archive of the csr matrix and ids or "h5" for a biom hdf5 file
+    :return: The location of the file
+    """
+    if sparse_format not in SPARSE_FORMATS:
+        raise ValueError("Unsupported sparse_format " + repr(sparse_format) + ", expected one of " +
+                         ", ".join(SPARSE_FORMATS))
+
+    if sparse_format == "h5":
+        from biom.util import biom_open
+        table = table.copy()
+        table.add_metadata(dict((sample_id, {"dx": dx}) for sample_id, dx in zip(table.ids("sample"), diagnoses)),
+                           axis="sample")
+        output_loc = output_loc + ".biom"
+        with biom_open(output_loc, "w") as f:
+            table.to_hdf5(f, "Freq_To_Biom")
+        return output_loc
+
+    matrix = table.matrix_data.tocsr()
+    output_loc = output_loc + ".npz"
+    np.savez_compressed(output_loc, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                        shape=matrix.shape, observation_ids=table.ids("observation"), sample_ids=table.ids("sample"),
+                        diagnosis=np.array(["" if dx is None else str(dx) for dx in diagnoses]))
+    return output_loc
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which converts the frequency tables from the frequency table service into
     csv/biom format. This also adds the condition information for each sample. This can then be used to import into
     lefse and machine learning services without having to reference the metadata file directly.
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -52,62 +114,57 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
-
-    taxa_table = qiime2.Artifact.load(parent["output"]["data"][0])
-
-    otu_freq = feature_table.methods.relative_frequency(taxa_table)
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
-    # Convert the table into a dataframe (pandas)
-    biom_table = otu_freq.relative_frequency_table.view(biom.Table)
-    df = pd.read_csv(io.StringIO(biom_table.to_tsv()), sep='\t', header=1)
-    samples = df.columns.values.tolist()[1:]
+    taxa_table = artifact_store.load(parent["output"]["data"][0])
 
-    meta_data = {}
-    # Add the condition status directly to the table information
-    for id in samples:
-        metadata_id = db.get_one_selective({"run_accession": id}, {"sample_alias": 1, "_id": 0}, "samples")[
-            "sample_alias"]
-        condition = db.get_one_selective({"sample": metadata_id}, {"dx": 1, "_id": 0}, "metadata")
-        # Capture when the condition is not included in the metadata
-        if condition is not None:
-            meta_data[id] = condition["dx"]
-        else:
-            meta_data[id] = "inconclusive"
+    # The relative frequency is computed on the sparse biom table
+    biom_table = taxa_table.view(biom.Table).norm(axis="sample", inplace=False)
+    sample_ids = list(biom_table.ids("sample"))
 
-    df.columns = pd.MultiIndex.from_tuples(new_headers(df, meta_data))
+    # Add the condition status directly to the table information, samples without a condition are left out
+    diagnoses = sample_diagnoses(db, sample_ids)
+    included = ~diagnoses.isin(EXCLUDED_DIAGNOSES)
+    biom_table = biom_table.filter(diagnoses.index[included], axis="sample", inplace=False)
+    diagnoses = diagnoses[included].tolist()
 
-    df = df.drop(' ', axis=1, level=0)
+    write_lefse_table(outputs[0], biom_table.matrix_data, list(biom_table.ids("observation")),
+                      list(biom_table.ids("sample")), diagnoses)
 
-    df = df.drop('inconclusive', axis=1, level=0)
-
-    # Save the dataframe to a .csv file
-    df.to_csv(outputs[0], sep='\t', index=False)
+    output = {
+        "data": outputs[0],
+        "visuals": None
+    }
+    if parameters.get("sparse_format"):
+        output["sparse"] = write_sparse_table(os.path.splitext(outputs[0])[0], biom_table, diagnoses,
+                                              parameters["sparse_format"])
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params":parameters,
-        "output": {
-            "data": outputs[0],
-            "visuals": None
-        }
+        "output": output
     }
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    # Get the passed parameters
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
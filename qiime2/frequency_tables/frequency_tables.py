@@ -1,24 +1,67 @@
 import json
 import os
-from pymongoClient import client
+from pymongoClient import client, artifact_store
 import qiime2
 from qiime2.plugins import taxa, feature_table
+import pandas as pd
 import logging
 
 CURRENT_STAGE = "Frequency_Tables"
 
 
-def experiment(exp_id, parent_name, parameters):
+def filter_table(table, sample_ids, exclude=False):
+    """
+    Keep (or remove) some samples of a feature table
+    :param table: The feature table artifact
+    :param sample_ids: The ids of the samples
+    :param exclude: If True the samples are removed rather than kept
+    :return: The filtered table
+    """
+    sample_metadata = qiime2.Metadata(pd.DataFrame(index=pd.Index(sample_ids, name="sample-id")))
+    return feature_table.methods.filter_samples(table, metadata=sample_metadata, exclude_ids=exclude).filtered_table
+
+
+def incremental_tables(reference_table, taxonomy, level, base, delta):
+    """
+    Create the collapsed and relative frequency tables by collapsing only the added samples and merging them with the
+    tables of the base experiment (without the removed samples)
+    :param reference_table: The feature table of every sample
+    :param taxonomy: The taxonomy of the features
+    :param level: The taxonomic level the tables are collapsed to (the same as the base experiment)
+    :param base: The base frequency tables experiment
+    :param delta: The sample delta (added and removed samples)
+    :return: The collapsed table, its relative frequency table and the relative frequency table of the features
+    """
+    base_tables = [artifact_store.load(base["output"]["data"][i]) for i in (0, 2, 3)]
+    if delta["removed"]:
+        base_tables = [filter_table(table, delta["removed"], exclude=True) for table in base_tables]
+    if not delta["added"]:
+        return tuple(base_tables)
+
+    added_table = filter_table(reference_table, delta["added"])
+    added_collapsed = taxa.methods.collapse(table=added_table, taxonomy=taxonomy,
+                                            level=level).collapsed_table
+    added_tables = [added_collapsed,
+                    feature_table.methods.relative_frequency(added_collapsed).relative_frequency_table,
+                    feature_table.methods.relative_frequency(added_table).relative_frequency_table]
+    print("Collapsed " + str(len(delta["added"])) + " added samples and merged them into " + base["_id"])
+    return tuple(feature_table.methods.merge(tables=[base_table, added]).merged_table
+                 for base_table, added in zip(base_tables, added_tables))
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which creates a number of frequency and relative frequency tables with both
     classified an non classified ASV's.
     It also produces a number of summary visuals and a stacked barplot demonstrating the composition of all the samples.
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -35,46 +78,56 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Get the sequences from the feature classifcation service
-    sequences = qiime2.Artifact.load(parent["output"]["data"])
+    sequences = artifact_store.load(parent["output"]["data"])
 
     # Get the ASV information from the QA service
-    reference_table_data = db.get_specified_parent_stage("Quality_Analysis", [parent], [])["output"]["data"][0]
-    reference_table = qiime2.Artifact.load(reference_table_data)
+    reference_table_data = db.get_related_stage("Quality_Analysis", parent)["output"]["data"][0]
+    reference_table = artifact_store.load(reference_table_data)
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
-
-    # Create the taxa table
-    taxa_table = taxa.methods.collapse(table=reference_table,
-                                       taxonomy=sequences,
-                                       level=params["level"])
-
-    # Getting the relative frequency
-    id_freq = feature_table.methods.relative_frequency(reference_table)
-    otu_freq = feature_table.methods.relative_frequency(taxa_table.collapsed_table)
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
+
+    # In incremental mode only the samples added since the base experiment are collapsed, the collapsed tables are
+    # the same at the same level so the base tables are reused for the other samples
+    base = db.get_incremental_base(CURRENT_STAGE, parent, {"params.level": parameters["level"]})
+    delta = None
+    if base is not None:
+        delta = {"base": base["_id"], "added": parent["sample_delta"]["added"],
+                 "removed": parent["sample_delta"]["removed"]}
+        collapsed_table, otu_relative, id_relative = incremental_tables(reference_table, sequences,
+                                                                        parameters["level"], base, delta)
+    else:
+        # Create the taxa table
+        collapsed_table = taxa.methods.collapse(table=reference_table,
+                                                taxonomy=sequences,
+                                                level=parameters["level"]).collapsed_table
+
+        # Getting the relative frequency
+        id_relative = feature_table.methods.relative_frequency(reference_table).relative_frequency_table
+        otu_relative = feature_table.methods.relative_frequency(collapsed_table).relative_frequency_table
 
     # Save the table data
-    taxa_table.collapsed_table.save(outputs[0])
-    reference_table.save(outputs[1])
-    otu_freq.relative_frequency_table.save(outputs[2])
-    id_freq.relative_frequency_table.save(outputs[3])
+    artifact_store.save(collapsed_table, outputs[0])
+    artifact_store.save(reference_table, outputs[1])
+    artifact_store.save(otu_relative, outputs[2])
+    artifact_store.save(id_relative, outputs[3])
 
     # Create visual summaries for every table
-    feature_table.visualizers.summarize(reference_table).visualization.save(outputs[4])
-    feature_table.visualizers.summarize(taxa_table.collapsed_table).visualization.save(outputs[5])
-    feature_table.visualizers.summarize(id_freq.relative_frequency_table).visualization.save(outputs[6])
-    feature_table.visualizers.summarize(otu_freq.relative_frequency_table).visualization.save(outputs[7])
+    artifact_store.save(feature_table.visualizers.summarize(reference_table).visualization, outputs[4])
+    artifact_store.save(feature_table.visualizers.summarize(collapsed_table).visualization, outputs[5])
+    artifact_store.save(feature_table.visualizers.summarize(id_relative).visualization, outputs[6])
+    artifact_store.save(feature_table.visualizers.summarize(otu_relative).visualization, outputs[7])
 
     # Metadata for the samples used in diversity metrics to determine importance
-    metadata_file = db.get_specified_parent_stage("Metadata_Creator", [parent], [])["output"]["data"]
+    metadata_file = db.get_related_stage("Metadata_Creator", parent)["output"]["data"]
     sample_metadata = qiime2.Metadata.load(metadata_file)
 
     # Visualise a stacked barplot for all samples
     stacked_boxplot = taxa.visualizers.barplot(reference_table, sequences, sample_metadata)
-    stacked_boxplot.visualization.save(outputs[8])
+    artifact_store.save(stacked_boxplot.visualization, outputs[8])
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params": parameters,
@@ -83,20 +136,27 @@ def experiment(exp_id, parent_name, parameters):
             "visuals": outputs[5:]
         }
     }
+    if delta is not None:
+        this_experiment["sample_delta"] = delta
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    # Get the passed parameters
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
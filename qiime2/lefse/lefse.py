@@ -15,15 +15,17 @@ from pymongoClient import client
 
 CURRENT_STAGE = "Lefse"
 
-def experiment(exp_id, parent_name, parameters):
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which uses lefse to determine the discrimant taxa for each classifation
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -40,7 +42,7 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
     # Separate the outputs into visuals and data (NEEDED AS PYTHON 2.7 handles the output retrieval differently)
     visuals_out = []
@@ -77,7 +79,7 @@ def experiment(exp_id, parent_name, parameters):
 
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params": parameters,
@@ -89,15 +91,21 @@ def experiment(exp_id, parent_name, parameters):
 
     db.new_experiment(this_experiment)
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
-    db.close()
\ No newline at end of file
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
+    db.close()
@@ -1,33 +1,21 @@
 import json
 import os
 import logging
-from pymongoClient import client
+from pymongoClient import client, sample_export
 
 CURRENT_STAGE = "Manifest_Creator"
 
+# The working directory of the data import service, the file locations of the samples (./data/...) are relative to it
+DATA_IMPORT_DIR = os.getenv("DATA_IMPORT_DIR", "/qiime_data_import/")
 
-def get_sample_locations(criteria):
+
+def manifest_path(sample):
     """
-    Get the location of the sample files from the system. These are stored when the sample downloader is used but
-    can also be added manually.
-    Certain criteria in this function may need to be customised for individual studies
-    :param criteria: The criteria for sample selection
-    :type criteria: dict
-    :return: The file locations of the selected samples
-    :rtype: list
+    The location of the sequences of a sample for the data import service (inside its container by default)
+    :param sample: The sample (with its run_accession and file_location)
+    :return: The location
     """
-    docs = []
-    # Get the relevant sample information
-    samples = db.query(criteria, 'samples')
-    # Checks that the samples selected have valid metadata including diagnosis (This is valid for only this metadata)
-    # A more generic approach could be developed in the future
-    for sample in samples:
-        try:
-            if db.get_one({"sample": sample['sample_alias']}, 'metadata')['dx'] is not None:
-                docs.append(sample)
-        except Exception as error:
-            logging.log(4,error)
-    return docs
+    return os.path.join(DATA_IMPORT_DIR, sample['file_location'][2:], sample['run_accession'] + '.fastq.gz')
 
 
 def write_manifest(sample_data, manifest_output_dir):
@@ -40,22 +28,55 @@ def write_manifest(sample_data, manifest_output_dir):
 
     with open(manifest_output_dir, 'w') as f:
         f.write('sample-id\tabsolute-filepath\n')
-        for sample in sample_data:
-            line = sample['run_accession'] + '\t' + \
-                   "/qiime_data_import/" + sample['file_location'][2:] + "/" + sample['run_accession'] + '.fastq.gz'
-            f.write(line + '\n')
+        f.writelines(sample['run_accession'] + '\t' + manifest_path(sample) + '\n' for sample in sample_data)
+
+
+def read_manifest(manifest_file):
+    """
+    Read the sample ids of a manifest file
+    :param manifest_file: The location of the manifest file
+    :return: The list of sample ids
+    """
+    with open(manifest_file, 'r') as f:
+        next(f)
+        return [line.split('\t')[0] for line in f if line.strip()]
+
 
+def sample_delta(db, base_id, docs):
+    """
+    Compare the selected samples to the samples of a base manifest creator experiment
+    :param db: The dbClient
+    :param base_id: The id of the base experiment
+    :param docs: The selected samples
+    :return: The delta (base, added and removed samples) or None if the base experiment doesn't exist
+    """
+    base = db.get_one({"_id": base_id, "stage": CURRENT_STAGE}, "experiment")
+    if base is None:
+        logging.warning("Base experiment " + base_id + " does not exist, all the samples will be processed")
+        return None
+    base_samples = set(read_manifest(base["output"]["data"]))
+    samples = set(doc['run_accession'] for doc in docs)
+    return {
+        "base": base_id,
+        "added": sorted(samples - base_samples),
+        "removed": sorted(base_samples - samples)
+    }
 
-def experiment(exp_id, parent_name, parameters):
+
+def experiment(db, exp_id, parent_name, parameters, output_dir, samples, base_exp_id=None):
     """
     Runs the experiment for this service which collection information about a number of samples and writes a qiime2
     manifest file for data importing
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
+    :param samples: A mongodb query (json) selecting the samples
+    :param base_exp_id: The manifest creator experiment an incremental run is compared to
     :return: NONE
     """
 
@@ -64,39 +85,62 @@ def experiment(exp_id, parent_name, parameters):
         logging.warning("That experiment_id already exists, please use a new experiment ID")
         return
 
-    samples = os.getenv('SAMPLES')
-
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
-
-    # Get the sample information and write to the manifest file
-    docs = get_sample_locations(json.loads(samples))
-    write_manifest(docs, outputs[0])
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
+
+    # Get the sample information and write the manifest file and the metadata of the samples together. Only
+    # samples with valid metadata including diagnosis are selected (This is valid for only this metadata)
+    metadata_file = os.path.join(os.path.dirname(outputs[0]), "manifest_metadata.tsv")
+    docs = sample_export.export_samples(db, json.loads(samples), outputs[0], metadata_file, manifest_path,
+                                        required=["dx"])
+    print("Exported " + str(len(docs)) + " samples")
+
+    # In incremental mode a second manifest only holds the samples added since the base experiment
+    delta = None
+    if base_exp_id:
+        delta = sample_delta(db, base_exp_id, docs)
+    if delta is not None:
+        delta["manifest"] = os.path.join(os.path.dirname(outputs[0]), "delta_" + os.path.basename(outputs[0]))
+        added = set(delta["added"])
+        write_manifest([doc for doc in docs if doc['run_accession'] in added], delta["manifest"])
+        print(str(len(delta["added"])) + " samples added and " + str(len(delta["removed"])) +
+              " removed since " + delta["base"])
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params": parameters,
         "output": {
             "visuals": None,
             "data": outputs[0]
-        }
-
+        },
+        # The query is stored as a string as mongodb operators can't be used as field names
+        "selection_criteria": samples,
+        "samples": len(docs),
+        "metadata_export": metadata_file
     }
+    if delta is not None:
+        this_experiment["sample_delta"] = delta
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    experiment_id = os.getenv('EXP_ID')
-    parent_experiment = os.getenv("PARENT")
-    params = os.getenv("PARAMS")
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment['EXP_ID']
     print("Running "+experiment_id)
-    experiment(experiment_id,parent_experiment,params)
+    experiment(db, experiment_id, environment.get("PARENT"), environment.get("PARAMS"), environment["OUTPUT_DIR"],
+               environment['SAMPLES'], environment.get("BASE_EXP_ID"))
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
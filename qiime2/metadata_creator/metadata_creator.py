@@ -2,7 +2,7 @@ import json
 import os
 from os import path
 import logging
-from pymongoClient import client
+from pymongoClient import client, sample_export
 
 CURRENT_STAGE = "Metadata_Creator"
 
@@ -28,70 +28,71 @@ def get_samples_from_manifest(manifest_experiment):
     return samples
 
 
-def write_metadata_manifest(output_loc, samples):
+def write_metadata_manifest(db, output_loc, samples, parameters):
     """
     Writes a metdsata manifest file for qiime2. Makes the assumption that all samples have the same metadata headers.
     This is a requirement for qiime2. Different metadata could be combined in future releases
+    :param db: The dbClient
     :param output_loc: file location for the manifest file
     :type output_loc: str
     :param samples: a list of sample ids (run accession)
     :type samples: list
+    :param parameters: The parameters of the experiment (a selection of the metadata fields)
     :return: None
     """
     # Prepare the output file headings
     output_file = open(output_loc, "w")
     output_file.write("sample-id \t")
 
+    # Every sample is joined to its metadata (via the sample alias) in one query
     # Write the headers of the meatadata data
-    if "selection" in params:
+    if "selection" in parameters:
         # If a selection of specific metadata is given get those headers
-        db_selection = params["selection"]
-        headings = list(db_selection.keys())
-        db_selection["_id"] = 0
-        db_selection["sample"] = 0
-        for item in headings:
-            output_file.write(item + "\t")
+        headings = list(parameters["selection"].keys())
+        resolved = db.resolve_samples(samples[1:], headings)
     else:
         # Get all the headers of the samples
-        db_selection = {"_id": 0, "sample": 0}
-        sample_alias = db.get_one_selective({"run_accession": samples[1]}, {"_id": 0}, "samples")["sample_alias"]
-        headings = db.get_one_selective({"sample": sample_alias}, {"_id": 0}, "metadata").keys()
-        [output_file.write(heading + "\t") for heading in list(headings)[1:]]
+        resolved = db.resolve_samples(samples[1:])
+        metadata = resolved[samples[1]]["metadata"]
+        headings = [heading for heading in metadata.keys() if heading != "sample"]
+    for heading in headings:
+        output_file.write(heading + "\t")
 
     output_file.write("\n")
 
-    # For every sample Id get the metdata and write to file
+    # For every sample Id write the metdata to file
     for id in samples[1:]:
-        # Need to convert from the run accession to the sample alias in the metadata
-        # This might not be needed for all datasets so a more flexibile method may be needed
-        sample_alias = db.get_one_selective({"run_accession": id}, {"sample_alias": 1}, "samples")["sample_alias"]
-        metadata = db.get_one_selective({"sample": sample_alias}, db_selection, "metadata")
+        metadata = resolved.get(id, {}).get("metadata")
         output_file.write(id + "\t")
         # This shouldnt happen but for some datasets metadata may be removed from repository so account for that
         if metadata is None:
-            [output_file.write("NaN\t") for item in list(headings)[1:]]
+            output_file.write("NaN\t" * len(headings))
             output_file.write("\n")
 
         else:
-            for value in metadata.values():
+            for heading in headings:
+                value = metadata.get(heading)
                 # If no value for the header in the metadata replace with NaN
                 if value is not None:
-                    output_file.write(value + "\t")
+                    output_file.write(str(value) + "\t")
                 else:
                     output_file.write("NaN\t")
             output_file.write("\n")
+    output_file.close()
 
 
-def experiment(exp_id, parent_name, parameters):
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which creates a file containing all the metadata for the samples in a manifest
     file
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -107,13 +108,20 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
-    samples = get_samples_from_manifest(parent)
-    write_metadata_manifest(outputs[0], samples)
+    export = parent.get("metadata_export")
+    if export is not None and path.exists(export):
+        # The manifest creator wrote the metadata of its samples while writing the manifest
+        fields = list(parameters["selection"].keys()) if "selection" in parameters else None
+        sample_export.select_metadata(export, outputs[0], fields)
+    else:
+        # Manifest creator experiments from before the metadata was exported with the manifest
+        samples = get_samples_from_manifest(parent)
+        write_metadata_manifest(db, outputs[0], samples, parameters)
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params":parameters,
@@ -126,15 +134,21 @@ def experiment(exp_id, parent_name, parameters):
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
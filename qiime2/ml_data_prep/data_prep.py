@@ -1,15 +1,22 @@
 import ast
 import json
 import os
-from pymongoClient import client
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongoClient import client, artifact_store, feature_matrix
 import qiime2
 import logging
 import pandas as pd
+from scipy import sparse
 import pathlib
 import tempfile
 
 CURRENT_STAGE = "Machine_Learning_Data_Prep"
 
+# Tables with a smaller fraction of non zero values than this are kept as sparse dataframes
+SPARSE_DENSITY = 0.3
+
 
 def extract_csvs(viz):
     """
@@ -33,15 +40,117 @@ def extract_csvs(viz):
     return data
 
 
-def experiment(exp_id, parent_name, parameters):
+def sparse_frame(df):
+    """
+    Convert a table of numbers to a sparse dataframe if most of its values are zero
+    :param df: The dataframe
+    :return: The sparse or original dataframe
+    """
+    values = df.to_numpy(dtype="float64")
+    if values.size and (values != 0).sum() < SPARSE_DENSITY * values.size:
+        return pd.DataFrame.sparse.from_spmatrix(sparse.csr_matrix(values), index=df.index, columns=df.columns)
+    return df.astype("float64")
+
+
+def lefse_filter(data):
+    """
+    Create the regex of the taxa found to be significant by lefse
+    :param data: The location of the lefse results (.res)
+    :return: The regex
+    """
+    temp = pd.read_csv(data, sep="\t", header=None)
+    filtered = temp[temp[2].isin(["CD", "UC", "Healthy"])]
+    filtered[0] = filtered[0].str.replace('.', ';')
+    filter = list(filtered[0])
+    # Create a list of regex filtering terms
+    for item in filter:
+        item = item + "[;__]*"
+    filter.append("dx")
+    return "|".join(filter)
+
+
+def load_data(data, stage):
+    """
+    Load the data of a parent, run in the thread pool
+    :param data: The location of the parent output
+    :param stage: The stage of the parent
+    :return: A tuple of "table" and the dataframe indexed by sample id, "filter" and the lefse regex or None
+    """
+    start = time.time()
+    result = None
+    # If the file is an aritfact extract the relevant data to a dataframe
+    if data[-4:] == ".qza":
+        artifact = artifact_store.load(data)
+        result = ("table", sparse_frame(extract_csvs(artifact)[0]))
+
+    # If the data frame is a tsv then will import as dataframe, the first row is the diagnosis of each sample
+    elif data[-4:] == ".tsv":
+        if stage == "Freq_To_Biom":
+            result = ("table", sparse_frame(pd.read_csv(data, sep="\t", skiprows=1, index_col=0).T))
+
+    # Filter a table based on lefse results
+    elif data[-4:] == ".res":
+        result = ("filter", lefse_filter(data))
+
+    print("Loaded " + data + " in " + str(round(time.time() - start, 1)) + "s")
+    return result
+
+
+def parent_data(db, item):
+    """
+    Get the location of the output of a parent used as input
+    :param db: The dbClient
+    :param item: A tuple of the parent experiment id and the name of its output
+    :return: The parent experiment and the location of its output, None if the parent does not exist
+    """
+    parent = db.get_one({"_id": item[0]}, "experiment")
+    if parent is None:
+        return None, None
+
+    # Outputs of the current parent
+    stage_outputs = db.get_one({"_id": parent["stage"]}, "services")["output"]["data"]
+
+    # Get the exact ouput required
+    if isinstance(parent["output"]["data"], list):
+        data = parent["output"]["data"][stage_outputs.index(item[1])]
+    else:
+        data = parent["output"]["data"]
+    return parent, data
+
+
+def align(labels, loaded):
+    """
+    Join the labels and the tables of the parents on the samples they all have, the lefse filters are applied to the
+    tables of the parents before them
+    :param labels: The series of the label of each sample
+    :param loaded: The results of load_data in the order of the parents
+    :return: The combined dataframe
+    """
+    tables = []
+    for kind, value in loaded:
+        if kind == "table":
+            tables.append(value)
+        elif kind == "filter":
+            tables = [table.filter(regex=value, axis=1) for table in tables]
+
+    samples = labels.index
+    for table in tables:
+        samples = samples[samples.isin(table.index)]
+    return pd.concat([labels.loc[samples]] + [table.loc[samples] for table in tables], axis=1)
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir, parents):
     """
     Runs the experiment for this service which quality controls the input samples using the defined parameters
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
+    :param parents: The (experiment id, output name) of each parent used as input
     :return: NONE
     """
 
@@ -49,97 +158,73 @@ def experiment(exp_id, parent_name, parameters):
     if db.check_doc_exists({"_id": exp_id}, "experiment"):
         logging.warning("That experiment_id already exists, please use a new experiment ID")
         return
-    # Get the parent information
-    parents = ast.literal_eval(os.getenv("PARENT_NAMES"))
-
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
-    df = pd.DataFrame()
-    # Will get all the data information from the parents to combine into one dataframe
+    start = time.time()
+    inputs = []
     for item in parents:
-        parent = db.get_one({"_id": item[0]}, "experiment")
+        parent, data = parent_data(db, item)
         if parent is None:
             logging.warning("Parent experiment does not exist - Maybe it hasn't finished executing")
             return
+        inputs.append((parent, data))
+
+    # Will always get the sample metadata first
+    metadata_file = db.get_related_stage("Metadata_Creator", inputs[0][0])["output"]["data"]
+    labels = pd.read_csv(metadata_file, sep="\t", header=0, index_col=0)
+    labels = labels.dropna(subset=[parameters["classifier_column"]])[parameters["classifier_column"]]
+
+    # Load the parents concurrently, an output used by more than one parent entry is only loaded once
+    with ThreadPoolExecutor(max_workers=parameters.get("workers", 4)) as executor:
+        loads = {}
+        for parent, data in inputs:
+            if data not in loads:
+                loads[data] = executor.submit(load_data, data, parent["stage"])
+        loaded = [loads[data].result() for parent, data in inputs]
+
+    df = align(labels, [result for result in loaded if result is not None])
+
+    # Save the combined data as a binary matrix with its index, the csv is only written if requested
+    csv_file = outputs[2] if parameters.get("csv", False) else None
+    feature_matrix.save(df, parameters["classifier_column"], outputs[0], outputs[1], csv_file)
 
-        # Outputs of the current parent
-        stage_outputs = db.get_one({"_id": parent["stage"]}, "services")["output"]["data"]
-
-        # Get the exact ouput required
-        if parent["output"]["data"] is list:
-            data = parent["output"]["data"][stage_outputs.index(item[1])]
-        else:
-            data = parent["output"]["data"]
-
-        # Will always get the sample metadata first
-        if parents.index(item) == 0:
-            metadata_file = db.get_specified_parent_stage("Metadata_Creator", [parent], [])["output"]["data"]
-
-            df = pd.read_csv(metadata_file, sep="\t", header=0, index_col=0)
-            df = df.dropna(subset=[params["classifier_column"]])
-            df = df[params["classifier_column"]]
-
-        # If the file is an aritfact extract the relevant data to a dataframe
-        if data[-4:] == ".qza":
-            artifact = qiime2.Artifact.load(data)
-            temp = extract_csvs(artifact)
-            df = pd.merge(left=df, left_index=True, right=temp[0], right_index=True, how='inner')
-
-        # If the data frame is a tsv then will import as dataframe
-        elif data[-4:] == ".tsv":
-
-            if parent["stage"] == "Freq_To_Biom":
-                temp = pd.read_csv(data, sep="\t", header=None)
-                temp = temp.drop(index=0)
-                temp = temp.T
-                temp = temp.set_index(temp.columns[0])
-                temp.columns = temp.iloc[0]
-                temp = temp.iloc[1:]
-                # Merge the current data with this data
-                df = pd.merge(left=df, left_index=True, right=temp, right_index=True, how='inner')
-
-        # Filter a table based on lefse results
-        elif data[-4:] == ".res":
-            temp = pd.read_csv(data, sep="\t", header=None)
-            filtered = temp[temp[2].isin(["CD", "UC", "Healthy"])]
-            filtered[0] = filtered[0].str.replace('.', ';')
-            filter = list(filtered[0])
-            # Create a list of regex filtering terms
-            for item in filter:
-                item = item + "[;__]*"
-            filter.append("dx")
-            # Will filter all the dataframe to only the taxa covered by the lefse regex
-            filterreg = "|".join(filter)
-
-            df = df.filter(regex=filterreg, axis=1)
-
-    # Save the combined data to a csv file
-    df.to_csv(outputs[0], sep = ',')
+    # ru_maxrss is in kilobytes, reported so the container can be sized
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print("Combined " + str(df.shape[0]) + " samples and " + str(df.shape[1] - 1) + " features in " +
+          str(round(time.time() - start, 1)) + "s, peak memory " + str(round(peak_rss_mb, 1)) + "MB")
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": None,
         "stage": CURRENT_STAGE,
         "params": parameters,
         "output": {
-            "data": outputs[0]
-        }
+            "data": outputs[0],
+            "index": outputs[1],
+            "csv": csv_file
+        },
+        "peak_rss_mb": peak_rss_mb
     }
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    # Get the passed parameters
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"], ast.literal_eval(environment["PARENT_NAMES"]))
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
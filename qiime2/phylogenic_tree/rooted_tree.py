@@ -1,21 +1,23 @@
 import json
 import os
 import logging
-from pymongoClient import client
+from pymongoClient import client, artifact_store
 import qiime2
 from qiime2.plugins import alignment, phylogeny
 
 CURRENT_STAGE = "Rooted_Tree"
 
-def experiment(exp_id, parent_name, parameters):
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which quality controls the input samples using the defined parameters
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -32,10 +34,10 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
     # Get the representative sequences from the QA experiment
-    representative_sequences = qiime2.Artifact.load(parent["output"]["data"][1])
+    representative_sequences = artifact_store.load(parent["output"]["data"][1])
 
     # Run a series of steps to create a phylogenetic tree file
     mafft_alignment = alignment.methods.mafft(representative_sequences)
@@ -43,10 +45,10 @@ def experiment(exp_id, parent_name, parameters):
     unrooted_tree = phylogeny.methods.fasttree(masked_mafft_alignment.masked_alignment)
     rooted_tree = phylogeny.methods.midpoint_root(unrooted_tree.tree)
 
-    rooted_tree.rooted_tree.save(outputs[0])
+    artifact_store.save(rooted_tree.rooted_tree, outputs[0])
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params":parameters,
@@ -59,16 +61,21 @@ def experiment(exp_id, parent_name, parameters):
 
 
 
-if __name__ == '__main__':
-
-    db = client.dbClient()
-
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
@@ -1,23 +1,206 @@
 import json
+import multiprocessing
 import os
-from pymongoClient import client
+import resource
+import shutil
+import tempfile
+import time
+from pymongoClient import client, stage_cache, artifact_store
 import qiime2
 from qiime2.plugins import quality_filter, deblur, feature_table, metadata, demux, cutadapt, dada2
+import pandas as pd
 import logging
 
 # Name of current Stage constant
 CURRENT_STAGE = "Quality_Analysis"
 
+# The denoise_pyro parameters used when they are not given in the experiment parameters
+DENOISE_DEFAULTS = {"trunc_len": 200, "max_len": 600, "trunc_q": 25, "n_threads": 0}
 
-def experiment(exp_id, parent_name, parameters):
+
+def denoise_parameters(parameters):
+    """
+    Get the denoise_pyro parameters for the experiment, any not given use the defaults
+    :param parameters: The parameters for the experiment
+    :return: The keyword arguments for denoise_pyro
+    """
+    denoise_params = DENOISE_DEFAULTS.copy()
+    denoise_params.update(parameters.get("denoise_pyro", {}))
+    # Only the documentation link is defined in the service definitions
+    denoise_params.pop("link_to_params", None)
+    return denoise_params
+
+
+def sample_ids(sequences):
+    """
+    Get the ids of the samples in the demultiplexed sequences
+    :param sequences: The demultiplexed sequences artifact
+    :return: The list of sample ids
+    """
+    from q2_types.per_sample_sequences import SingleLanePerSampleSingleEndFastqDirFmt
+    manifest = sequences.view(SingleLanePerSampleSingleEndFastqDirFmt).manifest.view(pd.DataFrame)
+    return list(manifest.index)
+
+
+def denoise_shard(shard):
+    """
+    Denoise one shard of the samples, run in a separate process of the pool
+    :param shard: A tuple of the shard number, the location of the shard sequences, the denoise_pyro parameters and
+    the directory to save the results to
+    :return: The locations of the table, representative sequences and stats with the wall time and peak memory
+    """
+    number, sequences_file, denoise_params, work_dir = shard
+    start = time.time()
+    sequences = qiime2.Artifact.load(sequences_file)
+    dd2 = dada2.methods.denoise_pyro(sequences, **denoise_params)
+
+    results = []
+    for name, result in [("table", dd2.table), ("sequences", dd2.representative_sequences),
+                         ("stats", dd2.denoising_stats)]:
+        results.append(result.save(os.path.join(work_dir, "shard_" + str(number) + "_" + name + ".qza")))
+
+    # ru_maxrss is in kilobytes, as each process of the pool only denoises one shard this is the peak of the shard
+    return {
+        "shard": number,
+        "output": results,
+        "wall_time": time.time() - start,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+
+
+def id_metadata(ids, name="sample-id"):
+    """
+    Create metadata with no columns holding a list of ids, used to filter samples and features
+    :param ids: The ids
+    :param name: The name of the id column
+    :return: The qiime2 Metadata
+    """
+    return qiime2.Metadata(pd.DataFrame(index=pd.Index(ids, name=name)))
+
+
+def denoise(sequences, denoise_params, shard_params):
+    """
+    Run the dada2 denoise method, on shards of the samples if enabled
+    :param sequences: The demultiplexed sequences artifact
+    :param denoise_params: The keyword arguments for denoise_pyro
+    :param shard_params: The sharding parameters (samples_per_shard and processes)
+    :return: The table, representative sequences and stats artifacts and the details of each shard (or None)
+    """
+    samples_per_shard = int(shard_params.get("samples_per_shard", 0))
+    if samples_per_shard > 0:
+        return sharded_denoise(sequences, denoise_params, samples_per_shard, int(shard_params.get("processes", 2)))
+    dd2 = dada2.methods.denoise_pyro(sequences, **denoise_params)
+    return dd2.table, dd2.representative_sequences, dd2.denoising_stats, None
+
+
+def incremental_denoise(sequences, base, delta, denoise_params, shard_params):
+    """
+    Denoise only the samples added since the base experiment and merge them into its table, representative sequences
+    and stats, the samples removed since the base experiment are filtered out
+    :param sequences: The demultiplexed sequences of the added samples
+    :param base: The base quality analysis experiment
+    :param delta: The sample delta (added and removed samples)
+    :param denoise_params: The keyword arguments for denoise_pyro
+    :param shard_params: The sharding parameters
+    :return: The table, representative sequences and stats artifacts and the details of each shard (or None)
+    """
+    if denoise_parameters(base["params"]) != denoise_params:
+        logging.warning("The denoise parameters differ from the base experiment " + base["_id"])
+
+    table = artifact_store.load(base["output"]["data"][0])
+    representative_sequences = artifact_store.load(base["output"]["data"][1])
+    stats = artifact_store.load(base["output"]["data"][2]).view(qiime2.Metadata).to_dataframe()
+
+    if delta["removed"]:
+        table = feature_table.methods.filter_samples(table, metadata=id_metadata(delta["removed"]),
+                                                     exclude_ids=True).filtered_table
+        stats = stats.drop(delta["removed"], errors="ignore")
+
+    shards = None
+    if delta["added"]:
+        added_table, added_sequences, added_stats, shards = denoise(sequences, denoise_params, shard_params)
+        table = feature_table.methods.merge(tables=[table, added_table]).merged_table
+        representative_sequences = feature_table.methods.merge_seqs(
+            data=[representative_sequences, added_sequences]).merged_data
+        stats = pd.concat([stats, added_stats.view(qiime2.Metadata).to_dataframe()])
+
+    # Only keep the sequences of the features still in the table
+    representative_sequences = feature_table.methods.filter_seqs(representative_sequences, table=table).filtered_data
+    denoising_stats = qiime2.Artifact.import_data("SampleData[DADA2Stats]", qiime2.Metadata(stats))
+    print("Merged " + str(len(delta["added"])) + " added samples into " + base["_id"] + " and removed " +
+          str(len(delta["removed"])))
+    return table, representative_sequences, denoising_stats, shards
+
+
+def sharded_denoise(sequences, denoise_params, samples_per_shard, processes):
+    """
+    Split the samples into shards and denoise the shards across a pool of processes, the feature tables,
+    representative sequences and denoising stats of the shards are then merged.
+    The error model is learnt separately for each shard so shards should contain a reasonable number of samples
+    :param sequences: The demultiplexed sequences artifact
+    :param denoise_params: The keyword arguments for denoise_pyro
+    :param samples_per_shard: The maximum number of samples in each shard
+    :param processes: The number of shards denoised at once
+    :return: The merged table, representative sequences and stats artifacts and the details of each shard
+    """
+    samples = sample_ids(sequences)
+    denoise_params = denoise_params.copy()
+    if denoise_params["n_threads"] == 0:
+        # Share the cores between the shards rather than each shard using all of them
+        denoise_params["n_threads"] = max(1, multiprocessing.cpu_count() // processes)
+
+    work_dir = tempfile.mkdtemp(prefix="qa_shards_")
+    try:
+        shards = []
+        for number, first in enumerate(range(0, len(samples), samples_per_shard)):
+            shard_samples = samples[first:first + samples_per_shard]
+            shard_sequences = demux.methods.filter_samples(sequences,
+                                                           metadata=id_metadata(shard_samples)).filtered_demux
+            shard_file = shard_sequences.save(os.path.join(work_dir, "shard_" + str(number) + ".qza"))
+            shards.append((number, shard_file, denoise_params, work_dir))
+        print("Denoising " + str(len(samples)) + " samples in " + str(len(shards)) + " shards")
+
+        # A fresh process for every shard so the memory of each shard is released and measured separately
+        pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+        try:
+            shard_results = []
+            for result in pool.imap_unordered(denoise_shard, shards):
+                print("Shard " + str(result["shard"]) + " finished in " + str(round(result["wall_time"], 1)) +
+                      "s, peak memory " + str(round(result["peak_rss_mb"], 1)) + "MB")
+                shard_results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+        shard_results.sort(key=lambda result: result["shard"])
+
+        tables = [qiime2.Artifact.load(result["output"][0]) for result in shard_results]
+        representative_sequences = [qiime2.Artifact.load(result["output"][1]) for result in shard_results]
+        stats = [qiime2.Artifact.load(result["output"][2]).view(qiime2.Metadata).to_dataframe()
+                 for result in shard_results]
+
+        table = feature_table.methods.merge(tables=tables).merged_table
+        merged_sequences = feature_table.methods.merge_seqs(data=representative_sequences).merged_data
+        denoising_stats = qiime2.Artifact.import_data("SampleData[DADA2Stats]", qiime2.Metadata(pd.concat(stats)))
+
+        # The output files of the shards are no longer needed
+        for result in shard_results:
+            del result["output"]
+        return table, merged_sequences, denoising_stats, shard_results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir):
     """
     Runs the experiment for this service which quality controls the input samples using the defined parameters
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
     :return: NONE
     """
 
@@ -34,20 +217,48 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
+
+    # In incremental mode only the samples added since the base experiment are denoised, if the parent only imported
+    # the added samples and there is no base to merge them into this raises rather than recording a partial table
+    base = db.get_incremental_base(CURRENT_STAGE, parent)
+    delta = None
+    inputs = [parent["output"]["data"]]
+    if base is not None:
+        delta = {"base": base["_id"], "added": parent["sample_delta"]["added"],
+                 "removed": parent["sample_delta"]["removed"]}
+        inputs.append(base["output"]["data"])
 
-    # Get the sequence information from the parent
-    sequences = qiime2.Artifact.load(parent["output"]["data"])
+    # Reuse the outputs of an earlier experiment with the same input sequences and parameters
+    cache = stage_cache.stageCache(db, CURRENT_STAGE)
+    cache_key = cache.key(inputs, parameters)
+    cached = cache.restore(cache_key, outputs)
 
-    # Run the dada2 denoise method
-    dd2 = dada2.methods.denoise_pyro(sequences, 200, max_len=600, trunc_q=25, n_threads=0)
+    shards = None
+    if cached is None:
+        start = time.time()
 
-    # Save the neccessary information to the system file storage (mounted volume)
-    dd2.table.save(outputs[0])
-    dd2.representative_sequences.save(outputs[1])
-    dd2.denoising_stats.save(outputs[2])
-    demux.visualizers.summarize(sequences).visualization.save(outputs[3])
-    feature_table.visualizers.summarize(dd2.table).visualization.save(outputs[4])
+        # Get the sequence information from the parent
+        sequences = artifact_store.load(parent["output"]["data"])
+
+        # Run the dada2 denoise method, on shards of the samples if enabled
+        denoise_params = denoise_parameters(parameters)
+        shard_params = parameters.get("shards", {})
+        if delta is not None:
+            table, representative_sequences, denoising_stats, shards = incremental_denoise(
+                sequences, base, delta, denoise_params, shard_params)
+        else:
+            table, representative_sequences, denoising_stats, shards = denoise(sequences, denoise_params,
+                                                                               shard_params)
+
+        # Save the neccessary information to the system file storage (mounted volume)
+        artifact_store.save(table, outputs[0])
+        artifact_store.save(representative_sequences, outputs[1])
+        artifact_store.save(denoising_stats, outputs[2])
+        artifact_store.save(demux.visualizers.summarize(sequences).visualization, outputs[3])
+        artifact_store.save(feature_table.visualizers.summarize(table).visualization, outputs[4])
+
+        cache.store(cache_key, exp_id, outputs, time.time() - start)
 
     # Save the experiment instance in the db
     this_experiment = {
@@ -60,20 +271,31 @@ def experiment(exp_id, parent_name, parameters):
             "visuals": outputs[3:]
         }
     }
+    if cached is not None:
+        this_experiment["cached_from"] = cached["experiment"]
+    elif shards is not None:
+        this_experiment["shards"] = shards
+    if delta is not None:
+        this_experiment["sample_delta"] = delta
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    # Get the passed parameters
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"])
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
     db.close()
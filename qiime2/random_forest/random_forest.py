@@ -1,23 +1,26 @@
+import argparse
 import os
-from pymongoClient import client
+import time
+import joblib
+import sklearn
+from pymongoClient import client, feature_matrix
+import rf_tuning
+import rf_stability
+import rf_plots
+import numpy as np
 import pandas as pd
 import json
-from pymongoClient import client
-import seaborn as sns
 import logging
-from sklearn.preprocessing import StandardScaler, label_binarize
-import matplotlib.pyplot as plt
-from sklearn.metrics import roc_auc_score
+from sklearn.preprocessing import StandardScaler
 
 ## Sklearn Libraries
 from sklearn.model_selection import StratifiedKFold
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import GridSearchCV, cross_val_predict
+from sklearn.model_selection import GridSearchCV
+from sklearn.base import clone
+from joblib import Parallel, delayed
 
-from sklearn.metrics import f1_score, confusion_matrix, roc_curve, auc, \
-    classification_report, recall_score, precision_recall_curve
-
-from sklearn.metrics import average_precision_score
+from sklearn.metrics import f1_score, classification_report, recall_score
 
 """
 Process for training a random forest model for the classification of microbiome samples
@@ -27,126 +30,62 @@ Uses pre formatted data form a data formatting system.
 CURRENT_STAGE = "Random_Forest"
 
 
-def plot_prec_recall(labels, predictedtargets, definitions, outputStruct, out_dir):
+def fit_fold(model, features, labels, train, test):
     """
-    Plot a precision recal graph for the passed data
-    :param labels: The actual labels of the data classified
-    :param predictedtargets: The predicted taregets from the classifier
-    :param definitions: The definitions of the data
-    :param outputStruct: The output dictionary for data summary
-    :param out_dir: The outpur directory
-    :return: NONE
+    Fit a copy of the model on the training samples of a fold and predict the probabilities of its test samples, run
+    in parallel for each fold
+    :param model: The unfitted model
+    :param features: The features of all the samples
+    :param labels: The labels of all the samples
+    :param train: The positions of the training samples
+    :param test: The positions of the test samples, None for the fit on all the samples
+    :return: The fitted model, the probabilities of the test samples in the order of model.classes_ and the fit and
+    predict times
     """
-    precision = dict()
-    recall = dict()
-    average_precision = dict()
-    y_bin = label_binarize(labels, classes=list(range(labels.nunique())))
-    for i in range(labels.nunique()):
-        precision[i], recall[i], _ = precision_recall_curve(y_bin[:, i],
-                                                            predictedtargets[:, i])
-        average_precision[i] = average_precision_score(y_bin[:, i], predictedtargets[:, i])
-
-    # Plot the averaged precision recall of all the classes
-    precision["macro"], recall["macro"], _ = precision_recall_curve(y_bin.ravel(),
-                                                                    predictedtargets.ravel())
-    average_precision["macro"] = average_precision_score(y_bin, predictedtargets,
-                                                         average="macro")
-
-    # Store the information ready for file output
-    outputStruct["average_precision"] = average_precision["macro"]
-    outputStruct["precision"] = precision["macro"].tolist()
-    outputStruct["recall"] = recall["macro"].tolist()
-
-    fig = plt.figure()
-
-    plt.plot(recall['macro'], precision['macro'],
-             label='macro-average precision score curve (area = {0:0.2f})'
-                   ''.format(average_precision["macro"]), linestyle=':', )
+    start = time.time()
+    fitted = clone(model).fit(features[train], labels[train])
+    fit_time = time.time() - start
 
-    # Plot the precision recall curve of each subclass
-    colors = ['blue', 'red', 'green']
-    for i, color in zip(range(labels.nunique()), colors):
-        plt.plot(recall[i], precision[i], color=color, lw=2,
-                 label='Precision-recall for class {0} (area = {1:0.2f})'
-                       ''.format(definitions[i], average_precision[i]))
+    probabilities = None
+    start = time.time()
+    if test is not None:
+        probabilities = fitted.predict_proba(features[test])
+    return fitted, probabilities, fit_time, time.time() - start
 
-    plt.xlabel('Recall')
-    plt.ylabel('Precision')
-    plt.ylim([0.0, 1.05])
-    plt.xlim([0.0, 1.0])
-    plt.legend(loc="lower center", bbox_to_anchor=(0.5, -0.6))
-    fig.subplots_adjust(bottom=0.35)
-    plt.savefig(out_dir)
-    plt.clf()
 
-
-def plot_roc(labels, predictions, definitions, outputStruct, out_dir):
+def cross_validate(model, features, labels, cv, n_jobs):
     """
-    Plots an area under curve graph
-    :param labels: The actual labels of the data classified
-    :param predictedtargets: The predicted taregets from the classifier
-    :param definitions: The definitions of the data
-    :param outputStruct: The output dictionary for data summary
-    :param out_dir: The outpur directory
-    :return: NONE
-    """
-    # Calcualte the datapoints to be plotted
-    fpr = dict()
-    tpr = dict()
-    roc_auc = dict()
-    y_bin = label_binarize(labels, classes=list(range(labels.nunique())))
-
-    for i in range(labels.nunique()):
-        fpr[i], tpr[i], _ = roc_curve(y_bin[:, i], predictions[:, i])
-        roc_auc[i] = auc(fpr[i], tpr[i])
-
-    fpr["macro"], tpr["macro"], _ = roc_curve(y_bin.ravel(), predictions.ravel())
-    roc_auc["macro"] = roc_auc_score(y_bin, predictions, average="macro")
-
-    # Store the information ready for file output
-    outputStruct["roc_auc"] = roc_auc["macro"]
-    outputStruct["mean_fpr"] = fpr["macro"].tolist()
-    outputStruct["mean_trp"] = tpr["macro"].tolist()
-
-    # Plot the average of all the classes
-    plt.plot(fpr["macro"], tpr["macro"],
-             label='macro-average ROC curve (area = {0:0.2f})'
-                   ''.format(roc_auc["macro"]),
-             color='navy', linestyle=':', linewidth=4)
-
-    # Plot each class
-    colors = ['blue', 'red', 'green']
-    for i, color in zip(range(labels.nunique()), colors):
-        plt.plot(fpr[i], tpr[i], color=color,
-                 label='ROC curve of class {0} (area = {1:0.2f})'
-                       ''.format(definitions[i], roc_auc[i]))
-    plt.plot([0, 1], [0, 1], 'k--')
-    plt.xlim([0, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('False Positive Rate')
-    plt.ylabel('True Positive Rate')
-    plt.title('Receiver operating characteristic for multi-class data')
-    plt.legend(loc="lower right")
-    plt.savefig(out_dir)
-    plt.clf()
-
-
-def plot_confusion_matrix(predictions, actual, out_dir):
-    """
-    Plots a confusion matrix of the classifications
-    :param predictions: The predictions of the model
-    :param actual: The actual labels of the samples
-    :param out_dir: The output directory for the image
-    :return:
+    Train the model on every fold and on all the samples in a single parallel pass. The probabilities of each sample
+    are predicted by the model of the fold it was held out of
+    :param model: The unfitted model
+    :param features: The features as a numpy array
+    :param labels: The integer labels as a numpy array
+    :param cv: The cross validation splitter
+    :param n_jobs: The number of fits run at once
+    :return: The model fitted on all the samples, the cross validated probabilities, the fold models with the positions
+    of their test samples and the details of each fold
     """
-    fig = plt.figure()
-    cm = pd.DataFrame(confusion_matrix(actual, predictions), columns=["CD", "UC", "Healthy"],
-                      index=["CD", "UC", "Healthy"])
-    sns.heatmap(cm, annot=True)
-    plt.savefig(out_dir)
-
-
-def run_classification(features, labels, definitions, outputStruct, out_dirs, parameters):
+    splits = list(cv.split(features, labels))
+    classes = np.unique(labels)
+    jobs = [(train, test) for train, test in splits] + [(np.arange(len(labels)), None)]
+    results = Parallel(n_jobs=n_jobs)(delayed(fit_fold)(model, features, labels, train, test) for train, test in jobs)
+
+    probabilities = np.zeros((len(labels), len(classes)))
+    folds = []
+    for number, ((train, test), (fitted, fold_probabilities, fit_time, predict_time)) in \
+            enumerate(zip(splits, results)):
+        # A fold may not contain every class
+        probabilities[np.ix_(test, np.searchsorted(classes, fitted.classes_))] = fold_probabilities
+        folds.append({"fold": number, "train_samples": len(train), "test_samples": len(test),
+                      "fit_time": fit_time, "predict_time": predict_time})
+
+    fitted, _, fit_time, _ = results[-1]
+    folds.append({"fold": "all", "train_samples": len(labels), "test_samples": 0, "fit_time": fit_time,
+                  "predict_time": 0})
+    return fitted, probabilities, [(result[0], test) for result, (_, test) in zip(results, splits)], folds
+
+
+def run_classification(features, labels, definitions, outputStruct, out_dirs, parameters, renderer):
     """
     Runs the random forest classification plotting a number of figures (ROC, Precision recall and confusion matrix)
     :param features: The features of the data (X)
@@ -154,8 +93,9 @@ def run_classification(features, labels, definitions, outputStruct, out_dirs, pa
     :param definitions: The definitions of the data
     :param outputStruct: The output dictionary for data summary
     :param out_dirs:The outpur directory
-    :param random_state:the random state for the crossfold
-    :return: The prediction labels and the actual labels
+    :param parameters: The parameters for the experiment
+    :param renderer: The plotRenderer the figures are rendered with
+    :return: The prediction labels, the actual labels and the model fitted on all the samples
     """
 
     # Stratified kfold to counteract teh class imbalances
@@ -164,35 +104,102 @@ def run_classification(features, labels, definitions, outputStruct, out_dirs, pa
     # Create a random fores model
     model = RandomForestClassifier(**parameters["rf_classifier"])
 
-    # Fit the model to the data
-    fitted = model.fit(features, labels)
-    predictions = cross_val_predict(model, features, labels, cv=cv, method="predict_proba")
-
-    predictions_labels = cross_val_predict(model, features, labels, cv=cv)
+    # Fit the model to the data and to each fold at once, the probabilities and labels both come from the fold models
+    start = time.time()
+    feature_values = feature_matrix.values(features)
+    fitted, predictions, fold_models, folds = cross_validate(model, feature_values, np.asarray(labels), cv,
+                                                             parameters.get("n_jobs", -1))
+    predictions_labels = np.argmax(predictions, axis=1)
+    outputStruct["folds"] = folds
+    print("Trained " + str(len(folds)) + " models in " + str(round(time.time() - start, 1)) + "s")
 
     feature_importances = pd.DataFrame(fitted.feature_importances_,
                                        index=features.columns,
                                        columns=['importance']).sort_values('importance', ascending=False)
 
-    plot_roc(labels, predictions, definitions, outputStruct, out_dirs[1])
-    plot_prec_recall(labels, predictions, definitions, outputStruct, out_dirs[2])
+    # Store the information ready for file output, the figures are rendered in the background
+    fpr, tpr, roc_auc = rf_plots.roc_curves(labels, predictions, len(definitions))
+    outputStruct["roc_auc"] = roc_auc["macro"]
+    outputStruct["mean_fpr"] = fpr["macro"].tolist()
+    outputStruct["mean_trp"] = tpr["macro"].tolist()
+    renderer.submit(rf_plots.render_roc, (fpr, tpr, roc_auc), list(definitions), out_dirs[1])
+
+    precision, recall, average_precision = rf_plots.precision_recall_curves(labels, predictions, len(definitions))
+    outputStruct["average_precision"] = average_precision["macro"]
+    outputStruct["precision"] = precision["macro"].tolist()
+    outputStruct["recall"] = recall["macro"].tolist()
+    renderer.submit(rf_plots.render_prec_recall, (precision, recall, average_precision), list(definitions),
+                    out_dirs[2])
 
     # Store the individual feature importance ready for writing to file
     outputStruct["feature_importances"] = feature_importances.to_dict('index')
 
-    return predictions_labels, labels
+    # Permutation importance of the fold models on their held out samples and its rank stability across the folds
+    if parameters.get("stability"):
+        stability = rf_stability.feature_stability(fold_models, feature_values, np.asarray(labels),
+                                                   list(features.columns), parameters["stability"],
+                                                   parameters.get("n_jobs", -1))
+        outputStruct["feature_stability"] = stability.to_dict('index')
+
+    return predictions_labels, labels, fitted
 
 
-def experiment(exp_id, parent_name, parameters):
+def save_model(db, fitted, features, definitions, label_column, parameters, exp_id, parent_name, output_dir):
+    """
+    Save the model fitted on all the samples with the schema of the features it expects, models trained on the same
+    data prep experiment are versioned in the order they were trained. The version is claimed in the database before
+    the files are written so services training at the same time never share a version
+    :param db: The dbClient
+    :param fitted: The fitted model
+    :param features: The features the model was trained on
+    :param definitions: The class name of each label
+    :param label_column: The name of the labels
+    :param parameters: The parameters the model was trained with
+    :param exp_id: The id of the experiment saving the model
+    :param parent_name: Id of the data prep experiment the model was trained on
+    :param output_dir: The output directory of the experiment
+    :return: The version and the locations of the model and schema files
+    """
+    # Models saved before versions were claimed are only recorded on their experiments
+    start = 1
+    for saved in db.query({"stage": CURRENT_STAGE, "parent": parent_name, "model": {"$exists": True}},
+                          "experiment").sort("model.version", -1).limit(1):
+        start = saved["model"]["version"] + 1
+    version = db.claim_version(CURRENT_STAGE + ":" + parent_name, exp_id, start)
+    model_dir = os.path.join(output_dir, "models")
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    name = os.path.join(model_dir, "random_forest_model_v" + str(version))
+
+    # Saved uncompressed so the arrays of the trees can be memory mapped when loaded
+    joblib.dump(fitted, name + ".joblib")
+    with open(name + ".json", "w") as f:
+        json.dump({
+            "version": version,
+            "trained_on": parent_name,
+            "features": [str(column) for column in features.columns],
+            "classes": [str(definition) for definition in definitions],
+            "label_column": label_column,
+            "rf_classifier": parameters["rf_classifier"],
+            "sklearn_version": sklearn.__version__
+        }, f, indent=4)
+    print("Saved model version " + str(version) + " to " + name + ".joblib")
+    return {"version": version, "model": name + ".joblib", "schema": name + ".json"}
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir, plots=True):
     """
     Runs the experiment for this service which trains and tests a random forest model with kfold cross validation
     Additionally it produces an AUROC and precision recall curve in addition to a confusuion matrix
+    :param db: The dbClient
     :param exp_id: The id of this experiment (must not already exist in the database)
     :type exp_id: str
     :param parent_name: Id of the parent experiment (should be of the correct stage type (data input)) and must exits
     :type parent_name: str
     :param parameters: The parameters for the experiment itself (dictionary of params)
     :type parameters: dict
+    :param output_dir: The output directory of the experiment
+    :param plots: If False no figures are rendered (the --no-plots argument)
     :return: NONE
     """
 
@@ -209,9 +216,10 @@ def experiment(exp_id, parent_name, parameters):
         return
 
     # Collect the file output locations from the database (based on the default locations of the services)
-    outputs = db.default_result_output_loc(CURRENT_STAGE, os.getenv("OUTPUT_DIR"))
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
 
-    dataset = pd.read_csv(parent["output"]["data"], sep=',', index_col=0, header=0)
+    # Memory map the feature matrix (csv files from older data prep experiments are parsed)
+    X, labels = feature_matrix.load(parent["output"]["data"], parent["output"].get("index"))
 
     output_file = open(outputs[0], "w")
 
@@ -219,19 +227,35 @@ def experiment(exp_id, parent_name, parameters):
     outputStruct = dict()
 
     # Convert the string classifications to integers
-    factor = pd.factorize(dataset["dx"])
+    factor = pd.factorize(labels)
     # Shows the mapping of sample id to new integer label
-    dataset.dx = factor[0]
+    y = pd.Series(factor[0], index=labels.index, name=labels.name)
     # List of order of the diganosis labels
     definitions = factor[1]
 
-    # Splitting the data into independent and dependent variables
-    X = dataset.iloc[:, 1:]
-    y = dataset.iloc[:, 0]
-
-    predicted_targets, actual_targets = run_classification(X, y, definitions, outputStruct, outputs, parameters)
-
-    plot_confusion_matrix(predicted_targets, actual_targets, outputs[3])
+    # Search the rf_classifier grid for the parameters to use if tuning is enabled
+    tuning = None
+    run_parameters = parameters
+    if parameters.get("tuning"):
+        tuning = rf_tuning.tune(RandomForestClassifier(**parameters["rf_classifier"]),
+                                feature_matrix.values(X), np.asarray(y),
+                                StratifiedKFold(**parameters["k_fold"]), parameters["tuning"],
+                                parameters.get("n_jobs", -1))
+        run_parameters = dict(parameters, rf_classifier=dict(parameters["rf_classifier"], **tuning["best_params"]))
+        outputStruct["tuning"] = dict((key, value) for key, value in tuning.items() if key != "trials")
+
+    # The figures are skipped if disabled by the parameters or the --no-plots argument
+    # The block waits for the figures to be saved, if anything fails the figures not yet started are cancelled
+    with rf_plots.plotRenderer(parameters.get("plots", True) and plots) as renderer:
+        predicted_targets, actual_targets, fitted = run_classification(X, y, definitions, outputStruct, outputs,
+                                                                       run_parameters, renderer)
+
+        # Keep the model fitted on all the samples so new samples can be scored without retraining
+        model = save_model(db, fitted, X, definitions, labels.name, run_parameters, exp_id, parent_name,
+                           output_dir)
+
+        renderer.submit(rf_plots.render_confusion_matrix,
+                        rf_plots.class_confusion_matrix(predicted_targets, actual_targets, definitions), outputs[3])
 
     # Will store the samples precicted and actual classification, in addition do sperating those that were classified
     # incorrectly
@@ -249,30 +273,44 @@ def experiment(exp_id, parent_name, parameters):
 
     # Write the data summary to file
     json.dump(outputStruct, output_file, indent=4)
+    output_file.close()
 
     this_experiment = {
-        "_id": experiment_id,
+        "_id": exp_id,
         "parent": parent_name,
         "stage": CURRENT_STAGE,
         "params": parameters,
         "output": {
             "data": outputs[0],
-            "visuals": outputs[1:]
-        }
+            "visuals": outputs[1:] if renderer.enabled else None
+        },
+        "model": model
     }
+    if tuning is not None:
+        this_experiment["tuning"] = tuning
 
     db.new_experiment(this_experiment)
 
 
-if __name__ == '__main__':
-    db = client.dbClient()
-
-    experiment_id = os.getenv("EXP_ID")
-    parent_experiment = os.getenv("PARENT")
-    params = json.loads(os.getenv("PARAMS"))
-
+def main(db, environment, plots=True):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :param plots: If False no figures are rendered
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
     print("Running " + experiment_id)
-    experiment(experiment_id, parent_experiment, params)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"], plots)
     print("Closing Service")
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train and test a random forest model")
+    parser.add_argument("--no-plots", action="store_true", help="Only write the data summary, no figures")
+
+    db = client.dbClient()
+    main(db, os.environ, not parser.parse_known_args()[0].no_plots)
     db.close()
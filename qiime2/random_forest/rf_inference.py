@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import logging
+import joblib
+import numpy as np
+import pandas as pd
+from pymongoClient import client, feature_matrix
+
+# Scores the samples of a machine learning data prep experiment with a random forest saved by an earlier random forest
+# experiment. The model is loaded once with its arrays memory mapped, the features are aligned to the features the
+# model was trained on (features the model does not know are dropped and missing features are 0) and the samples are
+# predicted a chunk at a time
+
+CURRENT_STAGE = "Random_Forest_Inference"
+
+
+def feature_positions(columns, schema_features):
+    """
+    Find the position of each feature of the model in the new feature matrix
+    :param columns: The features of the new matrix
+    :param schema_features: The features the model was trained on in order
+    :return: The position of each model feature in the new matrix, -1 where it is missing
+    """
+    lookup = pd.Series(np.arange(len(columns)), index=pd.Index([str(column) for column in columns]))
+    lookup = lookup[~lookup.index.duplicated()]
+    return lookup.reindex(schema_features).fillna(-1).astype(int).to_numpy()
+
+
+def predict_chunks(model, features, positions, chunk_size):
+    """
+    Predict the class probabilities of the samples a chunk at a time
+    :param model: The fitted model
+    :param features: The new feature matrix as a (memory mapped) numpy array
+    :param positions: The result of feature_positions
+    :param chunk_size: The number of samples predicted at once
+    :return: The probabilities of each sample
+    """
+    present = positions >= 0
+    probabilities = []
+    for first in range(0, features.shape[0], chunk_size):
+        rows = features[first:first + chunk_size]
+        chunk = np.zeros((rows.shape[0], len(positions)), dtype=np.float32)
+        chunk[:, present] = rows[:, positions[present]]
+        probabilities.append(model.predict_proba(chunk))
+    return np.concatenate(probabilities) if probabilities else np.zeros((0, len(model.classes_)))
+
+
+def experiment(db, exp_id, parent_name, parameters, output_dir, model_name):
+    """
+    Runs the experiment for this service which scores the samples of a data prep experiment with a saved random forest
+    :param db: The dbClient
+    :param exp_id: The id of this experiment (must not already exist in the database)
+    :type exp_id: str
+    :param parent_name: Id of the parent experiment (should be of the correct stage type (data prep)) and must exits
+    :type parent_name: str
+    :param parameters: The parameters for the experiment itself (dictionary of params)
+    :type parameters: dict
+    :param output_dir: The output directory of the experiment
+    :param model_name: The id of the random forest experiment whose model is used
+    :return: NONE
+    """
+
+    # Check if an experiment using this id already exists
+    if db.check_doc_exists({"_id": exp_id}, "experiment"):
+        logging.warning("That experiment_id already exists, please use a new experiment ID")
+        return
+
+    # Get the parent experiment information from the db
+    parent = db.stage_parent_correct(CURRENT_STAGE, parent_name)
+
+    if parent is None:
+        logging.warning("Parent experiment does not exist - Maybe it hasn't finished executing")
+        return
+
+    # The random forest experiment the model was saved by
+    model_experiment = db.get_one({"_id": model_name}, "experiment")
+    if model_experiment is None or model_experiment.get("model") is None:
+        logging.warning("Model experiment does not exist or has no saved model")
+        return
+
+    # Collect the file output locations from the database (based on the default locations of the services)
+    outputs = db.default_result_output_loc(CURRENT_STAGE, output_dir)
+
+    # Load the model once, the arrays of the trees are memory mapped rather than copied into memory
+    start = time.time()
+    model = joblib.load(model_experiment["model"]["model"], mmap_mode="r")
+    with open(model_experiment["model"]["schema"], "r") as f:
+        schema = json.load(f)
+    load_time = time.time() - start
+
+    features, labels = feature_matrix.load(parent["output"]["data"], parent["output"].get("index"))
+    positions = feature_positions(features.columns, schema["features"])
+    missing = int((positions < 0).sum())
+    if missing:
+        logging.warning(str(missing) + " of the " + str(len(positions)) + " model features are missing and set to 0")
+
+    start = time.time()
+    probabilities = predict_chunks(model, np.asarray(features), positions, parameters.get("chunk_size", 1000))
+    predict_time = time.time() - start
+    samples_per_second = len(features) / predict_time if predict_time > 0 else None
+    print("Scored " + str(len(features)) + " samples in " + str(round(predict_time, 2)) + "s (" +
+          str(round(samples_per_second or 0, 1)) + " samples/s)")
+
+    # The model was trained on the integer labels so the classes index the class names of the schema
+    classes = [schema["classes"][label] for label in model.classes_]
+    predictions = pd.DataFrame(probabilities, index=features.index, columns=classes)
+    predictions.insert(0, "predicted", [classes[i] for i in np.argmax(probabilities, axis=1)])
+    predictions.insert(1, "actual", labels.to_numpy())
+    predictions.to_csv(outputs[0], sep="\t")
+
+    this_experiment = {
+        "_id": exp_id,
+        "parent": parent_name,
+        "stage": CURRENT_STAGE,
+        "params": parameters,
+        "model": {"experiment": model_name, "version": model_experiment["model"]["version"]},
+        "output": {
+            "data": outputs[0],
+            "visuals": None
+        },
+        "throughput": {
+            "samples": len(features),
+            "missing_features": missing,
+            "load_time": load_time,
+            "predict_time": predict_time,
+            "samples_per_second": samples_per_second
+        }
+    }
+
+    db.new_experiment(this_experiment)
+
+
+def main(db, environment):
+    """
+    Run the experiment with the settings of the service
+    :param db: The dbClient
+    :param environment: The environment variables of the service
+    :return: NONE
+    """
+    experiment_id = environment["EXP_ID"]
+    print("Running " + experiment_id)
+    experiment(db, experiment_id, environment.get("PARENT"), json.loads(environment["PARAMS"]),
+               environment["OUTPUT_DIR"], environment["MODEL_EXP_ID"])
+    print("Closing Service")
+
+
+if __name__ == '__main__':
+    db = client.dbClient()
+    main(db, os.environ)
+    db.close()
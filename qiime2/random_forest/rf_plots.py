@@ -0,0 +1,211 @@
+import matplotlib
+matplotlib.use("Agg")
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import seaborn as sns
+from matplotlib.figure import Figure
+from sklearn.preprocessing import label_binarize
+from sklearn.metrics import roc_auc_score, roc_curve, auc, precision_recall_curve, average_precision_score, \
+    confusion_matrix
+
+# The figures of the random forest service. The data of each figure is computed separately from rendering it so the
+# summary statistics can be written without the figures. Each figure is drawn on its own Figure with the non interactive
+# Agg backend (rather than the pyplot state machine) and cleared once saved, the figures are rendered in a pool of
+# background processes while the service carries on
+
+COLORS = ['blue', 'red', 'green']
+
+
+def roc_curves(labels, predictions, n_classes):
+    """
+    Calculate the ROC curve of each class and the macro average
+    :param labels: The actual labels of the data classified
+    :param predictions: The predicted probabilities of each class
+    :param n_classes: The number of classes
+    :return: Dictionaries of the false positive rates, true positive rates and areas under the curves keyed by class
+    and "macro"
+    """
+    fpr = dict()
+    tpr = dict()
+    roc_auc = dict()
+    y_bin = label_binarize(labels, classes=list(range(n_classes)))
+
+    for i in range(n_classes):
+        fpr[i], tpr[i], _ = roc_curve(y_bin[:, i], predictions[:, i])
+        roc_auc[i] = auc(fpr[i], tpr[i])
+
+    fpr["macro"], tpr["macro"], _ = roc_curve(y_bin.ravel(), predictions.ravel())
+    roc_auc["macro"] = roc_auc_score(y_bin, predictions, average="macro")
+    return fpr, tpr, roc_auc
+
+
+def precision_recall_curves(labels, predictions, n_classes):
+    """
+    Calculate the precision recall curve of each class and the macro average
+    :param labels: The actual labels of the data classified
+    :param predictions: The predicted probabilities of each class
+    :param n_classes: The number of classes
+    :return: Dictionaries of the precisions, recalls and average precisions keyed by class and "macro"
+    """
+    precision = dict()
+    recall = dict()
+    average_precision = dict()
+    y_bin = label_binarize(labels, classes=list(range(n_classes)))
+    for i in range(n_classes):
+        precision[i], recall[i], _ = precision_recall_curve(y_bin[:, i], predictions[:, i])
+        average_precision[i] = average_precision_score(y_bin[:, i], predictions[:, i])
+
+    precision["macro"], recall["macro"], _ = precision_recall_curve(y_bin.ravel(), predictions.ravel())
+    average_precision["macro"] = average_precision_score(y_bin, predictions, average="macro")
+    return precision, recall, average_precision
+
+
+def class_confusion_matrix(predictions, actual, definitions):
+    """
+    Calculate the confusion matrix of the classifications
+    :param predictions: The predicted labels
+    :param actual: The actual labels
+    :param definitions: The name of each label
+    :return: A dataframe of the confusion matrix with the class names as the rows and columns
+    """
+    return pd.DataFrame(confusion_matrix(actual, predictions, labels=list(range(len(definitions)))),
+                        columns=list(definitions), index=list(definitions))
+
+
+def render_roc(curves, definitions, out_dir):
+    """
+    Render the ROC curves of each class and the macro average
+    :param curves: The result of roc_curves
+    :param definitions: The name of each class
+    :param out_dir: The location of the image
+    :return: NONE
+    """
+    fpr, tpr, roc_auc = curves
+    fig = Figure()
+    ax = fig.subplots()
+
+    # Plot the average of all the classes
+    ax.plot(fpr["macro"], tpr["macro"],
+            label='macro-average ROC curve (area = {0:0.2f})'.format(roc_auc["macro"]),
+            color='navy', linestyle=':', linewidth=4)
+
+    # Plot each class
+    for i, color in zip(range(len(definitions)), COLORS):
+        ax.plot(fpr[i], tpr[i], color=color,
+                label='ROC curve of class {0} (area = {1:0.2f})'.format(definitions[i], roc_auc[i]))
+    ax.plot([0, 1], [0, 1], 'k--')
+    ax.set_xlim([0, 1.0])
+    ax.set_ylim([0.0, 1.05])
+    ax.set_xlabel('False Positive Rate')
+    ax.set_ylabel('True Positive Rate')
+    ax.set_title('Receiver operating characteristic for multi-class data')
+    ax.legend(loc="lower right")
+    fig.savefig(out_dir)
+    fig.clear()
+
+
+def render_prec_recall(curves, definitions, out_dir):
+    """
+    Render the precision recall curves of each class and the macro average
+    :param curves: The result of precision_recall_curves
+    :param definitions: The name of each class
+    :param out_dir: The location of the image
+    :return: NONE
+    """
+    precision, recall, average_precision = curves
+    fig = Figure()
+    ax = fig.subplots()
+
+    # Plot the averaged precision recall of all the classes
+    ax.plot(recall['macro'], precision['macro'],
+            label='macro-average precision score curve (area = {0:0.2f})'.format(average_precision["macro"]),
+            linestyle=':')
+
+    # Plot the precision recall curve of each subclass
+    for i, color in zip(range(len(definitions)), COLORS):
+        ax.plot(recall[i], precision[i], color=color, lw=2,
+                label='Precision-recall for class {0} (area = {1:0.2f})'.format(definitions[i],
+                                                                                 average_precision[i]))
+
+    ax.set_xlabel('Recall')
+    ax.set_ylabel('Precision')
+    ax.set_ylim([0.0, 1.05])
+    ax.set_xlim([0.0, 1.0])
+    ax.legend(loc="lower center", bbox_to_anchor=(0.5, -0.6))
+    fig.subplots_adjust(bottom=0.35)
+    fig.savefig(out_dir)
+    fig.clear()
+
+
+def render_confusion_matrix(cm, out_dir):
+    """
+    Render a confusion matrix as an annotated heatmap
+    :param cm: The result of class_confusion_matrix
+    :param out_dir: The location of the image
+    :return: NONE
+    """
+    fig = Figure()
+    ax = fig.subplots()
+    sns.heatmap(cm, annot=True, ax=ax)
+    fig.savefig(out_dir)
+    fig.clear()
+
+
+class plotRenderer(object):
+    """
+    Renders figures in a pool of background processes, when plotting is disabled the figures are skipped. Used as a
+    context manager the pool is always shut down when the block ends
+    """
+
+    def __init__(self, enabled=True, workers=2):
+        """
+        :param enabled: If False the figures are not rendered
+        :param workers: The number of figures rendered at once
+        """
+        self.enabled = enabled
+        self.executor = ProcessPoolExecutor(workers) if enabled else None
+        self.futures = []
+
+    def submit(self, render, *args):
+        """
+        Render a figure in the background
+        :param render: One of the render functions
+        :param args: The arguments of the render function
+        :return: NONE
+        """
+        if self.enabled:
+            self.futures.append(self.executor.submit(render, *args))
+
+    def close(self):
+        """
+        Wait for the figures to be saved, an error rendering any figure is raised
+        :return: NONE
+        """
+        if self.executor is None:
+            return
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+    def cancel(self):
+        """
+        Cancel the figures not yet started and shut down the pool without waiting for the figures being rendered
+        :return: NONE
+        """
+        if self.executor is None:
+            return
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cancel()
+        return False
@@ -0,0 +1,127 @@
+import time
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
+
+# Stability of the feature importances of the random forest service across the cross validation folds. The forests
+# already trained for each fold are reused, the permutation importance of each feature is measured on the samples held
+# out of the fold and the ranks of the features in each fold are summarised. Only the features used by a split of the
+# forest are permuted (permuting any other feature cannot change the predictions) and the permuted copies of the test
+# samples are predicted together in batches
+
+# The stability parameters used when they are not given in the experiment parameters
+STABILITY_DEFAULTS = {
+    "n_repeats": 5,
+    "top_k": 20,
+    "random_state": None,
+    "batch_mb": 256
+}
+
+
+def stability_parameters(parameters):
+    """
+    Get the stability parameters for the experiment, any not given use the defaults
+    :param parameters: The stability parameters of the experiment
+    :return: The stability parameters
+    """
+    settings = STABILITY_DEFAULTS.copy()
+    settings.update(parameters)
+    return settings
+
+
+def used_features(model):
+    """
+    The features used by at least one split of a forest
+    :param model: The fitted forest
+    :return: The positions of the features
+    """
+    features = np.concatenate([tree.tree_.feature for tree in model.estimators_])
+    return np.unique(features[features >= 0])
+
+
+def balanced_accuracies(labels, predictions, classes):
+    """
+    The balanced accuracy of several sets of predictions of the same samples
+    :param labels: The labels of the samples
+    :param predictions: A 2D array of one set of predictions per row
+    :param classes: The classes in the labels
+    :return: The balanced accuracy of each row
+    """
+    members = (labels[None, :] == classes[:, None]).astype(np.float64)
+    correct = (predictions == labels[None, :]).astype(np.float64)
+    return (correct.dot(members.T) / members.sum(axis=1)).mean(axis=1)
+
+
+def fold_importance(model, features, labels, test, n_repeats, random_state, batch_mb):
+    """
+    The permutation importance of every feature on the test samples of a fold, run in parallel for each fold
+    :param model: The forest fitted on the training samples of the fold
+    :param features: The features of all the samples as a numpy array
+    :param labels: The labels of all the samples as a numpy array
+    :param test: The positions of the test samples
+    :param n_repeats: The number of times each feature is permuted
+    :param random_state: The random state of the permutations
+    :param batch_mb: The size of the permuted copies of the test samples predicted at once
+    :return: The mean decrease in balanced accuracy of each feature, 0 for features the forest does not use
+    """
+    features = features[test]
+    labels = labels[test]
+    n_samples = len(test)
+    classes = np.unique(labels)
+    baseline = balanced_accuracies(labels, model.predict(features)[None, :], classes)[0]
+
+    rng = np.random.RandomState(random_state)
+    importances = np.zeros(features.shape[1])
+    columns = np.repeat(used_features(model), n_repeats)
+    batch = max(1, int(batch_mb * 1024 * 1024 // max(1, features.nbytes)))
+
+    for first in range(0, len(columns), batch):
+        batch_columns = columns[first:first + batch]
+        # One copy of the test samples per permutation, each with one column shuffled
+        stacked = np.tile(features, (len(batch_columns), 1)).reshape(len(batch_columns), n_samples, -1)
+        permutations = np.argsort(rng.rand(len(batch_columns), n_samples), axis=1)
+        stacked[np.arange(len(batch_columns))[:, None], np.arange(n_samples)[None, :], batch_columns[:, None]] = \
+            features[permutations, batch_columns[:, None]]
+
+        predictions = model.predict(stacked.reshape(-1, features.shape[1])).reshape(len(batch_columns), n_samples)
+        decrease = baseline - balanced_accuracies(labels, predictions, classes)
+        np.add.at(importances, batch_columns, decrease / n_repeats)
+    return importances
+
+
+def feature_stability(fold_models, features, labels, feature_names, parameters, n_jobs=-1):
+    """
+    Measure the permutation importance of the features in every fold and summarise their ranks across the folds
+    :param fold_models: The forest of each fold with the positions of its test samples
+    :param features: The features as a numpy array
+    :param labels: The integer labels as a numpy array
+    :param feature_names: The name of each feature
+    :param parameters: The stability parameters of the experiment
+    :param n_jobs: The number of folds measured at once
+    :return: A dataframe of the importance and rank statistics of the features used by any fold, ordered by mean rank
+    """
+    settings = stability_parameters(parameters)
+    start = time.time()
+    seed = settings["random_state"]
+
+    importances = np.array(Parallel(n_jobs=n_jobs)(
+        delayed(fold_importance)(model, features, labels, test, settings["n_repeats"],
+                                 None if seed is None else seed + number, settings["batch_mb"])
+        for number, (model, test) in enumerate(fold_models)))
+
+    # Rank 1 is the most important feature of a fold, ties share the average rank
+    ranks = rankdata(-importances, axis=1)
+    table = pd.DataFrame({
+        "mean_importance": importances.mean(axis=0),
+        "std_importance": importances.std(axis=0),
+        "mean_rank": ranks.mean(axis=0),
+        "median_rank": np.median(ranks, axis=0),
+        "rank_std": ranks.std(axis=0),
+        "top_k_frequency": (ranks <= settings["top_k"]).mean(axis=0)
+    }, index=feature_names)
+
+    table = table[(importances != 0).any(axis=0)].sort_values("mean_rank")
+    print("Measured the stability of " + str(len(table)) + " features over " + str(len(fold_models)) + " folds in " +
+          str(round(time.time() - start, 1)) + "s")
+    return table
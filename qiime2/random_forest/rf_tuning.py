@@ -0,0 +1,197 @@
+import logging
+import time
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold
+
+# Nested cross validated hyperparameter search for the random forest service. The candidates of the rf_classifier grid
+# are compared with successive halving over the number of trees, each rung grows the forests of the remaining candidates
+# with warm_start (the trees of the previous rung are kept) and only the best 1/factor of the candidates go on to the
+# next rung. The outer folds estimate the performance of the search and a final search on all the samples picks the
+# parameters used by the service
+
+# The tuning parameters used when they are not given in the experiment parameters
+TUNING_DEFAULTS = {
+    "grid": {},
+    "inner_folds": 3,
+    "max_trials": 20,
+    "time_limit": None,
+    "min_estimators": 25,
+    "factor": 3,
+    "scoring": "balanced_accuracy",
+    "random_state": None
+}
+
+
+def tuning_parameters(parameters):
+    """
+    Get the tuning parameters for the experiment, any not given use the defaults
+    :param parameters: The tuning parameters of the experiment
+    :return: The tuning parameters
+    """
+    settings = TUNING_DEFAULTS.copy()
+    settings.update(parameters)
+    return settings
+
+
+def candidates(grid, max_trials, random_state):
+    """
+    The parameter combinations to compare, the whole grid if it has at most max_trials combinations otherwise
+    max_trials randomly sampled combinations
+    :param grid: A dictionary of each parameter to a list of its values
+    :param max_trials: The maximum number of combinations
+    :param random_state: The random state of the sampling
+    :return: The list of parameter combinations
+    """
+    if len(ParameterGrid(grid)) <= max_trials:
+        return list(ParameterGrid(grid))
+    return list(ParameterSampler(grid, max_trials, random_state=random_state))
+
+
+def rungs(min_estimators, n_estimators, factor):
+    """
+    The number of trees of each rung of the successive halving
+    :param min_estimators: The number of trees of the first rung
+    :param n_estimators: The number of trees of the last rung
+    :param factor: The growth of the number of trees between rungs
+    :return: The list of the number of trees
+    """
+    estimators = []
+    current = min(min_estimators, n_estimators)
+    while current < n_estimators:
+        estimators.append(current)
+        current *= factor
+    return estimators + [n_estimators]
+
+
+def grow(model, features, labels, train, test, n_estimators, scorer):
+    """
+    Grow a warm started forest to n_estimators trees on the training samples and score it on the test samples, run in
+    parallel for each candidate and fold
+    :param model: The forest (warm_start=True)
+    :param features: The features of all the samples
+    :param labels: The labels of all the samples
+    :param train: The positions of the training samples
+    :param test: The positions of the test samples
+    :param n_estimators: The number of trees
+    :param scorer: The sklearn scorer
+    :return: The grown forest, its score and the fit time
+    """
+    start = time.time()
+    model.set_params(n_estimators=n_estimators)
+    model.fit(features[train], labels[train])
+    fit_time = time.time() - start
+    return model, scorer(model, features[test], labels[test]), fit_time
+
+
+def successive_halving(model, settings, features, labels, splits, deadline, n_jobs, trials, outer_fold):
+    """
+    Compare the candidates of the grid on the splits with successive halving
+    :param model: The unfitted forest with the number of trees of the last rung
+    :param settings: The tuning parameters
+    :param features: The features of all the samples
+    :param labels: The labels of all the samples
+    :param splits: The (train, test) positions of each inner fold
+    :param deadline: The time the search must stop growing forests by or None
+    :param n_jobs: The number of forests grown at once
+    :param trials: The list the result of every candidate at every rung is added to
+    :param outer_fold: The outer fold the search is for, "all" for the search on all the samples
+    :return: The parameters of the best candidate
+    """
+    scorer = get_scorer(settings["scoring"])
+    grid = candidates(settings["grid"], settings["max_trials"], settings["random_state"])
+    models = dict(((candidate, fold), clone(model).set_params(warm_start=True, **grid[candidate]))
+                  for candidate in range(len(grid)) for fold in range(len(splits)))
+
+    alive = list(range(len(grid)))
+    for rung, n_estimators in enumerate(rungs(settings["min_estimators"], model.get_params()["n_estimators"],
+                                              settings["factor"])):
+        if rung > 0 and deadline is not None and time.time() > deadline:
+            logging.warning("Tuning time limit reached, stopping the search of outer fold " + str(outer_fold) +
+                            " at " + str(len(alive)) + " candidates")
+            break
+
+        jobs = [(candidate, fold) for candidate in alive for fold in range(len(splits))]
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(grow)(models[job], features, labels, splits[job[1]][0], splits[job[1]][1], n_estimators, scorer)
+            for job in jobs)
+
+        scores = dict((candidate, []) for candidate in alive)
+        fit_times = dict((candidate, 0.0) for candidate in alive)
+        for job, (grown, score, fit_time) in zip(jobs, results):
+            models[job] = grown
+            scores[job[0]].append(score)
+            fit_times[job[0]] += fit_time
+
+        for candidate in alive:
+            trials.append({"outer_fold": outer_fold, "rung": rung, "candidate": candidate,
+                           "params": grid[candidate], "n_estimators": n_estimators,
+                           "score": float(np.mean(scores[candidate])), "fit_time": fit_times[candidate]})
+
+        # Keep the best 1/factor of the candidates, the forests of the others are no longer needed
+        alive.sort(key=lambda candidate: np.mean(scores[candidate]), reverse=True)
+        for candidate in alive[max(1, len(alive) // settings["factor"]):]:
+            for fold in range(len(splits)):
+                del models[(candidate, fold)]
+        alive = alive[:max(1, len(alive) // settings["factor"])]
+        if len(alive) == 1:
+            break
+
+    return grid[alive[0]]
+
+
+def tune(model, features, labels, cv, parameters, n_jobs=-1):
+    """
+    Run the nested cross validated search. For each outer fold the candidates are compared on inner folds of its
+    training samples and the best is scored on its test samples, then the candidates are compared on folds of all the
+    samples to pick the parameters to use
+    :param model: The unfitted forest, its parameters are the defaults of the candidates
+    :param features: The features as a numpy array
+    :param labels: The integer labels as a numpy array
+    :param cv: The outer cross validation splitter
+    :param parameters: The tuning parameters of the experiment
+    :param n_jobs: The number of forests grown at once
+    :return: A summary of the search with the best parameters, the outer fold scores and every trial
+    """
+    settings = tuning_parameters(parameters)
+    start = time.time()
+    deadline = start + settings["time_limit"] if settings["time_limit"] else None
+    inner_cv = StratifiedKFold(settings["inner_folds"], shuffle=True, random_state=settings["random_state"])
+    scorer = get_scorer(settings["scoring"])
+
+    # The splits are made once and shared by every search
+    outer_splits = list(cv.split(features, labels))
+    inner_splits = [[(train[inner_train], train[inner_test])
+                     for inner_train, inner_test in inner_cv.split(features[train], labels[train])]
+                    for train, _ in outer_splits]
+
+    trials = []
+    outer_folds = []
+    for number, ((train, test), splits) in enumerate(zip(outer_splits, inner_splits)):
+        if deadline is not None and time.time() > deadline:
+            logging.warning("Tuning time limit reached, skipping the remaining outer folds")
+            break
+        best = successive_halving(model, settings, features, labels, splits, deadline, n_jobs, trials, number)
+
+        fold_start = time.time()
+        fitted = clone(model).set_params(**best).fit(features[train], labels[train])
+        outer_folds.append({"fold": number, "params": best,
+                            "score": float(scorer(fitted, features[test], labels[test])),
+                            "fit_time": time.time() - fold_start})
+        print("Outer fold " + str(number) + ": " + settings["scoring"] + " " + str(round(outer_folds[-1]["score"], 3)) +
+              " with " + str(best))
+
+    all_splits = list(inner_cv.split(features, labels))
+    best = successive_halving(model, settings, features, labels, all_splits, deadline, n_jobs, trials, "all")
+    print("Tuned in " + str(round(time.time() - start, 1)) + "s (" + str(len(trials)) + " trials), using " + str(best))
+
+    return {
+        "best_params": best,
+        "scoring": settings["scoring"],
+        "outer_folds": outer_folds,
+        "outer_score": float(np.mean([fold["score"] for fold in outer_folds])) if outer_folds else None,
+        "trials": trials,
+        "time": time.time() - start
+    }
@@ -0,0 +1,612 @@
+import argparse
+import ast
+import contextlib
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Runs the services of a workflow as soon as the services they depend on have finished, rather than strictly one after
+# another. The dependencies are read from the service definitions (the parent of each service and any other services it
+# requires) so services on independent branches, such as the metadata creator and data import or the phylogenetic tree
+# and frequency tables, run at the same time.
+# Services are run as local processes by default, inside the scheduler process (keeping the qiime2 artifacts in memory
+# between services) or as the docker containers defined in docker-compose.yml
+
+QIIME_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(QIIME_DIR)
+SERVICE_DEFS = os.path.join(ROOT_DIR, "mongo_service", "db_init", "service_defs.json")
+
+# How each service is run: the docker-compose service, the script inside the service folder and the environment
+# variables of the service mapped to the variables of the workflow .env file (as in docker-compose.yml)
+STAGES = {
+    "Manifest_Creator": {
+        "service": "manifest_creator", "script": "manifest_creator/manifest_creator.py",
+        "environment": {"EXP_ID": "MC_EXP_ID", "SAMPLES": "MC_SAMPLES", "OUTPUT_DIR": "MC_OUT_DIR",
+                        "PARENT": "MD_EXP_ID", "BASE_EXP_ID": "MC_BASE_EXP_ID"}
+    },
+    "Metadata_Creator": {
+        "service": "metadata_creator", "script": "metadata_creator/metadata_creator.py",
+        "environment": {"EXP_ID": "MD_EXP_ID", "PARENT": "MC_EXP_ID", "OUTPUT_DIR": "MD_OUT_DIR",
+                        "PARAMS": "MD_PARAMS"}
+    },
+    "Data_Import": {
+        "service": "qiime_data_import", "script": "data_import/qiime_data_import.py",
+        "environment": {"EXP_ID": "DI_EXP_ID", "PARENT": "MC_EXP_ID", "OUTPUT_DIR": "DI_OUT_DIR",
+                        "PARAMS": "DI_PARAMS"}
+    },
+    "Quality_Analysis": {
+        "service": "qiime_qa", "script": "quality_analysis/qiime_qa.py",
+        "environment": {"EXP_ID": "QA_EXP_ID", "PARENT": "DI_EXP_ID", "OUTPUT_DIR": "QA_OUT_DIR",
+                        "PARAMS": "QA_PARAMS"}
+    },
+    "Feature_Classification": {
+        "service": "qiime_classifier", "script": "feature_classification/feature_classification.py",
+        "environment": {"EXP_ID": "TC_EXP_ID", "PARENT": "QA_EXP_ID", "OUTPUT_DIR": "TC_OUT_DIR",
+                        "PARAMS": "TC_PARAMS"}
+    },
+    "Rooted_Tree": {
+        "service": "qiime_phylogeny_tree", "script": "phylogenic_tree/rooted_tree.py",
+        "environment": {"EXP_ID": "PT_EXP_ID", "PARENT": "QA_EXP_ID", "OUTPUT_DIR": "PT_OUT_DIR",
+                        "PARAMS": "PT_PARAMS"}
+    },
+    "Frequency_Tables": {
+        "service": "qiime_frequency_tables", "script": "frequency_tables/frequency_tables.py",
+        "environment": {"EXP_ID": "FT_EXP_ID", "PARENT": "TC_EXP_ID", "OUTPUT_DIR": "FT_OUT_DIR",
+                        "PARAMS": "FT_PARAMS"}
+    },
+    "Diversity": {
+        "service": "qiime_diversity", "script": "diversity/diversity.py",
+        "environment": {"EXP_ID": "AD_EXP_ID", "PARENT": "FT_EXP_ID", "OUTPUT_DIR": "AD_OUT_DIR",
+                        "PARAMS": "AD_PARAMS"}
+    },
+    "Freq_To_Biom": {
+        "service": "realtive_frequency_to_biom", "script": "frequency_tables/frequency_artifact_to_biom.py",
+        "environment": {"EXP_ID": "FTB_EXP_ID", "PARENT": "FT_EXP_ID", "OUTPUT_DIR": "FTB_OUT_DIR",
+                        "PARAMS": "FTB_PARAMS"}
+    },
+    "Lefse": {
+        "service": "lefse", "script": "lefse/lefse.py",
+        "environment": {"EXP_ID": "LA_EXP_ID", "PARENT": "FTB_EXP_ID", "OUTPUT_DIR": "LA_OUT_DIR",
+                        "PARAMS": "LA_PARAMS"}
+    },
+    "Machine_Learning_Data_Prep": {
+        "service": "data_prep", "script": "ml_data_prep/data_prep.py",
+        "environment": {"EXP_ID": "DP_EXP_ID", "OUTPUT_DIR": "DP_OUT_DIR", "PARENT_NAMES": "DP_PARENTS",
+                        "PARAMS": "DP_PARAMS"}
+    },
+    "Random_Forest": {
+        "service": "random_forest", "script": "random_forest/random_forest.py",
+        "environment": {"EXP_ID": "RF_EXP_ID", "PARENT": "DP_EXP_ID", "OUTPUT_DIR": "RF_OUT_DIR",
+                        "PARAMS": "RF_PARAMS"}
+    },
+    "Random_Forest_Inference": {
+        "service": "rf_inference", "script": "random_forest/rf_inference.py",
+        "environment": {"EXP_ID": "RI_EXP_ID", "PARENT": "RI_PARENT", "MODEL_EXP_ID": "RI_MODEL_EXP_ID",
+                        "OUTPUT_DIR": "RI_OUT_DIR", "PARAMS": "RI_PARAMS"}
+    }
+}
+
+# Stages only run by default when the variable of their input is set to something other than the default input
+# (inference of the model on the data it was trained on tells you nothing)
+OPTIONAL_STAGES = {"Random_Forest_Inference": ("RI_PARENT", "DP_EXP_ID")}
+
+# Stages that can't be run inside the scheduler process (lefse runs on python 2)
+SUBPROCESS_STAGES = ["Lefse"]
+
+ENV_ASSIGNMENT = re.compile(r'[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*')
+ENV_REFERENCE = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+
+def read_env_file(env_file):
+    """
+    Read a workflow .env file, values may be quoted, span several lines and reference earlier values with ${NAME}
+    :param env_file: The location of the .env file
+    :return: A dictionary of the variables
+    """
+    with open(env_file, "r") as f:
+        text = f.read()
+
+    values = {}
+    pos = 0
+    while pos < len(text):
+        line_end = text.find("\n", pos)
+        line_end = len(text) if line_end == -1 else line_end
+        line = text[pos:line_end].strip()
+        match = ENV_ASSIGNMENT.match(text, pos)
+        if not line or line.startswith("#") or match is None:
+            pos = line_end + 1
+            continue
+
+        name = match.group(1)
+        pos = match.end()
+        if text[pos:pos + 1] in ("'", '"'):
+            # Quoted values run until the closing quote
+            end = text.index(text[pos], pos + 1)
+            value = text[pos + 1:end]
+            pos = end + 1
+        else:
+            # Unquoted values (which may be empty) run to the end of the line
+            end = text.find("\n", pos)
+            end = len(text) if end == -1 else end
+            value = text[pos:end].strip()
+            pos = end
+        values[name] = ENV_REFERENCE.sub(lambda ref: values.get(ref.group(1), os.getenv(ref.group(1), "")), value)
+    return values
+
+
+def stage_environment(stage, env_values):
+    """
+    The environment variables of a service for the workflow
+    :param stage: The name of the stage
+    :param env_values: The variables of the workflow .env file
+    :return: A dictionary of environment variables
+    """
+    return dict((name, env_values.get(variable, "")) for name, variable in STAGES[stage]["environment"].items())
+
+
+def build_graph(env_values, stages=None, service_defs=SERVICE_DEFS):
+    """
+    Build the dependency graph of the workflow from the service definitions. Each stage depends on its parent stage
+    and the stages listed in "requires". The machine learning data prep stage also depends on the stages of the
+    experiments listed in its parents
+    :param env_values: The variables of the workflow .env file
+    :param stages: The stages to run, all the stages if not given
+    :param service_defs: The location of the service definitions
+    :return: A dictionary of each stage to the set of stages it depends on
+    """
+    with open(service_defs, "r") as f:
+        definitions = dict((service["_id"], service) for service in json.load(f))
+
+    if stages is None:
+        stages = [stage for stage in definitions if stage in STAGES and optional_stage_enabled(stage, env_values)]
+
+    # Experiment ids of the workflow to the stage that creates them
+    experiment_stages = dict((env_values.get(STAGES[stage]["environment"]["EXP_ID"]), stage) for stage in STAGES)
+
+    graph = {}
+    for stage in stages:
+        definition = definitions[stage]
+        dependencies = set(definition.get("requires") or [])
+        if definition.get("parent"):
+            dependencies.add(definition["parent"])
+        parent_names = stage_environment(stage, env_values).get("PARENT_NAMES")
+        if parent_names:
+            for item in ast.literal_eval(parent_names):
+                if item[0] in experiment_stages:
+                    dependencies.add(experiment_stages[item[0]])
+        # Stages that are not being run are assumed to have already finished
+        graph[stage] = set(dependency for dependency in dependencies if dependency in stages)
+
+    # Raises if the dependencies contain a cycle
+    topological_order(graph)
+    return graph
+
+
+def optional_stage_enabled(stage, env_values):
+    """
+    Check if a stage is part of the default workflow, optional stages are only included when their input is set to
+    something other than the default input
+    :param stage: The name of the stage
+    :param env_values: The variables of the workflow .env file
+    :return: True if the stage should be run
+    """
+    if stage not in OPTIONAL_STAGES:
+        return True
+    variable, default = OPTIONAL_STAGES[stage]
+    value = env_values.get(variable, "")
+    return value != "" and value != env_values.get(default, "")
+
+
+def topological_order(graph):
+    """
+    Order the stages so every stage comes after the stages it depends on
+    :param graph: A dictionary of each stage to the set of stages it depends on
+    :return: The list of stages
+    """
+    order = []
+    remaining = dict((stage, set(dependencies)) for stage, dependencies in graph.items())
+    while remaining:
+        ready = sorted(stage for stage, dependencies in remaining.items() if not dependencies - set(order))
+        if not ready:
+            raise ValueError("The stage dependencies contain a cycle or a missing stage: " +
+                             ", ".join(sorted(remaining)))
+        for stage in ready:
+            del remaining[stage]
+        order.extend(ready)
+    return order
+
+
+def dependents(graph, stage):
+    """
+    Find every stage that depends on a stage, directly or through other stages
+    :param graph: A dictionary of each stage to the set of stages it depends on
+    :param stage: The stage
+    :return: The set of stages
+    """
+    found = set()
+    new = set([stage])
+    while new:
+        new = set(other for other, dependencies in graph.items() if dependencies & new) - found
+        found |= new
+    return found
+
+
+def critical_path(graph, results):
+    """
+    Find the longest chain of dependent stages by wall time, this is the shortest the workflow could take with
+    unlimited workers
+    :param graph: The dependency graph
+    :param results: The results of the stages that ran
+    :return: The length of the path in seconds and the stages on the path
+    """
+    finish = {}
+    previous = {}
+
+    def longest(stage):
+        if stage not in finish:
+            best = None
+            for dependency in graph[stage]:
+                if best is None or longest(dependency) > finish[best]:
+                    best = dependency
+            previous[stage] = best
+            own = results.get(stage, {}).get("wall_time", 0.0)
+            finish[stage] = own + (finish[best] if best is not None else 0.0)
+        return finish[stage]
+
+    if not graph:
+        return 0.0, []
+    end = max(graph, key=longest)
+    path = []
+    stage = end
+    while stage is not None:
+        path.append(stage)
+        stage = previous[stage]
+    return finish[end], list(reversed(path))
+
+
+def run_workflow(graph, run_stage, max_workers=2):
+    """
+    Run every stage of the graph once all of its dependencies have finished successfully, running up to max_workers
+    stages at once. Stages that depend on a failed stage are skipped
+    :param graph: A dictionary of each stage to the set of stages it depends on
+    :param run_stage: A function that runs a stage and returns its exit code
+    :param max_workers: The maximum number of stages running at once
+    :return: A dictionary of the result of every stage (status, exit code, start, end and wall time)
+    """
+    results = {}
+    remaining = dict((stage, set(dependencies)) for stage, dependencies in graph.items())
+    workflow_start = time.time()
+
+    def timed(stage):
+        start = time.time()
+        print("Starting " + stage)
+        returncode = run_stage(stage)
+        end = time.time()
+        return {"status": "success" if returncode == 0 else "failed", "returncode": returncode,
+                "start": start - workflow_start, "end": end - workflow_start, "wall_time": end - start}
+
+    def skip_dependents(failed):
+        for stage, dependencies in list(remaining.items()):
+            if failed in dependencies:
+                del remaining[stage]
+                results[stage] = {"status": "skipped", "reason": failed + " did not succeed"}
+                print("Skipping " + stage + " as " + failed + " did not succeed")
+                skip_dependents(stage)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while remaining or running:
+            for stage in [stage for stage, dependencies in remaining.items() if not dependencies]:
+                del remaining[stage]
+                running[executor.submit(timed, stage)] = stage
+            if not running:
+                # Nothing is running and nothing can start so the remaining stages would wait forever
+                raise RuntimeError("No stage can be started, the remaining stages depend on stages that will never "
+                                   "run: " + ", ".join(sorted(remaining)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage] = future.result()
+                except Exception as err:
+                    results[stage] = {"status": "failed", "error": str(err)}
+                print("Finished " + stage + " (" + results[stage]["status"] + ")")
+                if results[stage]["status"] == "success":
+                    for dependencies in remaining.values():
+                        dependencies.discard(stage)
+                else:
+                    skip_dependents(stage)
+    return results
+
+
+class localRunner:
+    """
+    Runs each stage as a local python process, the output of each stage is written to a log file
+    """
+    def __init__(self, env_values, workspace, data_dir=os.path.join(ROOT_DIR, "PipelineOutput")):
+        """
+        :param env_values: The variables of the workflow .env file
+        :param workspace: The working directory of the stages, the stage output directories (./data/...) are
+        relative to it
+        :param data_dir: The directory the stages store their results in (mounted at ./data in the containers)
+        """
+        self.env_values = env_values
+        self.workspace = os.path.abspath(workspace)
+        self.logs = os.path.join(self.workspace, "logs")
+        if not os.path.exists(self.logs):
+            os.makedirs(self.logs)
+        data_link = os.path.join(self.workspace, "data")
+        if not os.path.exists(data_link):
+            os.symlink(os.path.abspath(data_dir), data_link)
+
+    def local_environment(self):
+        """
+        The environment variables that point the stages at the local database and folders rather than the ones inside
+        the containers, any already set in the environment are kept
+        :return: A dictionary of environment variables
+        """
+        return {
+            "MONGO_HOST": "localhost",
+            # The sample file locations (./data/...) are relative to the workspace like the data import container
+            "DATA_IMPORT_DIR": self.workspace,
+            "CLASSIFIER_DIR": os.path.join(QIIME_DIR, "sklearn_classifier")
+        }
+
+    def __call__(self, stage):
+        script = os.path.join(QIIME_DIR, STAGES[stage]["script"])
+        env = dict(os.environ)
+        env.update(stage_environment(stage, self.env_values))
+        for name, value in self.local_environment().items():
+            env.setdefault(name, value)
+        env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(script),
+                                             os.path.join(ROOT_DIR, "mongo_service", "db_interface"),
+                                             env.get("PYTHONPATH", "")])
+        with open(os.path.join(self.logs, stage + ".log"), "w") as log:
+            return subprocess.call([sys.executable, "-u", script], cwd=self.workspace, env=env, stdout=log,
+                                   stderr=subprocess.STDOUT)
+
+
+class stageOutput(object):
+    """
+    A stream that writes the output of each thread running an in-process stage to the log of that stage, the output of
+    every other thread (such as the scheduler) goes to the original stream
+    """
+    def __init__(self, stream):
+        """
+        :param stream: The original stream (sys.stdout or sys.stderr)
+        """
+        self.stream = stream
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def capture(self, log):
+        """
+        Write the output of the current thread to a log file until the block ends
+        :param log: The open log file
+        """
+        self.local.log = log
+        try:
+            yield
+        finally:
+            self.local.log = None
+
+    def target(self):
+        return getattr(self.local, "log", None) or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class inProcessRunner(localRunner):
+    """
+    Runs each stage inside this process so the qiime2 artifacts created by a stage are passed to the stages that use
+    them through the artifact store instead of being read back from disk, with the files written in the background.
+    Each stage module is imported and its main() is called with the shared dbClient and the environment of the stage.
+    The stages share the working directory so only one stage runs in the process at a time, stages that can't be
+    imported (lefse) are run as a separate process. The artifacts a stage saved or loaded are released from memory once
+    every stage that depends on it has finished
+    """
+    def __init__(self, env_values, workspace, graph, data_dir=os.path.join(ROOT_DIR, "PipelineOutput")):
+        """
+        :param env_values: The variables of the workflow .env file
+        :param workspace: The working directory of the stages
+        :param graph: The dependency graph of the workflow, used to know when an artifact is no longer needed
+        :param data_dir: The directory the stages store their results in
+        """
+        localRunner.__init__(self, env_values, workspace, data_dir)
+        sys.path.insert(0, os.path.join(ROOT_DIR, "mongo_service", "db_interface"))
+        for name, value in self.local_environment().items():
+            os.environ.setdefault(name, value)
+        os.environ.setdefault("ARTIFACT_STORE_ASYNC", "on")
+        # The stage output locations are relative to the workspace
+        os.chdir(self.workspace)
+        self.lock = threading.Lock()
+        # The output of each stage goes to its log without capturing what other threads print at the same time
+        self.stdout = sys.stdout = stageOutput(sys.stdout)
+        self.stderr = sys.stderr = stageOutput(sys.stderr)
+
+        from pymongoClient import artifact_store, client
+        self.artifact_store = artifact_store
+        self.db = client.dbClient()
+        self.dependents = dict((stage, dependents(graph, stage)) for stage in graph)
+        self.finished = set()
+        # Location of each artifact in memory to the first stage that held it
+        self.holders = {}
+
+    def __call__(self, stage):
+        if stage in SUBPROCESS_STAGES:
+            # A separate process can only read the artifacts once they are on disk
+            self.artifact_store.flush()
+            returncode = localRunner.__call__(self, stage)
+            self.release_artifacts(stage, returncode == 0)
+            return returncode
+
+        script = os.path.join(QIIME_DIR, STAGES[stage]["script"])
+        returncode = 1
+        with self.lock:
+            sys.path.insert(0, os.path.dirname(script))
+            try:
+                with open(os.path.join(self.logs, stage + ".log"), "w") as log:
+                    with self.stdout.capture(log), self.stderr.capture(log):
+                        try:
+                            self.load_stage(stage, script).main(self.db, stage_environment(stage, self.env_values))
+                            returncode = 0
+                        except Exception:
+                            traceback.print_exc()
+            finally:
+                sys.path.remove(os.path.dirname(script))
+                self.release_artifacts(stage, returncode == 0)
+        return returncode
+
+    def load_stage(self, stage, script):
+        """
+        Import the module of a stage from its script
+        :param stage: The name of the stage
+        :param script: The location of the script
+        :return: The module
+        """
+        spec = importlib.util.spec_from_file_location("stage_" + stage.lower(), script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def release_artifacts(self, stage, succeeded):
+        """
+        Release the artifacts no stage still to run can use, those held by stages whose dependents have all finished.
+        The dependents of a failed stage are skipped so they count as finished
+        :param stage: The stage that finished
+        :param succeeded: If the stage succeeded
+        :return: NONE
+        """
+        self.finished.add(stage)
+        if not succeeded:
+            self.finished.update(self.dependents.get(stage, ()))
+        for path in self.artifact_store.held():
+            self.holders.setdefault(path, stage)
+        released = [path for path, holder in self.holders.items()
+                    if self.dependents.get(holder, set()) <= self.finished]
+        for path in released:
+            del self.holders[path]
+        self.artifact_store.release(released)
+
+    def close(self):
+        """
+        Wait for the artifacts to be written to disk, release them and restore the output streams
+        :return: NONE
+        """
+        try:
+            self.artifact_store.clear()
+            self.db.close()
+        finally:
+            sys.stdout = self.stdout.stream
+            sys.stderr = self.stderr.stream
+
+
+class dockerRunner:
+    """
+    Runs each stage as its docker container from docker-compose.yml
+    """
+    def __init__(self, env_file):
+        """
+        :param env_file: The workflow .env file
+        """
+        self.compose = ["docker-compose", "--env-file", env_file]
+        # docker-compose calls are serialised, only the containers run at the same time
+        self.lock = threading.Lock()
+
+    def prepare(self):
+        """
+        Build the containers, start the database and load the service definitions
+        :return: NONE
+        """
+        subprocess.check_call(self.compose + ["build"], cwd=QIIME_DIR)
+        subprocess.check_call(self.compose + ["up", "-d", "database"], cwd=QIIME_DIR)
+        subprocess.check_call(self.compose + ["up", "database_init"], cwd=QIIME_DIR)
+
+    def __call__(self, stage):
+        service = STAGES[stage]["service"]
+        with self.lock:
+            subprocess.check_call(self.compose + ["up", "-d", "--no-deps", service], cwd=QIIME_DIR)
+        # The container name is the same as the service name, docker wait prints its exit code
+        output = subprocess.check_output(["docker", "wait", service])
+        return int(output.decode().strip())
+
+    def stop(self):
+        subprocess.call(self.compose + ["stop"], cwd=QIIME_DIR)
+
+
+def print_summary(graph, results, total):
+    """
+    Print the wall time of every stage and the critical path of the workflow
+    :param graph: The dependency graph
+    :param results: The results of the stages
+    :param total: The wall time of the whole workflow
+    :return: The length of the critical path and the stages on it
+    """
+    length, path = critical_path(graph, results)
+    for stage in sorted(results, key=lambda name: results[name].get("start", float("inf"))):
+        result = results[stage]
+        wall_time = str(round(result["wall_time"], 1)) + "s" if "wall_time" in result else "-"
+        print("{0:<28} {1:<8} {2}".format(stage, result["status"], wall_time))
+    print("Workflow wall time: " + str(round(total, 1)) + "s")
+    print("Critical path: " + str(round(length, 1)) + "s (" + " -> ".join(path) + ")")
+    return length, path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the services of a workflow in dependency order")
+    parser.add_argument("--env-file", required=True, help="The workflow .env file, e.g. .env.newsilva")
+    parser.add_argument("--runner", choices=["local", "in-process", "docker"], default="local")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SCHEDULER_WORKERS", 2)),
+                        help="The maximum number of stages run at once")
+    parser.add_argument("--stages", nargs="*", help="Only run these stages, the others are assumed to be complete")
+    parser.add_argument("--workspace", default=os.path.join(QIIME_DIR, "local_run"),
+                        help="Working directory for the local runner")
+    parser.add_argument("--report", help="Write the stage timings and critical path to this json file")
+    args = parser.parse_args()
+
+    env_file = args.env_file
+    if not os.path.exists(env_file):
+        env_file = os.path.join(QIIME_DIR, env_file)
+    env_values = read_env_file(env_file)
+    graph = build_graph(env_values, args.stages)
+
+    if args.runner == "docker":
+        runner = dockerRunner(os.path.abspath(env_file))
+        runner.prepare()
+    elif args.runner == "in-process":
+        runner = inProcessRunner(env_values, args.workspace, graph)
+    else:
+        runner = localRunner(env_values, args.workspace)
+
+    start = time.time()
+    try:
+        results = run_workflow(graph, runner, args.workers)
+    finally:
+        if args.runner == "docker":
+            runner.stop()
+        elif args.runner == "in-process":
+            runner.close()
+    total = time.time() - start
+    length, path = print_summary(graph, results, total)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"stages": results, "wall_time": total, "critical_path": {"length": length, "stages": path}},
+                      f, indent=4)
+
+    sys.exit(0 if all(result["status"] == "success" for result in results.values()) else 1)
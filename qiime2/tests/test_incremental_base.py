@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                "mongo_service", "db_interface"))
+
+from pymongoClient import client
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class incrementalBaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo_client = client.MongoClient
+        client.MongoClient = mongomock.MongoClient
+        self.db = client.dbClient()
+        self.db.new_experiment({"_id": "base_import", "stage": "Data_Import", "parent": "base_manifest"})
+        self.db.new_experiment({"_id": "base_qa", "stage": "Quality_Analysis", "parent": "base_import",
+                                "params": {"level": 6}})
+
+    def tearDown(self):
+        self.db.close()
+        client.MongoClient = self.mongo_client
+
+    def test_no_delta_has_no_base(self):
+        self.assertIsNone(self.db.get_incremental_base("Quality_Analysis", {"_id": "import"}))
+
+    def test_latest_matching_base(self):
+        parent = {"_id": "import", "sample_delta": {"base": "base_import", "added": ["S1"], "removed": []}}
+        self.assertEqual(self.db.get_incremental_base("Quality_Analysis", parent)["_id"], "base_qa")
+        self.assertIsNone(self.db.get_incremental_base("Quality_Analysis", parent, {"params.level": 7}))
+
+    def test_partial_parent_without_base_raises(self):
+        # The import only holds the added samples but nothing was denoised from the base import
+        self.db.new_experiment({"_id": "other_import", "stage": "Data_Import", "parent": "other_manifest"})
+        parent = {"_id": "import", "sample_delta": {"base": "other_import", "added": ["S1"], "removed": [],
+                                                    "partial": True}}
+        with self.assertRaises(ValueError):
+            self.db.get_incremental_base("Quality_Analysis", parent)
+
+    def test_complete_parent_without_base_processes_every_sample(self):
+        parent = {"_id": "qa", "sample_delta": {"base": "base_qa", "added": ["S1"], "removed": []}}
+        self.assertIsNone(self.db.get_incremental_base("Feature_Classification", parent))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stage_scheduler
+from pymongo import MongoClient, errors
+
+
+def local_database():
+    """
+    Connect to the database the local runner uses, None if it can't be reached
+    """
+    mongo = MongoClient(os.getenv("MONGO_HOST", "localhost"), int(os.getenv("MONGO_PORT", 27017)),
+                        serverSelectionTimeoutMS=1000)
+    try:
+        mongo.admin.command("ping")
+        return mongo
+    except errors.PyMongoError:
+        mongo.close()
+        return None
+
+
+class localRunnerTest(unittest.TestCase):
+    """
+    Runs the manifest creator as a local process against a database on localhost (skipped if there isn't one)
+    """
+
+    def setUp(self):
+        self.mongo = local_database()
+        if self.mongo is None:
+            self.skipTest("no database reachable on localhost")
+
+        self.database_name = "scheduler_test_" + str(os.getpid())
+        self.previous_database = os.environ.get("MONGO_DATABASE")
+        os.environ["MONGO_DATABASE"] = self.database_name
+        database = self.mongo[self.database_name]
+        with open(stage_scheduler.SERVICE_DEFS, "r") as f:
+            database["services"].insert_many(json.load(f))
+        database["samples"].insert_one({"run_accession": "SRR1", "sample_alias": "S1",
+                                        "file_location": "./data/ena/SRR1"})
+        database["metadata"].insert_one({"sample": "S1", "dx": "CD"})
+
+        self.workspace = tempfile.mkdtemp()
+        self.data_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.data_dir, "ena", "SRR1"))
+        open(os.path.join(self.data_dir, "ena", "SRR1", "SRR1.fastq.gz"), "w").close()
+
+    def tearDown(self):
+        if self.mongo is None:
+            return
+        self.mongo.drop_database(self.database_name)
+        self.mongo.close()
+        if self.previous_database is None:
+            os.environ.pop("MONGO_DATABASE", None)
+        else:
+            os.environ["MONGO_DATABASE"] = self.previous_database
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def test_manifest_points_at_local_files(self):
+        env_values = {"MC_EXP_ID": "test_manifest", "MC_SAMPLES": "{}", "MC_OUT_DIR": "./data/test/manifest",
+                      "MD_EXP_ID": "test_metadata"}
+        runner = stage_scheduler.localRunner(env_values, self.workspace, self.data_dir)
+        returncode = runner("Manifest_Creator")
+        with open(os.path.join(self.workspace, "logs", "Manifest_Creator.log"), "r") as log:
+            self.assertEqual(returncode, 0, log.read())
+
+        record = self.mongo[self.database_name]["experiment"].find_one({"_id": "test_manifest"})
+        self.assertEqual(record["samples"], 1)
+        with open(os.path.join(self.workspace, record["output"]["data"]), "r") as f:
+            lines = f.read().splitlines()[1:]
+        self.assertEqual(len(lines), 1)
+        sample_id, location = lines[0].split("\t")
+        self.assertEqual(sample_id, "SRR1")
+        self.assertTrue(os.path.exists(location), location)
+
+
+if __name__ == '__main__':
+    unittest.main()
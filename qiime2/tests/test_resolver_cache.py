@@ -0,0 +1,57 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                "mongo_service", "db_interface"))
+
+from pymongoClient import client
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class resolverCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo_client = client.MongoClient
+        client.MongoClient = mongomock.MongoClient
+        self.db = client.dbClient()
+        self.cache_dir = tempfile.mkdtemp()
+        self.db.bulk_upsert([{"run_accession": "SRR1", "sample_alias": "S1"}], "run_accession", "samples")
+        self.db.bulk_upsert([{"sample": "S1", "dx": "CD"}], "sample", "metadata")
+
+    def tearDown(self):
+        self.db.close()
+        client.MongoClient = self.mongo_client
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def dx(self):
+        return self.db.resolve_samples(["SRR1"], ["dx"], self.cache_dir)["SRR1"]["metadata"]["dx"]
+
+    def test_cached_until_metadata_changes(self):
+        self.assertEqual(self.dx(), "CD")
+        # Changed without the dbClient, the cached result is still used
+        self.db.database["metadata"].update_one({"sample": "S1"}, {"$set": {"dx": "UC"}})
+        self.assertEqual(self.dx(), "CD")
+        # The metadata ingest writes through the dbClient which invalidates the cached result
+        self.db.bulk_upsert([{"sample": "S1", "dx": "nonIBD"}], "sample", "metadata")
+        self.assertEqual(self.dx(), "nonIBD")
+
+    def test_expired_results_are_not_used(self):
+        self.assertEqual(self.dx(), "CD")
+        self.db.database["metadata"].update_one({"sample": "S1"}, {"$set": {"dx": "UC"}})
+        cache_file = self.db.resolver_cache_file(["SRR1"], self.cache_dir)
+        expired = time.time() - 25 * 3600
+        os.utime(cache_file, (expired, expired))
+        self.assertEqual(self.dx(), "UC")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stage_scheduler
+
+
+class readEnvFileTest(unittest.TestCase):
+
+    def read(self, text):
+        with tempfile.NamedTemporaryFile("w", suffix=".env", delete=False) as f:
+            f.write(text)
+        try:
+            return stage_scheduler.read_env_file(f.name)
+        finally:
+            os.remove(f.name)
+
+    def test_empty_assignment_followed_by_assignment(self):
+        values = self.read('X=\nY=1\n')
+        self.assertEqual(values["X"], "")
+        self.assertEqual(values["Y"], "1")
+
+    def test_empty_assignment_followed_by_comment(self):
+        values = self.read('MC_BASE_EXP_ID=\n\n#Data Import\nDI_EXP_ID="input"\n')
+        self.assertEqual(values["MC_BASE_EXP_ID"], "")
+        self.assertEqual(values["DI_EXP_ID"], "input")
+
+    def test_shipped_env_files(self):
+        for env_file in (".env.newsilva", ".env.oldsilva"):
+            values = stage_scheduler.read_env_file(os.path.join(stage_scheduler.QIIME_DIR, env_file))
+            self.assertEqual(values["MC_BASE_EXP_ID"], "")
+            self.assertEqual(values["RI_PARENT"], "")
+            self.assertEqual(values["DI_EXP_ID"], values["PRIMARY_EXP_ID"] + "_input")
+
+    def test_quoted_multiline_value_and_reference(self):
+        values = self.read('A="a"\nB=\'{"x":1,\n"y":"${A}"}\'\n')
+        self.assertEqual(values["B"], '{"x":1,\n"y":"a"}')
+
+
+class graphTest(unittest.TestCase):
+
+    def test_cycle_raises(self):
+        with self.assertRaises(ValueError):
+            stage_scheduler.topological_order({"A": {"B"}, "B": {"A"}})
+
+    def test_order(self):
+        self.assertEqual(stage_scheduler.topological_order({"A": set(), "B": {"A"}, "C": {"B"}}), ["A", "B", "C"])
+
+    def test_inference_only_run_on_other_data(self):
+        env_file = os.path.join(stage_scheduler.QIIME_DIR, ".env.newsilva")
+        values = stage_scheduler.read_env_file(env_file)
+        self.assertNotIn("Random_Forest_Inference", stage_scheduler.build_graph(values))
+
+        values["RI_PARENT"] = values["DP_EXP_ID"]
+        self.assertNotIn("Random_Forest_Inference", stage_scheduler.build_graph(values))
+
+        values["RI_PARENT"] = "New_Samples_ml_data_prep"
+        self.assertIn("Random_Forest_Inference", stage_scheduler.build_graph(values))
+
+
+class runWorkflowTest(unittest.TestCase):
+
+    def test_runs_dependencies_first(self):
+        finished = []
+
+        def run_stage(stage):
+            finished.append(stage)
+            return 0
+
+        results = stage_scheduler.run_workflow({"A": set(), "B": {"A"}}, run_stage)
+        self.assertEqual(finished, ["A", "B"])
+        self.assertEqual(results["B"]["status"], "success")
+
+    def test_skips_dependents_of_failed_stage(self):
+        results = stage_scheduler.run_workflow({"A": set(), "B": {"A"}}, lambda stage: 1)
+        self.assertEqual(results["A"]["status"], "failed")
+        self.assertEqual(results["B"]["status"], "skipped")
+
+    def test_unreachable_stage_raises(self):
+        with self.assertRaises(RuntimeError):
+            stage_scheduler.run_workflow({"A": {"Missing"}}, lambda stage: 0)
+
+
+class stageOutputTest(unittest.TestCase):
+
+    def test_other_threads_not_captured(self):
+        original = io.StringIO()
+        log = io.StringIO()
+        output = stage_scheduler.stageOutput(original)
+        started = threading.Event()
+        printed = threading.Event()
+
+        def stage():
+            with output.capture(log):
+                output.write("stage\n")
+                started.set()
+                printed.wait()
+
+        thread = threading.Thread(target=stage)
+        thread.start()
+        started.wait()
+        output.write("scheduler\n")
+        printed.set()
+        thread.join()
+
+        self.assertEqual(log.getvalue(), "stage\n")
+        self.assertEqual(original.getvalue(), "scheduler\n")
+
+
+# A stage that saves an artifact and a stage that loads it, both through the artifact store
+PRODUCER = """
+from pymongoClient import artifact_store
+
+
+class fakeArtifact(object):
+    def view(self, view_type):
+        return self
+
+    def save(self, path):
+        open(path, "w").close()
+        return path
+
+
+def main(db, environment):
+    print("Running " + environment["EXP_ID"])
+    artifact_store.save(fakeArtifact(), environment["OUTPUT_DIR"])
+"""
+
+CONSUMER = """
+from pymongoClient import artifact_store
+
+
+def main(db, environment):
+    print("Running " + environment["EXP_ID"])
+    assert artifact_store.peek(environment["PARENT"]) is not None
+"""
+
+
+class inProcessRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.stages = stage_scheduler.STAGES
+        self.workspace = tempfile.mkdtemp()
+        self.scripts = tempfile.mkdtemp()
+        for name, source in (("producer.py", PRODUCER), ("consumer.py", CONSUMER)):
+            with open(os.path.join(self.scripts, name), "w") as f:
+                f.write(source)
+        stage_scheduler.STAGES = {
+            "A": {"script": os.path.join(self.scripts, "producer.py"),
+                  "environment": {"EXP_ID": "A_EXP_ID", "OUTPUT_DIR": "A_OUT"}},
+            "B": {"script": os.path.join(self.scripts, "consumer.py"),
+                  "environment": {"EXP_ID": "B_EXP_ID", "PARENT": "A_OUT"}}
+        }
+
+    def tearDown(self):
+        stage_scheduler.STAGES = self.stages
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workspace, ignore_errors=True)
+        shutil.rmtree(self.scripts, ignore_errors=True)
+
+    def test_artifacts_passed_and_released(self):
+        graph = {"A": set(), "B": {"A"}}
+        env_values = {"A_EXP_ID": "a", "A_OUT": "a.qza", "B_EXP_ID": "b"}
+        runner = stage_scheduler.inProcessRunner(env_values, self.workspace, graph, self.workspace)
+        try:
+            self.assertEqual(runner("A"), 0)
+            # B has not run yet so the artifact of A is kept in memory
+            self.assertIsNotNone(runner.artifact_store.peek("a.qza"))
+            self.assertEqual(runner("B"), 0)
+            self.assertIsNone(runner.artifact_store.peek("a.qza"))
+        finally:
+            runner.close()
+
+        self.assertTrue(os.path.exists(os.path.join(self.workspace, "a.qza")))
+        with open(os.path.join(self.workspace, "logs", "B.log"), "r") as log:
+            self.assertEqual(log.read(), "Running b\n")
+
+
+if __name__ == '__main__':
+    unittest.main()